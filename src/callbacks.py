@@ -1,4 +1,4 @@
-from typing import Protocol, runtime_checkable
+from typing import Protocol, Tuple, runtime_checkable
 
 from processor.digitizer import MeterResult
 from configuration import Config
@@ -6,12 +6,14 @@ from configuration import Config
 
 @runtime_checkable
 class Callbacks(Protocol):
-    def get_meter_data(self, url: str = "", saveimages: bool = False) -> MeterResult:
-        """Get meter data"""
+    def get_meter_data(
+        self, url: str = "", saveimages: bool = False
+    ) -> Tuple[MeterResult, str]:
+        """Get meter data and the id of the reading's images"""
         ...
 
-    def get_image_as_base64_str(self, image_name: str) -> str:
-        """Get image as base64 string"""
+    def get_image_url(self, reading_id: str, image_name: str) -> str:
+        """Get URL of an image of a reading"""
         ...
 
     def get_config(self) -> Config:
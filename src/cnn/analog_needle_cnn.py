@@ -1,10 +1,12 @@
 import math
 import logging
+from typing import List, Optional, Union
 
 from PIL.Image import Image
 import numpy as np
 
 from cnn.base import CNNBase
+from cnn.registry import InterpreterOptions
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +17,32 @@ class AnalogNeedleCNN(CNNBase):
         modelfile: str,
         dx: int,
         dy: int,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        zero_copy: bool = False,
+        cache_size: Optional[int] = None,
     ) -> None:
         super().__init__(
             modelfile,
             dx=dx,
             dy=dy,
+            pool_size=pool_size,
+            options=options,
+            zero_copy=zero_copy,
+            cache_size=cache_size,
         )
         super()._loadModel()
 
-    def readout(self, image: Image) -> float:
+    def readout(self, image: Union[Image, np.ndarray]) -> float:
         output_data = super()._readout(image)
         out_sin = output_data[0][0]
         out_cos = output_data[0][1]
         result = np.arctan2(out_sin, out_cos) / (2 * math.pi) % 1
         result = result * 10
         return result
+
+    def _decode(self, output_data: np.ndarray) -> List[float]:
+        angle = np.arctan2(output_data[:, 0], output_data[:, 1]).astype(np.float64)
+        result = angle / (2 * math.pi) % 1
+        result = result * 10
+        return result.tolist()
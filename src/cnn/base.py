@@ -1,15 +1,27 @@
-import contextlib
 from dataclasses import dataclass
+import hashlib
 import os
 import logging
+import threading
 from importlib import util
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from PIL.Image import Image, NEAREST
 import numpy as np
 
-
-with contextlib.suppress(ImportError):
-    import tflite_runtime.interpreter as tflite
+from cnn.registry import InterpreterOptions, PooledInterpreter, model_registry
+from data_classes import ImagePosition
+import utils.image
 
 spam_spec = util.find_spec("tensorflow")
 found_tensorflow = spam_spec is not None
@@ -29,16 +41,44 @@ class ModelDetails:
     numer_output: int
 
 
+class _Buffers(threading.local):
+    def __init__(self) -> None:
+        self.buffers: Dict[Tuple, np.ndarray] = {}
+
+    def get(self, key: Tuple, shape: Tuple, dtype: np.dtype) -> np.ndarray:
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buffer
+        return buffer
+
+
+_input_buffers = _Buffers()
+_output_buffers = _Buffers()
+
+
+class _ResizeError(Exception):
+    pass
+
+
 class CNNBase:
     def __init__(
         self,
         modelfile: str,
         dx: int,
         dy: int,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        zero_copy: bool = False,
+        cache_size: Optional[int] = None,
     ) -> None:
         self.modelfile = modelfile
         self.dx = dx
         self.dy = dy
+        self.pool_size = pool_size
+        self.options = options
+        self.zero_copy = zero_copy
+        self.cache_size = cache_size
 
     def _loadModel(self) -> None:
         filename, file_extension = os.path.splitext(self.modelfile)
@@ -50,10 +90,12 @@ class CNNBase:
             return
 
         try:
-            self.interpreter = tflite.Interpreter(model_path=self.modelfile)  # type: ignore
-            self.interpreter.allocate_tensors()
-            self.input_details = self.interpreter.get_input_details()
-            self.output_details = self.interpreter.get_output_details()
+            model = model_registry.get(
+                self.modelfile, self.pool_size, self.options, self.cache_size
+            )
+            self.model = model
+            self.input_details = model.input_details
+            self.output_details = model.output_details
             self.getModelDetails()
         except Exception as e:
             logger.error(f"Error occured during model '{self.modelfile}' loading: {e}")
@@ -66,7 +108,9 @@ class CNNBase:
         logger.debug(
             f"Model '{self.modelfile}' loaded. "
             f"ModelSize: {xsize}x{ysize}x{channels}. "
-            f"Output: {numeroutput}"
+            f"Output: {numeroutput}. "
+            f"Input type: {np.dtype(self.input_details[0]['dtype']).name}. "
+            f"Output type: {np.dtype(self.output_details[0]['dtype']).name}"
         )
 
         return ModelDetails(
@@ -77,10 +121,250 @@ class CNNBase:
             numeroutput,
         )
 
-    def _readout(self, image: Image) -> np.ndarray:
-        test_image = image.resize((self.dx, self.dy), NEAREST)
-        test_image = np.array(test_image, dtype="float32")
-        input_data = np.reshape(test_image, [1, self.dy, self.dx, 3])
-        self.interpreter.set_tensor(self.input_details[0]["index"], input_data)
-        self.interpreter.invoke()
-        return self.interpreter.get_tensor(self.output_details[0]["index"])
+    def readout_batch(self, images: List[Union[Image, np.ndarray]]) -> List:
+        if not images:
+            return []
+        return self._decode(self._readout_batch(images))
+
+    def readout_pixels(self, pixels: np.ndarray) -> List:
+        """
+        Read out images from an array of shape (N, dy, dx, 3), see
+        input_buffer.
+        """
+        if len(pixels) == 0:
+            return []
+        return self._decode(self._readout_pixels(pixels))
+
+    def readout_direct(self, count: int, fill: Callable[[np.ndarray], Any]) -> List:
+        """
+        Read out images which are written by the fill function, see
+        _readout_direct.
+        """
+        if count == 0:
+            return []
+        return self._decode(self._readout_direct(count, fill))
+
+    def readout_cached(
+        self, keys: Sequence[Hashable], fill: Callable[[np.ndarray], Any]
+    ) -> List:
+        """
+        Read out images with the readout cache of the model, see
+        _readout_cached.
+        """
+        if len(keys) == 0:
+            return []
+        return self._readout_cached(keys, fill, self._decode)
+
+    def _decode(self, output_data: np.ndarray) -> List:
+        """
+        Convert the model output of shape (N, outputs) to a readout value for
+        every image. Implemented by the model types.
+        """
+        raise NotImplementedError
+
+    def _readout(self, image: Union[Image, np.ndarray]) -> np.ndarray:
+        return self._invoke(self._prepare_image(image)[np.newaxis])
+
+    def _readout_batch(self, images: List[Union[Image, np.ndarray]]) -> np.ndarray:
+        return self._readout_array(
+            np.stack([self._prepare_image(image) for image in images])
+        )
+
+    def _readout_array(self, input_data: np.ndarray) -> np.ndarray:
+        """
+        Read out all images with a single interpreter invoke. Falls back to
+        one invoke per image if the model does not accept a resized input.
+        """
+        if len(input_data) > 1 and self.model.batch_supported:
+            try:
+                return self._invoke(input_data)
+            except Exception as e:
+                logger.warning(
+                    f"Model '{self.modelfile}' does not support batch readout, "
+                    f"fallback to single image readout: {e}"
+                )
+                self.model.batch_supported = False
+        return np.concatenate(
+            [self._invoke(input_data[i : i + 1]) for i in range(len(input_data))]
+        )
+
+    def input_buffer(self, count: int) -> np.ndarray:
+        """
+        Reusable array of shape (count, dy, dx, 3) for the pixel values of the
+        images to read out. The array is allocated once per thread and model,
+        float models get a float32 array and quantized models an uint8 array.
+        """
+        dtype = np.dtype(self.input_details[0]["dtype"])
+        dtype = dtype if dtype.kind == "f" else np.dtype(np.uint8)
+        shape = (count, self.dy, self.dx, 3)
+        return _input_buffers.get((self.modelfile, shape, dtype), shape, dtype)
+
+    def _readout_pixels(self, pixels: np.ndarray) -> np.ndarray:
+        return self._readout_array(self._quantize_input(pixels))
+
+    def _readout_direct(
+        self, count: int, fill: Callable[[np.ndarray], Any]
+    ) -> np.ndarray:
+        """
+        Read out images which are written by the fill function. In zero copy
+        mode fill writes the pixel values directly into the input tensor of the
+        interpreter and the output is copied once into a reusable array, which
+        is only valid until the next readout of the model in the same thread.
+        Otherwise or when the model does not support it, fill writes into
+        input_buffer and the images are read out like _readout_pixels does.
+
+        Args:
+            count (int): Number of images.
+            fill (Callable[[np.ndarray], Any]): Function which writes the pixel
+            values (0-255) into the given array of shape (count, dy, dx, 3).
+
+        Returns:
+            np.ndarray: Model output for all images.
+        """
+        if self.zero_copy and self._direct_input_supported(count):
+            try:
+                return self._invoke_direct(count, fill)
+            except _ResizeError as e:
+                logger.warning(
+                    f"Model '{self.modelfile}' does not support batch readout, "
+                    f"fallback to single image readout: {e}"
+                )
+                self.model.batch_supported = False
+        return self._readout_pixels(fill(self.input_buffer(count)))
+
+    def _readout_cached(
+        self,
+        keys: Sequence[Hashable],
+        fill: Callable[[np.ndarray], Any],
+        decode: Callable[[np.ndarray], List],
+    ) -> List:
+        """
+        Read out images with the readout cache of the model. Every image is
+        identified by its key together with a hash of its pixel values, only
+        images not found in the cache are read out by the model. Without cache
+        all images are read out like _readout_direct does.
+
+        Args:
+            keys (Sequence[Hashable]): Key for every image, e.g. the position
+            and preprocessing settings of the cut image.
+            fill (Callable[[np.ndarray], Any]): Function which writes the pixel
+            values (0-255) into the given array of shape (count, dy, dx, 3).
+            decode (Callable[[np.ndarray], List]): Function which converts the
+            model output to readout values.
+
+        Returns:
+            List: Readout value for every image.
+        """
+        cache = self.model.cache
+        if not cache.enabled:
+            return decode(self._readout_direct(len(keys), fill))
+
+        pixels = fill(self.input_buffer(len(keys)))
+        keys = [
+            (key, hashlib.blake2b(pixels[i], digest_size=16).digest())
+            for i, key in enumerate(keys)
+        ]
+        values = [cache.get(key) for key in keys]
+        misses = [i for i, value in enumerate(values) if value is None]
+        if misses:
+            output = decode(self._readout_pixels(pixels[misses]))
+            for i, value in zip(misses, output):
+                values[i] = value
+                cache.put(keys[i], value)
+        return values
+
+    def _direct_input_supported(self, count: int) -> bool:
+        # pixel values can be written as is only if no quantization is needed
+        if count > 1 and not self.model.batch_supported:
+            return False
+        dtype = np.dtype(self.input_details[0]["dtype"])
+        if dtype.kind == "f":
+            return True
+        scale, zero_point = self.input_details[0]["quantization"]
+        return dtype == np.uint8 and (scale == 0 or (scale == 1 and zero_point == 0))
+
+    def _prepare_image(self, image: Union[Image, np.ndarray]) -> np.ndarray:
+        if isinstance(image, np.ndarray):
+            # same pixels as PIL resize with NEAREST filter
+            h, w = image.shape[:2]
+            test_image = utils.image.cut_images_to_array(
+                image, [ImagePosition("", 0, 0, w, h)], self.dx, self.dy
+            )[0]
+        else:
+            test_image = np.asarray(image.resize((self.dx, self.dy), NEAREST))
+        test_image = self._quantize_input(test_image)
+        return np.reshape(test_image, [self.dy, self.dx, 3])
+
+    def _quantize_input(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Convert pixel values (0-255) to the model input type. Quantized
+        (uint8/int8) models get the integer values directly, scaled with the
+        input quantization parameters when the model has them.
+        """
+        dtype = np.dtype(self.input_details[0]["dtype"])
+        if dtype.kind == "f":
+            return pixels.astype(dtype, copy=False)
+        scale, zero_point = self.input_details[0]["quantization"]
+        if scale == 0 or (scale == 1 and zero_point == 0):
+            values = pixels
+        else:
+            values = np.round(pixels / scale + zero_point)
+        if values.dtype == dtype:
+            return values
+        info = np.iinfo(dtype)
+        return np.clip(values, info.min, info.max).astype(dtype)
+
+    def _dequantize_output(self, output: np.ndarray) -> np.ndarray:
+        """
+        Convert quantized (uint8/int8) model output to float values.
+        """
+        if output.dtype.kind == "f":
+            return output
+        scale, zero_point = self.output_details[0]["quantization"]
+        if scale == 0:
+            return output.astype(np.float32)
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def _invoke(self, input_data: np.ndarray) -> np.ndarray:
+        index = self.input_details[0]["index"]
+        with self.model.pool.checkout() as item:
+            interpreter = item.interpreter
+            self._resize_input(item, len(input_data))
+            interpreter.set_tensor(index, input_data)
+            interpreter.invoke()
+            output = interpreter.get_tensor(self.output_details[0]["index"])
+        return self._dequantize_output(output)
+
+    def _invoke_direct(
+        self, count: int, fill: Callable[[np.ndarray], Any]
+    ) -> np.ndarray:
+        with self.model.pool.checkout() as item:
+            interpreter = item.interpreter
+            try:
+                self._resize_input(item, count)
+            except Exception as e:
+                if count == 1:
+                    raise
+                raise _ResizeError(e) from e
+            # views to the tensor data must be released before invoke
+            fill(interpreter.tensor(self.input_details[0]["index"])())
+            interpreter.invoke()
+            output = interpreter.tensor(self.output_details[0]["index"])()
+            result = _output_buffers.get(
+                (self.modelfile, output.shape, output.dtype),
+                output.shape,
+                output.dtype,
+            )
+            np.copyto(result, output)
+            del output
+        return self._dequantize_output(result)
+
+    def _resize_input(self, item: PooledInterpreter, count: int) -> None:
+        if item.batch_size == count:
+            return
+        shape = [count, *self.input_details[0]["shape"][1:]]
+        # unknown until the resized tensors are allocated successfully
+        item.batch_size = 0
+        item.interpreter.resize_tensor_input(self.input_details[0]["index"], shape)
+        item.interpreter.allocate_tensors()
+        item.batch_size = count
@@ -0,0 +1,372 @@
+from dataclasses import dataclass, field
+import os
+import logging
+import resource
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+from cnn.analog_needle_cnn import AnalogNeedleCNN
+from cnn.digital_counter_cnn import DigitalCounterCNN
+from cnn.registry import InterpreterOptions, create_interpreter, model_registry
+from configuration import CNNParams, Config
+from data_classes import ImagePosition
+import utils.image
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LatencyResult:
+    model_file: str
+    num_threads: int
+    use_xnnpack: bool
+    batch_size: int
+    iterations: int
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    min_ms: float
+
+
+@dataclass
+class AllocationResult:
+    name: str
+    iterations: int
+    mean_peak_bytes: float
+    max_peak_bytes: int
+    retained_bytes: int
+
+
+@dataclass
+class ModelBenchmarkResult:
+    model_file: str
+    model_type: str
+    input_type: str
+    load_time_ms: float
+    images: int
+    p50_ms: float
+    p95_ms: float
+    batch_size: int
+    batch_images_per_sec: float
+    peak_rss_mb: float
+    agreement: Dict[str, float] = field(default_factory=dict)
+
+
+def default_thread_counts() -> List[int]:
+    """
+    Thread counts to benchmark: 1, 2, 4, ... up to the number of CPU cores.
+    The runtime default (0) is always included.
+    """
+    cpu_count = os.cpu_count() or 1
+    counts = [0]
+    threads = 1
+    while threads <= cpu_count:
+        counts.append(threads)
+        threads *= 2
+    if counts[-1] != cpu_count:
+        counts.append(cpu_count)
+    return counts
+
+
+def benchmark_latency(
+    model_file: str,
+    thread_counts: Sequence[int] = (),
+    xnnpack: Sequence[bool] = (True, False),
+    batch_size: int = 1,
+    iterations: int = 50,
+    warmup: int = 5,
+) -> List[LatencyResult]:
+    """
+    Measure the per invoke latency of a model for each interpreter setting.
+
+    Args:
+        model_file (str): Path to the TFLite model file.
+        thread_counts (Sequence[int], optional): Thread counts to measure.
+        Defaults to default_thread_counts().
+        xnnpack (Sequence[bool], optional): XNNPACK delegate settings to
+        measure. Defaults to both enabled and disabled.
+        batch_size (int, optional): Number of images per invoke. Defaults to 1.
+        iterations (int, optional): Number of measured invokes. Defaults to 50.
+        warmup (int, optional): Number of invokes before measuring. Defaults
+        to 5.
+
+    Returns:
+        List[LatencyResult]: Latency per setting, fastest first.
+    """
+    results = []
+    for use_xnnpack in xnnpack:
+        for num_threads in thread_counts or default_thread_counts():
+            options = InterpreterOptions(
+                num_threads=num_threads, use_xnnpack=use_xnnpack
+            )
+            times = _measure(model_file, options, batch_size, iterations, warmup)
+            result = LatencyResult(
+                model_file=model_file,
+                num_threads=num_threads,
+                use_xnnpack=use_xnnpack,
+                batch_size=batch_size,
+                iterations=iterations,
+                mean_ms=float(np.mean(times)),
+                p50_ms=float(np.percentile(times, 50)),
+                p95_ms=float(np.percentile(times, 95)),
+                min_ms=float(np.min(times)),
+            )
+            logger.debug(f"Benchmark result: {result}")
+            results.append(result)
+    return sorted(results, key=lambda x: x.p50_ms)
+
+
+def _measure(
+    model_file: str,
+    options: InterpreterOptions,
+    batch_size: int,
+    iterations: int,
+    warmup: int,
+) -> np.ndarray:
+    interpreter = create_interpreter(model_file, options)
+    input_details = interpreter.get_input_details()[0]
+    shape = [batch_size, *input_details["shape"][1:]]
+    if batch_size != input_details["shape"][0]:
+        interpreter.resize_tensor_input(input_details["index"], shape)
+        interpreter.allocate_tensors()
+
+    rng = np.random.default_rng(0)
+    input_data = rng.uniform(0, 255, shape).astype(input_details["dtype"])
+    times = np.empty(iterations)
+    for i in range(warmup + iterations):
+        start_time = time.perf_counter()
+        interpreter.set_tensor(input_details["index"], input_data)
+        interpreter.invoke()
+        if i >= warmup:
+            times[i - warmup] = (time.perf_counter() - start_time) * 1000
+    return times
+
+
+def measure_allocations(
+    name: str, func: Callable[[], Any], iterations: int = 20, warmup: int = 2
+) -> AllocationResult:
+    """
+    Measure the memory allocated by each call of the function. The peak is the
+    memory allocated on top of the memory in use before the call, so it is
+    zero when the call does not allocate.
+
+    Args:
+        name (str): Name of the result.
+        func (Callable[[], Any]): Function to measure.
+        iterations (int, optional): Number of measured calls. Defaults to 20.
+        warmup (int, optional): Number of calls before measuring, e.g. to fill
+        caches and reusable buffers. Defaults to 2.
+
+    Returns:
+        AllocationResult: Allocations per call.
+    """
+    for _ in range(warmup):
+        func()
+    peaks = np.empty(iterations, dtype=np.int64)
+    tracemalloc.start()
+    try:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        for i in range(iterations):
+            tracemalloc.reset_peak()
+            current_bytes = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks[i] = tracemalloc.get_traced_memory()[1] - current_bytes
+        retained_bytes = tracemalloc.get_traced_memory()[0] - start_bytes
+    finally:
+        tracemalloc.stop()
+    result = AllocationResult(
+        name=name,
+        iterations=iterations,
+        mean_peak_bytes=float(np.mean(peaks)),
+        max_peak_bytes=int(np.max(peaks)),
+        retained_bytes=retained_bytes,
+    )
+    logger.debug(f"Allocation result: {result}")
+    return result
+
+
+def benchmark_models(
+    model_files: Sequence[str],
+    frames: Sequence[np.ndarray],
+    analog_positions: Sequence[ImagePosition],
+    digital_positions: Sequence[ImagePosition],
+    repeats: int = 5,
+    autocontrast: bool = False,
+    cutoff_low: float = 2,
+    cutoff_high: float = 45,
+    ignore: Union[int, None] = None,
+) -> List[ModelBenchmarkResult]:
+    """
+    Compare models on the cut images of the given frames. Every model reads out
+    the analog or digital positions depending on its output, the readouts of
+    models of the same type are compared with each other.
+
+    Args:
+        model_files (Sequence[str]): Paths of the TFLite model files.
+        frames (Sequence[np.ndarray]): Aligned RGB images.
+        analog_positions (Sequence[ImagePosition]): Analog counter positions.
+        digital_positions (Sequence[ImagePosition]): Digit positions.
+        repeats (int, optional): Number of times the images are read out for
+        the latency and throughput measurement. Defaults to 5.
+        autocontrast (bool, optional): Apply autocontrast to the cut images,
+        see utils.image.cut_images_to_array. Defaults to False.
+        cutoff_low (float, optional): Autocontrast low cutoff in percent.
+        cutoff_high (float, optional): Autocontrast high cutoff in percent.
+        ignore (int, optional): Autocontrast background pixel value.
+
+    Returns:
+        List[ModelBenchmarkResult]: Result for every model. The peak RSS is
+        the peak of the process up to the end of the model benchmark.
+    """
+    results = []
+    readings: Dict[str, List[Optional[float]]] = {}
+    for model_file in model_files:
+        start_time = time.perf_counter()
+        model = model_registry.get(model_file)
+        load_time = time.perf_counter() - start_time
+
+        _, dy, dx, _ = model.input_details[0]["shape"]
+        classes = model.output_details[0]["shape"][1]
+        reader: Union[AnalogNeedleCNN, DigitalCounterCNN]
+        if classes == 2:
+            reader = AnalogNeedleCNN(model_file, dx=dx, dy=dy)
+            model_type, positions = "analog", analog_positions
+        else:
+            reader = DigitalCounterCNN(model_file, dx=dx, dy=dy)
+            model_type, positions = f"digital{classes}", digital_positions
+
+        pixels = np.concatenate(
+            [
+                utils.image.cut_images_to_array(
+                    frame,
+                    positions,
+                    int(dx),
+                    int(dy),
+                    autocontrast=autocontrast,
+                    cutoff_low=cutoff_low,
+                    cutoff_high=cutoff_high,
+                    ignore=ignore,
+                )
+                for frame in frames
+            ]
+        )
+        values = reader.readout_pixels(pixels)
+        times = []
+        batch_time = 0.0
+        for _ in range(repeats):
+            for i in range(len(pixels)):
+                start_time = time.perf_counter()
+                reader.readout_pixels(pixels[i : i + 1])
+                times.append(time.perf_counter() - start_time)
+            for i in range(0, len(pixels), max(1, len(positions))):
+                start_time = time.perf_counter()
+                reader.readout_pixels(pixels[i : i + len(positions)])
+                batch_time += time.perf_counter() - start_time
+
+        readings[model_file] = [_normalize(value, classes) for value in values]
+        result = ModelBenchmarkResult(
+            model_file=model_file,
+            model_type=model_type,
+            input_type=np.dtype(model.input_details[0]["dtype"]).name,
+            load_time_ms=load_time * 1000,
+            images=len(pixels),
+            p50_ms=float(np.percentile(times, 50)) * 1000 if times else 0.0,
+            p95_ms=float(np.percentile(times, 95)) * 1000 if times else 0.0,
+            batch_size=len(positions),
+            batch_images_per_sec=(
+                len(pixels) * repeats / batch_time if batch_time else 0.0
+            ),
+            peak_rss_mb=_peak_rss_mb(),
+        )
+        logger.debug(f"Model benchmark result: {result}")
+        results.append(result)
+
+    for result in results:
+        for other in results:
+            if other is not result and other.model_type[:6] == result.model_type[:6]:
+                result.agreement[other.model_file] = _agreement(
+                    readings[result.model_file], readings[other.model_file]
+                )
+    return results
+
+
+def measure_readout_allocations(
+    params: CNNParams, reader: Union[AnalogNeedleCNN, DigitalCounterCNN]
+) -> AllocationResult:
+    """
+    Measure the allocations of reading out the configured positions of a
+    model, see measure_allocations.
+    """
+    positions = params.cut_images
+    height = max([pos.y + pos.h for pos in positions] or [1])
+    width = max([pos.x + pos.w for pos in positions] or [1])
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), np.uint8)
+
+    def fill(out: np.ndarray) -> np.ndarray:
+        return utils.image.cut_images_to_array(
+            frame, positions, reader.dx, reader.dy, out=out
+        )
+
+    return measure_allocations(
+        f"{os.path.basename(params.model_file)} (zero copy: {reader.zero_copy})",
+        lambda: reader.readout_direct(len(positions), fill),
+    )
+
+
+def benchmark_model_dirs(
+    config: Config, frames: Sequence[np.ndarray]
+) -> List[ModelBenchmarkResult]:
+    """
+    Compare all models in the directories of the configured models on the
+    configured positions of the given frames, see benchmark_models.
+    """
+    model_files = []
+    for params in [config.digital_readout, config.analog_readout]:
+        models_dir = os.path.dirname(params.model_file)
+        model_files += [
+            os.path.join(models_dir, name)
+            for name in sorted(os.listdir(models_dir))
+            if name.endswith(".tflite")
+        ]
+    cut_params = config.image_processing.autocontrast_cut_images
+    return benchmark_models(
+        sorted(set(model_files), key=model_files.index),
+        frames,
+        config.analog_readout.cut_images,
+        config.digital_readout.cut_images,
+        autocontrast=config.image_processing.enabled and cut_params.enabled,
+        cutoff_low=cut_params.cutoff_low,
+        cutoff_high=cut_params.cutoff_high,
+        ignore=cut_params.ignore,
+    )
+
+
+def _normalize(value: float, classes: int) -> Optional[float]:
+    # readout as counter value 0-10, None if the digit is not readable
+    if classes == 2:
+        return value
+    if classes == 100:
+        return value / 10
+    return value if value < 10 else None
+
+
+def _agreement(values: List[Optional[float]], others: List[Optional[float]]) -> float:
+    # values agree if they are less than one digit apart (values wrap at 10)
+    if not values:
+        return 0.0
+    agree = 0
+    for value, other in zip(values, others):
+        if value is None or other is None:
+            agree += value is None and other is None
+        else:
+            distance = abs(value - other) % 10
+            agree += min(distance, 10 - distance) < 1
+    return agree / len(values)
+
+
+def _peak_rss_mb() -> float:
+    # peak resident set size of the process, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
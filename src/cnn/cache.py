@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    size: int = 0
+    max_size: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class InferenceCache:
+    """
+    Bounded LRU cache for readout values of a model. Entries are identified by
+    the caller, typically by the cut image position together with a hash of
+    the model input pixels. A cache with size 0 is disabled.
+    """
+
+    def __init__(self, max_size: int = 0) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self.stats = CacheStats(max_size=max(0, max_size))
+
+    @property
+    def enabled(self) -> bool:
+        return self.stats.max_size > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if not self.enabled:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def resize(self, max_size: int) -> None:
+        with self._lock:
+            self.stats.max_size = max(0, max_size)
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.stats.size = 0
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.stats.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        self.stats.size = len(self._entries)
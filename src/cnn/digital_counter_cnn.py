@@ -1,9 +1,11 @@
 import logging
+from typing import List, Optional, Union
 
 from PIL.Image import Image
 import numpy as np
 
 from cnn.base import CNNBase
+from cnn.registry import InterpreterOptions
 
 logger = logging.getLogger(__name__)
 
@@ -14,14 +16,25 @@ class DigitalCounterCNN(CNNBase):
         modelfile: str,
         dx: int,
         dy: int,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        zero_copy: bool = False,
+        cache_size: Optional[int] = None,
     ) -> None:
         super().__init__(
             modelfile,
             dx=dx,
             dy=dy,
+            pool_size=pool_size,
+            options=options,
+            zero_copy=zero_copy,
+            cache_size=cache_size,
         )
         super()._loadModel()
 
-    def readout(self, image: Image) -> int:
+    def readout(self, image: Union[Image, np.ndarray]) -> int:
         output_data = super()._readout(image)
         return int(np.argmax(output_data))
+
+    def _decode(self, output_data: np.ndarray) -> List[int]:
+        return np.argmax(output_data, axis=1).tolist()
@@ -0,0 +1,319 @@
+import contextlib
+from dataclasses import dataclass, field
+import os
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from cnn.cache import CacheStats, InferenceCache
+from configuration import CNNParams
+
+with contextlib.suppress(ImportError):
+    import tflite_runtime.interpreter as tflite
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class InterpreterOptions:
+    num_threads: int = 0
+    use_xnnpack: bool = True
+
+
+def get_interpreter_options(params: CNNParams) -> InterpreterOptions:
+    return InterpreterOptions(
+        num_threads=params.num_threads, use_xnnpack=params.use_xnnpack
+    )
+
+
+def create_interpreter(
+    model_file: str, options: InterpreterOptions = InterpreterOptions()
+) -> Any:
+    """
+    Create TFLite interpreter for the model file and allocate its tensors.
+
+    Args:
+        model_file (str): Path to the TFLite model file.
+        options (InterpreterOptions, optional): Number of threads (0 for the
+        runtime default) and whether the default XNNPACK delegate is applied.
+
+    Returns:
+        Any: TFLite interpreter.
+    """
+    resolver_type = (
+        tflite.OpResolverType.AUTO  # type: ignore
+        if options.use_xnnpack
+        else tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES  # type: ignore
+    )
+    interpreter = tflite.Interpreter(  # type: ignore
+        model_path=model_file,
+        num_threads=options.num_threads if options.num_threads > 0 else None,
+        experimental_op_resolver_type=resolver_type,
+    )
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+@dataclass
+class PooledInterpreter:
+    interpreter: Any
+    batch_size: int = 1
+
+
+@dataclass
+class PoolStats:
+    size: int = 0
+    interpreters: int = 0
+    in_use: int = 0
+    checkout_count: int = 0
+    wait_count: int = 0
+    total_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+
+
+class InterpreterPool:
+    """
+    Pool of interpreters for one model. A TFLite interpreter must not be used
+    by several threads at the same time, so every thread checks out its own
+    interpreter. Interpreters are created lazily up to the pool size, after
+    that the callers wait until an interpreter is returned to the pool.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        size: int = 1,
+        interpreter: Any = None,
+    ) -> None:
+        self._factory = factory
+        self._condition = threading.Condition()
+        self._idle: List[PooledInterpreter] = []
+        self._created = 0
+        self.stats = PoolStats(size=max(1, size))
+        if interpreter is not None:
+            self._idle.append(PooledInterpreter(interpreter))
+            self._created = 1
+            self.stats.interpreters = 1
+
+    def resize(self, size: int) -> None:
+        with self._condition:
+            self.stats.size = max(1, size)
+            while self._idle and self._created > self.stats.size:
+                self._idle.pop()
+                self._created -= 1
+            self.stats.interpreters = self._created
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def checkout(self) -> Iterator[PooledInterpreter]:
+        start_time = time.perf_counter()
+        with self._condition:
+            waited = False
+            while not self._idle and self._created >= self.stats.size:
+                waited = True
+                self._condition.wait()
+            item = self._idle.pop() if self._idle else None
+            if item is None:
+                self._created += 1
+            wait_time = time.perf_counter() - start_time
+            self.stats.checkout_count += 1
+            self.stats.wait_count += 1 if waited else 0
+            self.stats.total_wait_time += wait_time
+            self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+            self.stats.in_use += 1
+
+        if item is None:
+            try:
+                item = PooledInterpreter(self._factory())
+            except Exception:
+                with self._condition:
+                    self._created -= 1
+                    self.stats.in_use -= 1
+                    self._condition.notify()
+                raise
+
+        try:
+            yield item
+        finally:
+            with self._condition:
+                self.stats.in_use -= 1
+                if self._created > self.stats.size:
+                    self._created -= 1
+                else:
+                    self._idle.append(item)
+                self.stats.interpreters = self._created
+                self._condition.notify()
+
+
+@dataclass
+class LoadedModel:
+    model_file: str
+    mtime: float
+    size: int
+    options: InterpreterOptions
+    input_details: list
+    output_details: list
+    pool: InterpreterPool
+    cache: InferenceCache = field(default_factory=InferenceCache)
+    batch_supported: bool = True
+
+
+@dataclass
+class ModelStats:
+    model_file: str
+    loaded: bool = False
+    load_count: int = 0
+    reuse_count: int = 0
+    last_load_time: float = 0.0
+    total_load_time: float = 0.0
+    num_threads: int = 0
+    use_xnnpack: bool = True
+    pool: PoolStats = field(default_factory=PoolStats)
+    cache: CacheStats = field(default_factory=CacheStats)
+
+
+class ModelRegistry:
+    """
+    Process wide cache for TFLite models.
+
+    Models are loaded once and kept warm. An entry is identified by the model
+    file path together with the file modification time and size, so a model
+    file replaced on disk is loaded again on next use.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._models: Dict[str, LoadedModel] = {}
+        self._stats: Dict[str, ModelStats] = {}
+
+    def get(
+        self,
+        model_file: str,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        cache_size: Optional[int] = None,
+    ) -> LoadedModel:
+        """
+        Get loaded model from the registry. Model is loaded if it is not
+        available in the registry, if the model file has changed or if the
+        interpreter options differ from the loaded model. A reloaded model
+        starts with an empty readout cache.
+
+        Args:
+            model_file (str): Path to the TFLite model file.
+            pool_size (int, optional): Number of interpreters which can be used
+            in parallel for the model. Defaults to None, which keeps the current
+            pool size (1 for a new model).
+            options (InterpreterOptions, optional): Interpreter options. Defaults
+            to None, which keeps the current options (default options for a new
+            model).
+            cache_size (int, optional): Number of readout values cached for the
+            model, 0 disables the cache. Defaults to None, which keeps the
+            current size (0 for a new model).
+
+        Returns:
+            LoadedModel: Loaded model.
+        """
+        path = os.path.realpath(model_file)
+        mtime, size = self._file_signature(path)
+        with self._lock:
+            stats = self._stats.setdefault(path, ModelStats(model_file=path))
+            model = self._models.get(path)
+            if options is None:
+                options = model.options if model else InterpreterOptions()
+            if (
+                model is not None
+                and model.mtime == mtime
+                and model.size == size
+                and model.options == options
+            ):
+                stats.reuse_count += 1
+                if pool_size is not None and pool_size != model.pool.stats.size:
+                    model.pool.resize(pool_size)
+                if cache_size is not None and cache_size != model.cache.stats.max_size:
+                    model.cache.resize(cache_size)
+                return model
+
+            start_time = time.perf_counter()
+            if model is not None and pool_size is None:
+                pool_size = model.pool.stats.size
+            if model is not None and cache_size is None:
+                cache_size = model.cache.stats.max_size
+            model = self._load(path, mtime, size, pool_size or 1, options)
+            model.cache.resize(cache_size or 0)
+            load_time = time.perf_counter() - start_time
+
+            self._models[path] = model
+            stats.loaded = True
+            stats.load_count += 1
+            stats.last_load_time = load_time
+            stats.total_load_time += load_time
+            stats.num_threads = options.num_threads
+            stats.use_xnnpack = options.use_xnnpack
+            stats.pool = model.pool.stats
+            stats.cache = model.cache.stats
+            logger.debug(f"Model '{path}' loaded in {load_time:.4f} sec")
+            return model
+
+    def retain(self, model_files: List[str]) -> None:
+        """
+        Remove all models from the registry which are not in the given list.
+
+        Args:
+            model_files (List[str]): Paths of the model files to keep.
+        """
+        keep = {os.path.realpath(file) for file in model_files if file}
+        with self._lock:
+            for path in list(self._models):
+                if path not in keep:
+                    logger.debug(f"Model '{path}' removed from registry")
+                    del self._models[path]
+                    self._stats[path].loaded = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self._stats.clear()
+
+    def get_stats(self) -> List[ModelStats]:
+        with self._lock:
+            return [
+                ModelStats(
+                    **{
+                        **vars(stats),
+                        "pool": PoolStats(**vars(stats.pool)),
+                        "cache": CacheStats(**vars(stats.cache)),
+                    }
+                )
+                for stats in self._stats.values()
+            ]
+
+    def _file_signature(self, path: str) -> Tuple[float, int]:
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def _load(
+        self,
+        path: str,
+        mtime: float,
+        size: int,
+        pool_size: int,
+        options: InterpreterOptions,
+    ) -> LoadedModel:
+        def factory() -> Any:
+            return create_interpreter(path, options)
+
+        interpreter = factory()
+        return LoadedModel(
+            model_file=path,
+            mtime=mtime,
+            size=size,
+            options=options,
+            input_details=interpreter.get_input_details(),
+            output_details=interpreter.get_output_details(),
+            pool=InterpreterPool(factory, size=pool_size, interpreter=interpreter),
+        )
+
+
+model_registry = ModelRegistry()
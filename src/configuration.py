@@ -21,6 +21,7 @@ class ImageSource:
     url: str = ""
     timeout: int = 30
     min_size: int = 10000
+    reduced_decode: bool = False
 
 
 @dataclass
@@ -28,6 +29,13 @@ class CNNParams:
     enabled: bool = False
     model_file: str = ""
     model: str = ""
+    interpreter_pool_size: int = 1
+    num_threads: int = 0
+    use_xnnpack: bool = True
+    zero_copy: bool = True
+    cache_size: int = 64
+    change_threshold: float = 0.0
+    full_readout_interval: int = 10
     cut_images: List[ImagePosition] = field(default_factory=list)
 
 
@@ -36,6 +44,14 @@ class Alignment:
     rotate_angle: float = 0.0
     ref_images: List[RefImage] = field(default_factory=list)
     post_rotate_angle: float = 0.0
+    search_window: int = 50
+    min_confidence: float = 0.8
+    mode: str = "full"
+    pyramid_levels: int = 2
+    reuse_transform: bool = False
+    max_transform_age: int = 10
+    phase_min_response: float = 0.3
+    phase_rotation: bool = False
 
 
 @dataclass
@@ -72,6 +88,7 @@ class ImageProcessing:
     grayscale: bool = False
     autocontrast: AutoContrast = field(default_factory=AutoContrast)
     autocontrast_cut_images: AutoContrast = field(default_factory=AutoContrast)
+    cut_images_area_only: bool = False
 
 
 @dataclass
@@ -148,6 +165,7 @@ class Config:
             "URL": self.image_source.url,
             "Timeout": str(self.image_source.timeout),
             "MinSize": str(self.image_source.min_size),
+            "ReducedDecode": str(self.image_source.reduced_decode),
         }
 
         config["Crop"] = {
@@ -189,12 +207,21 @@ class Config:
             "AutoContrastCutImagesIgnore": str(
                 self.image_processing.autocontrast_cut_images.ignore
             ),
+            "CutImagesAreaOnly": str(self.image_processing.cut_images_area_only),
         }
 
         config["Alignment"] = {
             "RotationAngle": str(self.alignment.rotate_angle),
             "Refs": ", ".join([ref.name for ref in self.alignment.ref_images]),
             "PostRotationAngle": str(self.alignment.post_rotate_angle),
+            "SearchWindow": str(self.alignment.search_window),
+            "MinConfidence": str(self.alignment.min_confidence),
+            "Mode": self.alignment.mode,
+            "PyramidLevels": str(self.alignment.pyramid_levels),
+            "ReuseTransform": str(self.alignment.reuse_transform),
+            "MaxTransformAge": str(self.alignment.max_transform_age),
+            "PhaseMinResponse": str(self.alignment.phase_min_response),
+            "PhaseRotation": str(self.alignment.phase_rotation),
         }
 
         for ref in self.alignment.ref_images:
@@ -226,6 +253,13 @@ class Config:
             "Enabled": str(self.digital_readout.enabled),
             "ModelFile": self.digital_readout.model_file,
             "Model": self.digital_readout.model,
+            "InterpreterPoolSize": str(self.digital_readout.interpreter_pool_size),
+            "NumThreads": str(self.digital_readout.num_threads),
+            "UseXnnpack": str(self.digital_readout.use_xnnpack),
+            "ZeroCopy": str(self.digital_readout.zero_copy),
+            "CacheSize": str(self.digital_readout.cache_size),
+            "ChangeThreshold": str(self.digital_readout.change_threshold),
+            "FullReadoutInterval": str(self.digital_readout.full_readout_interval),
             "Names": ", ".join(
                 [image.name for image in self.digital_readout.cut_images]
             ),
@@ -235,6 +269,13 @@ class Config:
             "Enabled": str(self.analog_readout.enabled),
             "ModelFile": self.analog_readout.model_file,
             "Model": self.analog_readout.model,
+            "InterpreterPoolSize": str(self.analog_readout.interpreter_pool_size),
+            "NumThreads": str(self.analog_readout.num_threads),
+            "UseXnnpack": str(self.analog_readout.use_xnnpack),
+            "ZeroCopy": str(self.analog_readout.zero_copy),
+            "CacheSize": str(self.analog_readout.cache_size),
+            "ChangeThreshold": str(self.analog_readout.change_threshold),
+            "FullReadoutInterval": str(self.analog_readout.full_readout_interval),
             "Names": ", ".join(
                 [image.name for image in self.analog_readout.cut_images]
             ),
@@ -279,10 +320,14 @@ class Config:
         url = config.get("ImageSource", "URL", fallback="")
         timeout = config.getint("ImageSource", "Timeout", fallback=30)
         min_size = config.getint("ImageSource", "MinSize", fallback=10000)
+        reduced_decode = config.getboolean(
+            "ImageSource", "ReducedDecode", fallback=False
+        )
         self.image_source = ImageSource(
             url=url,
             timeout=timeout,
             min_size=min_size,
+            reduced_decode=reduced_decode,
         )
         ##################  DigitalReadOut Parameters ##################################
 
@@ -300,6 +345,19 @@ class Config:
             "Alignment", "PostRotationAngle", fallback=0.0
         )
 
+        search_window = config.getint("Alignment", "SearchWindow", fallback=50)
+        min_confidence = config.getfloat("Alignment", "MinConfidence", fallback=0.8)
+        alignment_mode = config.get("Alignment", "Mode", fallback="full").lower()
+        pyramid_levels = config.getint("Alignment", "PyramidLevels", fallback=2)
+        reuse_transform = config.getboolean(
+            "Alignment", "ReuseTransform", fallback=False
+        )
+        max_transform_age = config.getint("Alignment", "MaxTransformAge", fallback=10)
+        phase_min_response = config.getfloat(
+            "Alignment", "PhaseMinResponse", fallback=0.3
+        )
+        phase_rotation = config.getboolean("Alignment", "PhaseRotation", fallback=False)
+
         refs = config.get("Alignment", "Refs", fallback="")
         ref_images = []
         for name in [x.strip() for x in refs.split(",")]:
@@ -313,6 +371,14 @@ class Config:
             rotate_angle=rotate_angle,
             ref_images=ref_images,
             post_rotate_angle=post_rotate_angle,
+            search_window=search_window,
+            min_confidence=min_confidence,
+            mode=alignment_mode,
+            pyramid_levels=pyramid_levels,
+            reuse_transform=reuse_transform,
+            max_transform_age=max_transform_age,
+            phase_min_response=phase_min_response,
+            phase_rotation=phase_rotation,
         )
 
         ################## Crop Parameters #############################################
@@ -382,6 +448,9 @@ class Config:
             image_processing_autocontrast_cut_images_ignore = config.getint(
                 "ImageProcessing", "AutoContrastCutImagesIgnore", fallback=0
             )
+        image_processing_cut_images_area_only = config.getboolean(
+            "ImageProcessing", "CutImagesAreaOnly", fallback=False
+        )
 
         self.image_processing = ImageProcessing(
             enabled=image_processing_enabled,
@@ -402,6 +471,7 @@ class Config:
                 cutoff_high=image_processing_autocontrast_cut_images_cutoff_high,
                 ignore=image_processing_autocontrast_cut_images_ignore,
             ),
+            cut_images_area_only=image_processing_cut_images_area_only,
         )
 
         ################## Meter Parameters ############################################
@@ -449,6 +519,17 @@ class Config:
         readout_enabled = config.getboolean(section, "Enabled", fallback=False)
         model_file = config.get(section, "Modelfile", fallback="")
         model = config.get(section, "Model", fallback="auto").lower()
+        interpreter_pool_size = config.getint(
+            section, "InterpreterPoolSize", fallback=1
+        )
+        num_threads = config.getint(section, "NumThreads", fallback=0)
+        use_xnnpack = config.getboolean(section, "UseXnnpack", fallback=True)
+        zero_copy = config.getboolean(section, "ZeroCopy", fallback=True)
+        cache_size = config.getint(section, "CacheSize", fallback=64)
+        change_threshold = config.getfloat(section, "ChangeThreshold", fallback=0.0)
+        full_readout_interval = config.getint(
+            section, "FullReadoutInterval", fallback=10
+        )
         images = []
         if readout_enabled:
             names = config.get(section, "names", fallback="")
@@ -468,5 +549,12 @@ class Config:
             enabled=readout_enabled,
             model_file=model_file,
             model=model,
+            interpreter_pool_size=interpreter_pool_size,
+            num_threads=num_threads,
+            use_xnnpack=use_xnnpack,
+            zero_copy=zero_copy,
+            cache_size=cache_size,
+            change_threshold=change_threshold,
+            full_readout_interval=full_readout_interval,
             cut_images=images,
         )
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from PIL.Image import Image
+import numpy as np
 
 
 @dataclass
@@ -33,4 +33,4 @@ class MeterConfig:
 @dataclass
 class CutImage:
     name: str
-    image: Image
+    image: np.ndarray
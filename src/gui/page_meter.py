@@ -30,7 +30,7 @@ class MeterPage:
             self.spinner.visible = False
 
         async def fecth_data() -> None:
-            result = self.callbacks.get_meter_data(saveimages=True)
+            result, reading_id = self.callbacks.get_meter_data(saveimages=True)
             text_size = "text-xs"
             with value_container:
                 with ui.grid(columns=2):
@@ -41,8 +41,7 @@ class MeterPage:
                         ui.label(f"{meter.value} {meter.unit}").classes(text_size)
                 ui.separator()
                 with ui.row().classes("w-full"):
-                    base64img = self.callbacks.get_image_as_base64_str("final")
-                    ui.image(f"data:image/jpeg;base64,{base64img}").classes(
+                    ui.image(self.callbacks.get_image_url(reading_id, "final")).classes(
                         "max-w-screen-sm"
                     )
 
@@ -51,19 +50,17 @@ class MeterPage:
                         for image, value in result.digital_results.items():
                             with ui.card():
                                 ui.label(f"{image}").classes(text_size)
-                                base64img = self.callbacks.get_image_as_base64_str(
-                                    image
+                                ui.image(
+                                    self.callbacks.get_image_url(reading_id, image)
                                 )
-                                ui.image(f"data:image/jpeg;base64,{base64img}")
                                 with ui.card_section():
                                     ui.label(f"{value}").classes(text_size)
                         for image, value in result.analog_results.items():
                             with ui.card():
                                 ui.label(f"{image}").classes(text_size)
-                                base64img = self.callbacks.get_image_as_base64_str(
-                                    image
+                                ui.image(
+                                    self.callbacks.get_image_url(reading_id, image)
                                 )
-                                ui.image(f"data:image/jpeg;base64,{base64img}")
                                 with ui.card_section():
                                     ui.label(f"{value}").classes(text_size)
 
@@ -99,9 +99,7 @@ class SetupPage:
             if base64_str is None or base64_str == "":
                 return
             self.image = base64_str
-            w, h = ImageUtils.image_size(
-                ImageUtils.convert_base64_str_to_image(base64_str)
-            )
+            w, h = ImageUtils.image_size_from_base64_str(base64_str)
             self.image_details.text = f"Size: {w}x{h}"
             self.interactive_image.set_source(f"data:image/png;base64,{base64_str}")
             self.interactive_image.update()
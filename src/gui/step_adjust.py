@@ -1,9 +1,14 @@
-from typing import Callable
+import asyncio
+from typing import Callable, List
 
 from nicegui import ui
 
-from processor.image import ImageProcessor
-from .step_base import BaseStep
+import processor.pipeline as pipeline
+import utils.image
+from .step_base import BaseStep, LatestJob
+
+# maximum size (width, height) of the image shown while values are changed
+PREVIEW_SIZE = (640, 480)
 
 
 class AdjustStep(BaseStep):
@@ -20,10 +25,17 @@ class AdjustStep(BaseStep):
         )
         self.rotate_angle: ui.number
         self.org_image: str = ""
+        self.preview_stages: List[pipeline.PipelineStage] = []
+        self.preview_scale = 1.0
+        self.preview_job = LatestJob()
 
     def update_image(self, image: str) -> None:
         self.org_image = image
         self.image = self._do_adjust(image)
+        size = utils.image.image_size_from_base64_str(image)
+        self.preview_stages, self.preview_scale = pipeline.preview_stages(
+            size, PREVIEW_SIZE
+        )
 
     def _reset_image(self) -> None:
         if self.org_image != "":
@@ -35,103 +47,197 @@ class AdjustStep(BaseStep):
     @BaseStep.decorator_catch_err
     async def do_adjust(self) -> None:
         self._reset_image()
-        self.image = self._do_adjust(self.image)
+        image = self.image
+        self.image = await asyncio.to_thread(self._do_adjust, image)
         if self.set_image_callback is not None:
             self.set_image_callback(self.image)
 
+    @BaseStep.decorator_catch_err
+    async def _preview(self) -> None:
+        # interactive changes are shown on a downscaled proxy of the image
+        if self.org_image == "":
+            return
+        stages = (
+            self.preview_stages
+            + self._adjust_stages(self.preview_scale)
+            + [pipeline.encode_base64_stage()]
+        )
+        image = await self.preview_job.run(
+            lambda: pipeline.stage_cache.run(stages, self.org_image)
+        )
+        if image is not None and self.set_image_callback is not None:
+            self.set_image_callback(image)
+
     def _do_adjust(self, image: str) -> str:
-        return (
-            ImageProcessor()
-            .set_image_from_base64_str(image)
-            .if_(self.rotate_enabled.value)
-            .rotate_image(self.rotate_angle.value)
-            .endif_()
-            .if_(self.crop_enabled.value)
-            .crop_image(
-                x=self.crop_x.value,
-                y=self.crop_y.value,
-                w=self.crop_w.value,
-                h=self.crop_h.value,
+        # unchanged stages are taken from the stage cache
+        stages = (
+            [pipeline.decode_base64_stage()]
+            + self._adjust_stages()
+            + [pipeline.encode_base64_stage()]
+        )
+        return pipeline.stage_cache.run(stages, image)
+
+    def _adjust_stages(self, scale: float = 1.0) -> List[pipeline.PipelineStage]:
+        # positions and sizes are scaled for the proxy
+        stages = []
+        if self.rotate_enabled.value:
+            stages.append(pipeline.rotate_stage(self.rotate_angle.value))
+        if self.crop_enabled.value:
+            stages.append(
+                pipeline.crop_stage(
+                    x=round(self.crop_x.value * scale),
+                    y=round(self.crop_y.value * scale),
+                    w=round(self.crop_w.value * scale),
+                    h=round(self.crop_h.value * scale),
+                )
             )
-            .endif_()
-            .if_(self.resize_enabled.value)
-            .resize_image(
-                width=int(self.resize_w.value),
-                height=int(self.resize_h.value),
+        if self.resize_enabled.value:
+            stages.append(
+                pipeline.resize_stage(
+                    width=max(1, round(int(self.resize_w.value) * scale)),
+                    height=max(1, round(int(self.resize_h.value) * scale)),
+                )
             )
-            .endif_()
-            .if_(self.adjust_enabled.value)
-            .adjust_image(
-                contrast=self.adjust_contrast.value,
-                brightness=self.adjust_brightness.value,
-                sharpness=self.adjust_sharpness.value,
-                color=self.adjust_color.value,
+        if self.adjust_enabled.value:
+            stages.append(
+                pipeline.adjust_stage(
+                    contrast=self.adjust_contrast.value,
+                    brightness=self.adjust_brightness.value,
+                    sharpness=self.adjust_sharpness.value,
+                    color=self.adjust_color.value,
+                )
             )
-            .endif_()
-            .if_(self.grayscale_enabled.value)
-            .to_gray_scale()
-            .endif_()
-            .if_(self.autocontrast_enabled.value)
-            .autocontrast_image(
-                cutoff_low=self.autocontrast_cutoff_low.value,
-                cutoff_high=self.autocontrast_cutoff_high.value,
+        if self.grayscale_enabled.value:
+            stages.append(pipeline.gray_stage())
+        if self.autocontrast_enabled.value:
+            stages.append(
+                pipeline.autocontrast_stage(
+                    cutoff_low=self.autocontrast_cutoff_low.value,
+                    cutoff_high=self.autocontrast_cutoff_high.value,
+                )
             )
-            .endif_()
-            .get_image_as_base64_str()
-        )
+        return stages
 
     async def show(self, stepper, first_step=False, last_step=False) -> None:
         with ui.step(self.name):
 
             with ui.row().classes("w-full items-center"):
-                self.rotate_enabled = ui.checkbox("Enable Rotate", value=False)
+                self.rotate_enabled = ui.checkbox(
+                    "Enable Rotate", value=False, on_change=self._preview
+                )
                 self.rotate_angle = ui.number(
-                    "Angle", min=-359, max=359, step=1, value=0
+                    "Angle", min=-359, max=359, step=1, value=0, on_change=self._preview
                 )
 
             with ui.row().classes("w-full items-center"):
-                self.crop_enabled = ui.checkbox("Enable Crop", value=False)
-                self.crop_x = ui.number("X", min=-0, max=10000, step=1, value=0)
-                self.crop_y = ui.number("Y", min=-0, max=10000, step=1, value=0)
-                self.crop_w = ui.number("Width", min=-640, max=10000, step=1, value=0)
-                self.crop_h = ui.number("Height", min=-480, max=10000, step=1, value=0)
+                self.crop_enabled = ui.checkbox(
+                    "Enable Crop", value=False, on_change=self._preview
+                )
+                self.crop_x = ui.number(
+                    "X", min=-0, max=10000, step=1, value=0, on_change=self._preview
+                )
+                self.crop_y = ui.number(
+                    "Y", min=-0, max=10000, step=1, value=0, on_change=self._preview
+                )
+                self.crop_w = ui.number(
+                    "Width",
+                    min=-640,
+                    max=10000,
+                    step=1,
+                    value=0,
+                    on_change=self._preview,
+                )
+                self.crop_h = ui.number(
+                    "Height",
+                    min=-480,
+                    max=10000,
+                    step=1,
+                    value=0,
+                    on_change=self._preview,
+                )
 
             with ui.row().classes("w-full items-center"):
-                self.adjust_enabled = ui.checkbox("Enable Adjust", value=False)
+                self.adjust_enabled = ui.checkbox(
+                    "Enable Adjust", value=False, on_change=self._preview
+                )
                 self.adjust_contrast = ui.number(
-                    "Contrast", min=-0, max=10, step=0.1, value=1.0
+                    "Contrast",
+                    min=-0,
+                    max=10,
+                    step=0.1,
+                    value=1.0,
+                    on_change=self._preview,
                 )
                 self.adjust_brightness = ui.number(
-                    "Brightness", min=-0, max=10, step=0.1, value=1.0
+                    "Brightness",
+                    min=-0,
+                    max=10,
+                    step=0.1,
+                    value=1.0,
+                    on_change=self._preview,
                 )
                 self.adjust_sharpness = ui.number(
-                    "Sharpness", min=-0, max=10, step=0.1, value=1.0
+                    "Sharpness",
+                    min=-0,
+                    max=10,
+                    step=0.1,
+                    value=1.0,
+                    on_change=self._preview,
                 )
                 self.adjust_color = ui.number(
-                    "Color", min=-0, max=10, step=0.1, value=1.0
+                    "Color",
+                    min=-0,
+                    max=10,
+                    step=0.1,
+                    value=1.0,
+                    on_change=self._preview,
                 )
 
             with ui.row().classes("w-full items-center"):
-                self.resize_enabled = ui.checkbox("Enable Resize", value=False)
-                self.resize_w = ui.number("Width", min=-640, max=10000, step=1, value=0)
+                self.resize_enabled = ui.checkbox(
+                    "Enable Resize", value=False, on_change=self._preview
+                )
+                self.resize_w = ui.number(
+                    "Width",
+                    min=-640,
+                    max=10000,
+                    step=1,
+                    value=0,
+                    on_change=self._preview,
+                )
                 self.resize_h = ui.number(
-                    "Height", min=-480, max=10000, step=1, value=0
+                    "Height",
+                    min=-480,
+                    max=10000,
+                    step=1,
+                    value=0,
+                    on_change=self._preview,
                 )
 
             with ui.row().classes("w-full items-center"):
                 self.grayscale_enabled = ui.checkbox(
-                    "Enable Grayscale image", value=False
+                    "Enable Grayscale image", value=False, on_change=self._preview
                 )
 
             with ui.row().classes("w-full items-center"):
                 self.autocontrast_enabled = ui.checkbox(
-                    "Enable Autocontrast", value=False
+                    "Enable Autocontrast", value=False, on_change=self._preview
                 )
                 self.autocontrast_cutoff_low = ui.number(
-                    "Cutoff low", min=0, max=100, step=1, value=2
+                    "Cutoff low",
+                    min=0,
+                    max=100,
+                    step=1,
+                    value=2,
+                    on_change=self._preview,
                 )
                 self.autocontrast_cutoff_high = ui.number(
-                    "Cutoff high", min=0, max=100, step=1, value=45
+                    "Cutoff high",
+                    min=0,
+                    max=100,
+                    step=1,
+                    value=45,
+                    on_change=self._preview,
                 )
 
             with ui.row().classes("w-full items-center"):
@@ -1,7 +1,41 @@
-from typing import Callable
+import asyncio
+from typing import Callable, Optional, TypeVar
 
 from nicegui import ui
 
+T = TypeVar("T")
+
+
+class LatestJob:
+    """
+    Run only the latest of quickly repeated jobs, e.g. the previews of the
+    setup wizard while a value is changed. A job waits for the delay and is
+    dropped when a newer job is started meanwhile. Jobs run one after the
+    other in a thread, the result of a job which is superseded while it runs
+    is dropped as well.
+    """
+
+    def __init__(self, delay: float = 0.2) -> None:
+        self.delay = delay
+        self._generation = 0
+        # created in run(), a lock created outside of the running event loop
+        # is bound to another loop on python < 3.10
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def run(self, func: Callable[[], T]) -> Optional[T]:
+        self._generation += 1
+        generation = self._generation
+        await asyncio.sleep(self.delay)
+        if generation != self._generation:
+            return None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if generation != self._generation:
+                return None
+            result = await asyncio.to_thread(func)
+        return result if generation == self._generation else None
+
 
 class BaseStep:
     def __init__(
@@ -8,6 +8,7 @@ from data_classes import CutImage, ImagePosition
 from .step_base import BaseStep
 import utils.image
 from processor.image import ImageProcessor
+import processor.pipeline as pipeline
 
 
 @dataclass
@@ -206,7 +207,9 @@ class DrawRoisBaseStep(BaseStep):
         ]
         return (
             ImageProcessor()
-            .set_image_from_base64_str(self.image)
+            .set_image(
+                pipeline.stage_cache.run([pipeline.decode_base64_stage()], self.image)
+            )
             .start_image_cutting()
             .cut_images(
                 postions,
@@ -2,7 +2,7 @@ from typing import Callable
 
 from nicegui import ui
 
-from processor.image import ImageProcessor
+import processor.pipeline as pipeline
 from .step_base import BaseStep
 
 
@@ -42,11 +42,13 @@ class InitialRotateStep(BaseStep):
             self.set_image_callback(self.image)
 
     def _rotate_image(self, image: str, angle: float) -> str:
-        return (
-            ImageProcessor()
-            .set_image_from_base64_str(image)
-            .rotate_image(angle)
-            .get_image_as_base64_str()
+        return pipeline.stage_cache.run(
+            [
+                pipeline.decode_base64_stage(),
+                pipeline.rotate_stage(angle),
+                pipeline.encode_base64_stage(),
+            ],
+            image,
         )
 
     @BaseStep.decorator_spinner
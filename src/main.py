@@ -5,8 +5,9 @@ import signal
 import os
 import logging
 import sys
+from typing import Optional, Tuple
 
-from fastapi import FastAPI, HTTPException, Response, Request
+from fastapi import FastAPI, HTTPException, Query, Response, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -15,13 +16,20 @@ import uvicorn
 
 from decorators.decorators import log_execution_time
 from configuration import Config
+from cnn.registry import get_interpreter_options, model_registry
 from utils.download import DownloadFailure
 import utils.image
+from utils.benchmark import (
+    run_alignment_benchmark,
+    run_benchmark,
+    run_model_benchmark,
+)
+from processor.change_detector import ChangeDetector
 from processor.digitizer import DigitizerProcessor, MeterResult
 from processor.image import ImageProcessor
+from processor.image_store import ImageStore
+from processor.pipeline import PipelinePlan, compile_pipeline
 import previous_value as previous_value
-from PIL.Image import Image
-
 
 VERSION = "8.0.0"
 
@@ -29,9 +37,13 @@ COLOR_RED = (255, 0, 0)
 COLOR_GREEN = (0, 255, 0)
 COLOR_BLUE = (0, 0, 255)
 
+IMAGE_EXTENSIONS = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".webp": "webp"}
+
 config_file = os.environ.get("CONFIG_FILE", "/config/config.ini")
 config = Config()
-images: dict[str, Image] = {}
+image_store = ImageStore()
+change_detectors: dict[str, ChangeDetector] = {}
+pipeline_plans: dict[bool, PipelinePlan] = {}
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -62,14 +74,81 @@ def healthcheck():
 
 @app.get("/image_tmp/{image}")
 @log_execution_time
-def get_image(image: str) -> Response:
-    image = image.replace(".jpg", "")
+def get_image(
+    request: Request,
+    image: str,
+    format: str = "",
+    quality: Optional[int] = Query(None, ge=1, le=100),
+    w: int = Query(0, ge=0),
+) -> Response:
     logger.debug(f"Getting image: {image}")
-    img = images.get(image)
-    if img is None:
+    # the image changes with every reading, the browser has to revalidate it
+    return image_response(request, image, "", format, quality, w, "no-cache")
+
+
+@app.get("/images/{reading_id}/{image}")
+@log_execution_time
+def get_reading_image(
+    request: Request,
+    reading_id: str,
+    image: str,
+    format: str = "",
+    quality: Optional[int] = Query(None, ge=1, le=100),
+    w: int = Query(0, ge=0),
+) -> Response:
+    # the image of a reading never changes, so browsers can keep it
+    cache_control = "public, max-age=31536000, immutable"
+    return image_response(request, image, reading_id, format, quality, w, cache_control)
+
+
+def image_response(
+    request: Request,
+    image: str,
+    reading_id: str,
+    format: str,
+    quality: Optional[int],
+    width: int,
+    cache_control: str,
+) -> Response:
+    """
+    Response with an image of the image store. The format is taken from the
+    format parameter or the file extension of the image name, format "auto"
+    selects the first format of the Accept header. Otherwise the original
+    image is returned as downloaded and the other images as JPEG.
+    """
+    name, extension = os.path.splitext(image)
+    headers = {"Cache-Control": cache_control}
+    if not format:
+        format = IMAGE_EXTENSIONS.get(extension.lower(), "")
+    if format == "auto":
+        format = negotiate_image_format(request.headers.get("accept", ""))
+        headers["Vary"] = "Accept"
+    if format and format not in utils.image.IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format {format}")
+
+    encoded = image_store.get_encoded(name, reading_id, format or None, quality, width)
+    if encoded is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    image_bytes = utils.image.convert_image_to_bytes(img)
-    return Response(content=image_bytes, media_type="image/jpg")
+    headers["ETag"] = encoded.etag
+    if etag_matches(request.headers.get("if-none-match", ""), encoded.etag):
+        return Response(status_code=304, headers=headers)
+    media_type = utils.image.IMAGE_FORMATS[encoded.format]
+    if encoded.format == "jpeg" and not reading_id:
+        # media type of the first versions of /image_tmp
+        media_type = "image/jpg"
+    return Response(content=encoded.data, media_type=media_type, headers=headers)
+
+
+def negotiate_image_format(accept: str) -> str:
+    # first supported format the client lists, quality values are ignored
+    media_types = [part.split(";")[0].strip() for part in accept.split(",")]
+    formats = {v: k for k, v in utils.image.IMAGE_FORMATS.items()}
+    return next((formats[t] for t in media_types if t in formats), "")
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
 
 
 @app.get("/version")
@@ -78,6 +157,20 @@ def get_version() -> Response:
     return Response(json.dumps({"version": VERSION}), media_type="application/json")
 
 
+@app.get("/models")
+@log_execution_time
+def get_models() -> Response:
+    stats = [dataclasses.asdict(item) for item in model_registry.get_stats()]
+    return Response(json.dumps(stats), media_type="application/json")
+
+
+@app.get("/pipeline")
+@log_execution_time
+def get_pipeline(saveimages: bool = False) -> Response:
+    plan = pipeline_plans[saveimages].describe()
+    return Response(json.dumps(plan), media_type="application/json")
+
+
 @app.get("/exit", response_class=HTMLResponse)
 @log_execution_time
 def do_exit():
@@ -116,7 +209,15 @@ def get_roi(
             ImageProcessor()
             .download_image(url, timeout, config.image_source.min_size)
             .rotate_image(config.alignment.rotate_angle)
-            .align_image(config.alignment.ref_images)
+            .align_image(
+                config.alignment.ref_images,
+                config.alignment.search_window,
+                config.alignment.min_confidence,
+                config.alignment.mode,
+                config.alignment.pyramid_levels,
+                phase_min_response=config.alignment.phase_min_response,
+                phase_rotation=config.alignment.phase_rotation,
+            )
             .if_(draw_refs)
             .draw_roi(config.alignment.ref_images, COLOR_GREEN)
             .endif_()
@@ -164,7 +265,7 @@ def get_meters(
         return Response("Invalid format. Use 'html' or 'json'", media_type="text/html")
 
     try:
-        result = get_meter_data(url, saveimages)
+        result, reading_id = get_meter_data(url, saveimages)
     except Exception as e:
         logger.warning(f"Error occured: {str(e)}")
         if format != "html":
@@ -183,110 +284,102 @@ def get_meters(
         context={
             "request": request,
             "result": result,
+            "reading_id": reading_id,
+            # the cut images are only saved with saveimages
+            "images": image_store.names(reading_id),
         },
         media_type="text/html",
     )
 
 
+def process_image(url: str = "", saveimages: bool = False) -> ImageProcessor:
+    image, pictures = pipeline_plans[saveimages].run(url or config.image_source.url)
+    return ImageProcessor().set_processed_image(image, pictures)
+
+
 @log_execution_time
-def get_meter_data(url: str = "", saveimages: bool = False) -> MeterResult:
-    url = url or config.image_source.url
-    timeout = config.image_source.timeout
-
-    imageProcessor = ImageProcessor()
-    (
-        imageProcessor.enable_image_saving(saveimages)
-        .download_image(url, timeout, config.image_source.min_size)
-        .save_image("original")
-        .rotate_image(config.alignment.rotate_angle)
-        .save_image("rotated")
-        .align_image(config.alignment.ref_images)
-        .save_image("aligned")
-        .rotate_image(config.alignment.post_rotate_angle)
-        .save_image("post_rotated")
-        .if_(config.crop.enabled)
-        .crop_image(config.crop.x, config.crop.y, config.crop.w, config.crop.h)
-        .save_image("cropped")
-        .endif_()
-        .if_(config.resize.enabled)
-        .resize_image(config.resize.w, config.resize.h)
-        .save_image("resized")
-        .endif_()
-        .if_(config.image_processing.enabled and config.image_processing.grayscale)
-        .to_gray_scale()
-        .save_image("gray")
-        .endif_()
-        .if_(config.image_processing.enabled)
-        .adjust_image(
-            brightness=config.image_processing.brightness,
-            contrast=config.image_processing.contrast,
-            sharpness=config.image_processing.sharpness,
-            color=config.image_processing.color,
-        )
-        .if_(config.image_processing.enabled and config.image_processing.autocontrast)
-        .autocontrast_image(
-            cutoff_low=config.image_processing.autocontrast.cutoff_low,
-            cutoff_high=config.image_processing.autocontrast.cutoff_high,
-            ignore=config.image_processing.autocontrast.ignore,
-        )
-        .save_image("processed")
-        .endif_()
-        .save_image("final", True)
-    )
+def get_meter_data(url: str = "", saveimages: bool = False) -> Tuple[MeterResult, str]:
+    # returns the result and the id of the images of the reading in the image
+    # store, the final image is stored also if the other images are not saved
+    imageProcessor = process_image(url, saveimages)
     autocontrast = (
         config.image_processing.enabled
         and config.image_processing.autocontrast_cut_images.enabled
     )
-    digital_images = (
-        imageProcessor.start_image_cutting()
-        .cut_images(
+    cut_params = config.image_processing.autocontrast_cut_images
+    if saveimages:
+        for positions in [
             config.digital_readout.cut_images,
-            autocontrast=autocontrast,
-            cutoff_low=config.image_processing.autocontrast_cut_images.cutoff_low,
-            cutoff_high=config.image_processing.autocontrast_cut_images.cutoff_high,
-            ignore=config.image_processing.autocontrast_cut_images.ignore,
-        )
-        .stop_image_cutting()
-        .save_cutted_images()
-        .get_cutted_images()
-    )
-    analog_images = (
-        imageProcessor.start_image_cutting()
-        .cut_images(
             config.analog_readout.cut_images,
-            autocontrast=autocontrast,
-            cutoff_low=config.image_processing.autocontrast_cut_images.cutoff_low,
-            cutoff_high=config.image_processing.autocontrast_cut_images.cutoff_high,
-            ignore=config.image_processing.autocontrast_cut_images.ignore,
-        )
-        .stop_image_cutting()
-        .save_cutted_images()
-        .get_cutted_images()
+        ]:
+            (
+                imageProcessor.start_image_cutting()
+                .cut_images(
+                    positions,
+                    autocontrast=autocontrast,
+                    cutoff_low=cut_params.cutoff_low,
+                    cutoff_high=cut_params.cutoff_high,
+                    ignore=cut_params.ignore,
+                )
+                .stop_image_cutting()
+                .save_cutted_images()
+            )
+    reading_id = image_store.put(imageProcessor.get_pictures())
+    image = imageProcessor.get_image_for_cutting()
+    # the change detectors keep no values of another camera or alignment
+    source = (
+        url or config.image_source.url,
+        utils.image.image_size(image),
+        utils.image.reference_images_key(config.alignment.ref_images),
     )
-    global images
-    images = imageProcessor.get_pictures()
 
-    return (
+    result = (
         DigitizerProcessor()
         .init_analog_model(
-            config.analog_readout.model_file, config.analog_readout.model
+            config.analog_readout.model_file,
+            config.analog_readout.model,
+            config.analog_readout.interpreter_pool_size,
+            get_interpreter_options(config.analog_readout),
+            config.analog_readout.zero_copy,
+            config.analog_readout.cache_size,
         )
         .init_digital_model(
-            config.digital_readout.model_file, config.digital_readout.model
+            config.digital_readout.model_file,
+            config.digital_readout.model,
+            config.digital_readout.interpreter_pool_size,
+            get_interpreter_options(config.digital_readout),
+            config.digital_readout.zero_copy,
+            config.digital_readout.cache_size,
         )
         .use_previous_value_file(config.prevoius_value_file)
-        .execute_analog_ccn(analog_images)
-        .execute_digital_ccn(digital_images)
+        .execute_analog_ccn_on_image(
+            image,
+            config.analog_readout.cut_images,
+            autocontrast=autocontrast,
+            cutoff_low=cut_params.cutoff_low,
+            cutoff_high=cut_params.cutoff_high,
+            ignore=cut_params.ignore,
+            change_detector=change_detectors.get("analog"),
+            source=source,
+        )
+        .execute_digital_ccn_on_image(
+            image,
+            config.digital_readout.cut_images,
+            autocontrast=autocontrast,
+            cutoff_low=cut_params.cutoff_low,
+            cutoff_high=cut_params.cutoff_high,
+            ignore=cut_params.ignore,
+            change_detector=change_detectors.get("digital"),
+            source=source,
+        )
         .evaluate_ccn_results()
         .get_meter_values(config.meter_configs)
     )
+    return result, reading_id
 
 
-def get_image_as_base64_str(image_name: str) -> str:
-    img = images.get(image_name)
-    if img is None:
-        raise HTTPException(status_code=404, detail="Image not found")
-    return utils.image.convert_image_base64str(img)
+def get_image_url(reading_id: str, image_name: str) -> str:
+    return f"/images/{reading_id}/{image_name}.jpg"
 
 
 def load_config_file() -> str:
@@ -306,11 +399,11 @@ def init_gui(app) -> None:
     class CallbacksImpl(Callbacks):
         def get_meter_data(
             self, url: str = "", saveimages: bool = False
-        ) -> MeterResult:
+        ) -> Tuple[MeterResult, str]:
             return get_meter_data(url=url, saveimages=saveimages)
 
-        def get_image_as_base64_str(self, image_name: str) -> str:
-            return get_image_as_base64_str(image_name)
+        def get_image_url(self, reading_id: str, image_name: str) -> str:
+            return get_image_url(reading_id, image_name)
 
         def get_config(self) -> Config:
             return config
@@ -332,6 +425,23 @@ def init_config() -> None:
     global config
     config = Config().load_from_file(ini_file=config_file)
     logger.setLevel(config.log_level)
+    model_registry.retain(
+        [config.digital_readout.model_file, config.analog_readout.model_file]
+    )
+    utils.image.template_cache.clear()
+    utils.image.transform_cache.clear()
+    utils.image.phase_reference.clear()
+    change_detectors.clear()
+    for name, params in [
+        ("digital", config.digital_readout),
+        ("analog", config.analog_readout),
+    ]:
+        if params.change_threshold > 0:
+            change_detectors[name] = ChangeDetector(
+                params.change_threshold, params.full_readout_interval
+            )
+    for saveimages in [False, True]:
+        pipeline_plans[saveimages] = compile_pipeline(config, saveimages)
 
     logging.getLogger("CNN.CNNBase").setLevel(logger.level)
     logging.getLogger("CNN.AnalogNeedleCNN").setLevel(logger.level)
@@ -359,10 +469,50 @@ if __name__ == "__main__":
         help="Configuration file",
         default=config_file,
     )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        dest="benchmark",
+        action="store_true",
+        help="Measure model latency for each interpreter setting and exit",
+    )
+    parser.add_argument(
+        "-m",
+        "--benchmark-models",
+        dest="benchmark_models",
+        action="store_true",
+        help="Compare all models in the model directories and exit",
+    )
+    parser.add_argument(
+        "-a",
+        "--benchmark-alignment",
+        dest="benchmark_alignment",
+        action="store_true",
+        help="Compare the alignment modes and exit",
+    )
+    parser.add_argument(
+        "--frames",
+        dest="frames_dir",
+        type=str,
+        help="Directory of images used by --benchmark-models and "
+        "--benchmark-alignment instead of the configured image source",
+        default="",
+    )
 
     args = parser.parse_args()
     config_file = args.config_file
     init_config()
+    if args.benchmark:
+        print(json.dumps(run_benchmark(config, process_image), indent=4))
+        sys.exit(0)
+    if args.benchmark_models:
+        results = run_model_benchmark(config, process_image, args.frames_dir)
+        print(json.dumps([dataclasses.asdict(r) for r in results], indent=4))
+        sys.exit(0)
+    if args.benchmark_alignment:
+        results = run_alignment_benchmark(config, args.frames_dir)
+        print(json.dumps([dataclasses.asdict(r) for r in results], indent=4))
+        sys.exit(0)
     init_gui(app)
 
     port = 3000
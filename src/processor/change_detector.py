@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Any, Dict, Hashable, List, Tuple, Union
+
+import numpy as np
+
+from data_classes import ImagePosition
+import utils.image
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _RoiState:
+    geometry: Tuple[int, int, int, int]
+    fingerprint: np.ndarray
+    value: Any
+
+
+@dataclass
+class ChangeStats:
+    frames: int = 0
+    readouts: int = 0
+    skipped: int = 0
+
+
+class ChangeDetector:
+    """
+    Detect which cut images have changed since they were read out last time.
+
+    A small downsampled fingerprint is stored for every cut image when it is
+    read out. Cut images whose fingerprint differs less than the threshold
+    (mean absolute difference of the pixel values 0-255) keep their previous
+    value, so sensor noise does not cause a readout. Every full_readout_interval
+    frames all cut images are read out again. The previous values are dropped
+    when the model or the source of the images changes.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        full_readout_interval: int = 10,
+        fingerprint_size: int = 8,
+    ) -> None:
+        self.threshold = threshold
+        self.full_readout_interval = full_readout_interval
+        self.fingerprint_size = fingerprint_size
+        self.stats = ChangeStats()
+        self._lock = threading.Lock()
+        self._states: Dict[str, _RoiState] = {}
+        self._model: Any = None
+        self._source: Hashable = None
+        self._frames_since_full_readout = 0
+
+    def changed_positions(
+        self,
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        positions: List[ImagePosition],
+        model: Any = None,
+        source: Hashable = None,
+    ) -> Tuple[List[bool], np.ndarray]:
+        """
+        Find the cut images which need to be read out.
+
+        Args:
+            image (np.ndarray | WarpedImage): Image to cut.
+            positions (List[ImagePosition]): Positions of the cut images.
+            model (Any, optional): Model which reads out the images, previous
+            values are dropped when the model changes.
+            source (Hashable, optional): Identity of the image source, e.g. the
+            url and the alignment, previous values are dropped when it changes.
+
+        Returns:
+            Tuple[List[bool], np.ndarray]: Flag for every position whether it
+            has to be read out and the fingerprints of the cut images, which
+            are passed to update after the readout.
+        """
+        fingerprints = self._fingerprints(image, positions)
+        with self._lock:
+            if model is not self._model or source != self._source:
+                self._states.clear()
+                self._model = model
+                self._source = source
+            self.stats.frames += 1
+            self._frames_since_full_readout += 1
+            if self._frames_since_full_readout >= self.full_readout_interval:
+                self._frames_since_full_readout = 0
+                return [True] * len(positions), fingerprints
+
+            changed = []
+            for pos, fingerprint in zip(positions, fingerprints):
+                state = self._states.get(pos.name)
+                changed.append(
+                    state is None
+                    or state.geometry != (pos.x, pos.y, pos.w, pos.h)
+                    or np.mean(np.abs(fingerprint - state.fingerprint)) > self.threshold
+                )
+            return changed, fingerprints
+
+    def update(
+        self,
+        positions: List[ImagePosition],
+        changed: List[bool],
+        fingerprints: np.ndarray,
+        values: List[Any],
+    ) -> List[Any]:
+        """
+        Store the values of the read out cut images.
+
+        Args:
+            positions (List[ImagePosition]): Positions of all cut images.
+            changed (List[bool]): Flags returned by changed_positions.
+            fingerprints (np.ndarray): Fingerprints returned by
+            changed_positions.
+            values (List[Any]): Values of the changed cut images.
+
+        Returns:
+            List[Any]: Values of all cut images, previous values are used for
+            the unchanged cut images.
+        """
+        with self._lock:
+            new_values = iter(values)
+            for pos, is_changed, fingerprint in zip(positions, changed, fingerprints):
+                if is_changed:
+                    self._states[pos.name] = _RoiState(
+                        geometry=(pos.x, pos.y, pos.w, pos.h),
+                        fingerprint=fingerprint,
+                        value=next(new_values),
+                    )
+            self.stats.readouts += sum(changed)
+            self.stats.skipped += len(changed) - sum(changed)
+            return [self._states[pos.name].value for pos in positions]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._states.clear()
+            self._model = None
+            self._source = None
+            self._frames_since_full_readout = 0
+
+    def _fingerprints(
+        self,
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        positions: List[ImagePosition],
+    ) -> np.ndarray:
+        # sample 4x4 pixels for every fingerprint pixel and average them
+        size = self.fingerprint_size
+        pixels = utils.image.cut_images_to_array(image, positions, size * 4, size * 4)
+        pixels = pixels.reshape(len(positions), size, 4, size, 4, 3)
+        return pixels.mean(axis=(2, 4), dtype=np.float32)
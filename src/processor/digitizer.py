@@ -1,9 +1,10 @@
 from dataclasses import dataclass
-from typing import List, Union
+from typing import Hashable, List, Optional, Union
 import re
 import math
 import logging
 
+import numpy as np
 
 from previous_value import (
     load_previous_value_from_file,
@@ -14,14 +15,20 @@ from utils.math import (
     fill_with_predecessor_digits,
 )
 from cnn.base import ModelDetails
+from cnn.registry import InterpreterOptions
 from cnn.digital_counter_cnn import DigitalCounterCNN
 from cnn.analog_needle_cnn import AnalogNeedleCNN
-from data_classes import MeterConfig, CutImage
+from data_classes import ImagePosition, MeterConfig, CutImage
+from processor.change_detector import ChangeDetector
 from decorators.decorators import log_execution_time
-
+import utils.image
 
 logger = logging.getLogger(__name__)
 
+# size (width, height) the cut images are resized to for the models
+ANALOG_IMAGE_SIZE = (32, 32)
+DIGITAL_IMAGE_SIZE = (20, 32)
+
 
 @dataclass
 class ReadoutResult:
@@ -81,10 +88,24 @@ class DigitizerProcessor:
 
     @log_execution_time
     def init_analog_model(
-        self, modelfile: str, model_name: str
+        self,
+        modelfile: str,
+        model_name: str,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        zero_copy: bool = False,
+        cache_size: Optional[int] = None,
     ) -> "DigitizerProcessor":
         self.analog_model = model_name
-        self.analog_counter_reader = AnalogNeedleCNN(modelfile=modelfile, dx=32, dy=32)
+        self.analog_counter_reader = AnalogNeedleCNN(
+            modelfile=modelfile,
+            dx=ANALOG_IMAGE_SIZE[0],
+            dy=ANALOG_IMAGE_SIZE[1],
+            pool_size=pool_size,
+            options=options,
+            zero_copy=zero_copy,
+            cache_size=cache_size,
+        )
         return self
 
     def set_analog_model(
@@ -96,11 +117,23 @@ class DigitizerProcessor:
 
     @log_execution_time
     def init_digital_model(
-        self, modelfile: str, model_name: str
+        self,
+        modelfile: str,
+        model_name: str,
+        pool_size: Optional[int] = None,
+        options: Optional[InterpreterOptions] = None,
+        zero_copy: bool = False,
+        cache_size: Optional[int] = None,
     ) -> "DigitizerProcessor":
         self.digital_model = model_name
         self.digital_counter_reader = DigitalCounterCNN(
-            modelfile=modelfile, dx=20, dy=32
+            modelfile=modelfile,
+            dx=DIGITAL_IMAGE_SIZE[0],
+            dy=DIGITAL_IMAGE_SIZE[1],
+            pool_size=pool_size,
+            options=options,
+            zero_copy=zero_copy,
+            cache_size=cache_size,
         )
         return self
 
@@ -120,25 +153,134 @@ class DigitizerProcessor:
         if self.analog_counter_reader is None and self.digital_counter_reader is None:
             raise ValueError("No CNN reader initialized")
         if self.analog_counter_reader is not None:
-            result = []
-            for item in images:
-                value = self.analog_counter_reader.readout(item.image)
-                result.append(ReadoutResult(item.name, value))
-            self.cnn_analog_results = result
+            values = self.analog_counter_reader.readout_batch(
+                [item.image for item in images]
+            )
+            self.cnn_analog_results = [
+                ReadoutResult(item.name, value) for item, value in zip(images, values)
+            ]
             logger.debug(f"Analog CNN results: {self.cnn_analog_results}")
         return self
 
     @log_execution_time
     def execute_digital_ccn(self, images: List[CutImage]) -> "DigitizerProcessor":
         if self.digital_counter_reader is not None:
-            result = []
-            for item in images:
-                value = self.digital_counter_reader.readout(item.image)
-                result.append(ReadoutResult(item.name, value))
-            self.cnn_digital_results = result
+            values = self.digital_counter_reader.readout_batch(
+                [item.image for item in images]
+            )
+            self.cnn_digital_results = [
+                ReadoutResult(item.name, value) for item, value in zip(images, values)
+            ]
+            logger.debug(f"Digital CNN results: {self.cnn_digital_results}")
+        return self
+
+    @log_execution_time
+    def execute_analog_ccn_on_image(
+        self,
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        positions: List[ImagePosition],
+        autocontrast: bool = False,
+        cutoff_low: float = 2,
+        cutoff_high: float = 45,
+        ignore: Union[int, None] = None,
+        change_detector: Optional[ChangeDetector] = None,
+        source: Hashable = None,
+    ) -> "DigitizerProcessor":
+        if self.analog_counter_reader is None and self.digital_counter_reader is None:
+            raise ValueError("No CNN reader initialized")
+        if self.analog_counter_reader is not None:
+            values = self._readout_positions(
+                self.analog_counter_reader,
+                image,
+                positions,
+                autocontrast,
+                cutoff_low,
+                cutoff_high,
+                ignore,
+                change_detector,
+                source,
+            )
+            self.cnn_analog_results = [
+                ReadoutResult(pos.name, value) for pos, value in zip(positions, values)
+            ]
+            logger.debug(f"Analog CNN results: {self.cnn_analog_results}")
+        return self
+
+    @log_execution_time
+    def execute_digital_ccn_on_image(
+        self,
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        positions: List[ImagePosition],
+        autocontrast: bool = False,
+        cutoff_low: float = 2,
+        cutoff_high: float = 45,
+        ignore: Union[int, None] = None,
+        change_detector: Optional[ChangeDetector] = None,
+        source: Hashable = None,
+    ) -> "DigitizerProcessor":
+        if self.digital_counter_reader is not None:
+            values = self._readout_positions(
+                self.digital_counter_reader,
+                image,
+                positions,
+                autocontrast,
+                cutoff_low,
+                cutoff_high,
+                ignore,
+                change_detector,
+                source,
+            )
+            self.cnn_digital_results = [
+                ReadoutResult(pos.name, value) for pos, value in zip(positions, values)
+            ]
             logger.debug(f"Digital CNN results: {self.cnn_digital_results}")
         return self
 
+    def _readout_positions(
+        self,
+        reader: Union[AnalogNeedleCNN, DigitalCounterCNN],
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        positions: List[ImagePosition],
+        autocontrast: bool,
+        cutoff_low: float,
+        cutoff_high: float,
+        ignore: Union[int, None],
+        change_detector: Optional[ChangeDetector],
+        source: Hashable = None,
+    ) -> list:
+        if change_detector is not None:
+            changed, fingerprints = change_detector.changed_positions(
+                image, positions, reader.model, source
+            )
+            changed_positions = [pos for pos, c in zip(positions, changed) if c]
+            logger.debug(f"{len(changed_positions)} of {len(positions)} images changed")
+            values = self._readout_positions(
+                reader,
+                image,
+                changed_positions,
+                autocontrast,
+                cutoff_low,
+                cutoff_high,
+                ignore,
+                None,
+            )
+            return change_detector.update(positions, changed, fingerprints, values)
+
+        return reader.readout_cached(
+            [(pos.name, pos.x, pos.y, pos.w, pos.h) for pos in positions],
+            lambda out: utils.image.cut_images_to_array(
+                image,
+                positions,
+                reader.dx,
+                reader.dy,
+                out=out,
+                autocontrast=autocontrast,
+                cutoff_low=cutoff_low,
+                cutoff_high=cutoff_high,
+                ignore=ignore,
+            ),
+        )
+
     def evaluate_ccn_results(self) -> "DigitizerProcessor":
         available_values = {}
 
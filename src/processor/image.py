@@ -1,7 +1,8 @@
-from typing import Callable, List, Sequence, Union
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 import logging
 
 from PIL.Image import Image
+import numpy as np
 
 from data_classes import CutImage, ImagePosition, RefImage
 import utils.image
@@ -22,12 +23,18 @@ def _conditional_func(func) -> Callable[..., "ImageProcessor"]:
 
 
 class ImageProcessor:
+    """
+    Image processing steps. The image is kept as RGB NumPy array (or as lazily
+    transformed WarpedImage) from the download to the cut images, PIL images
+    are created only for drawing and by the methods which return PIL images.
+    """
+
     def __init__(self) -> None:
         self.condition = None
-        self.image: Image
+        self.image: Union[np.ndarray, utils.image.WarpedImage]
         self.cutted_images: List[CutImage] = []
         self.enable_img_saving = False
-        self.pictures: dict[str, Image] = {}
+        self.pictures: dict[str, Union[np.ndarray, utils.image.WarpedImage]] = {}
 
     def if_(self, a) -> "ImageProcessor":
         self.condition = a
@@ -47,8 +54,22 @@ class ImageProcessor:
         return self
 
     @_conditional_func
-    def set_image(self, image: Image) -> "ImageProcessor":
-        self.image = utils.image.convert_to_image(image)
+    def set_image(self, image: Union[Image, np.ndarray]) -> "ImageProcessor":
+        self.image = utils.image.convert_image_to_np_array(image)
+        return self
+
+    @_conditional_func
+    def set_processed_image(
+        self,
+        image: Union[np.ndarray, utils.image.WarpedImage],
+        pictures: Dict[str, Union[np.ndarray, utils.image.WarpedImage]],
+    ) -> "ImageProcessor":
+        """
+        Use the result of a compiled pipeline, see processor.pipeline. Lazily
+        transformed images are kept as they are.
+        """
+        self.image = image
+        self.pictures = dict(pictures)
         return self
 
     @_conditional_func
@@ -58,17 +79,33 @@ class ImageProcessor:
 
     @_conditional_func
     def get_image(self) -> Image:
-        return self.image.copy()
+        return utils.image.convert_to_image(self.image)
 
     def get_picture(self, name: str) -> Image:
         img = self.pictures.get(name, None)
         if img is None:
             raise ValueError(f"No image with name {name} available")
-        return img.copy()
+        return utils.image.convert_to_image(img)
 
     def get_pictures(self) -> dict:
         return self.pictures.copy()
 
+    def get_image_as_np_array(self) -> np.ndarray:
+        return utils.image.convert_image_to_np_array(self.image)
+
+    def get_image_for_cutting(self) -> Union[np.ndarray, utils.image.WarpedImage]:
+        """
+        Image to pass to utils.image.cut_images_to_array, lazily transformed
+        images are returned as they are, so their pixels are not computed.
+        """
+        if isinstance(self.image, utils.image.WarpedImage):
+            return self.image
+        return self.get_image_as_np_array()
+
+    def _np_image(self) -> np.ndarray:
+        # lazily transformed images are computed for steps which need all pixels
+        return utils.image.convert_image_to_np_array(self.image)
+
     def get_image_as_base64_str(self) -> str:
         return utils.image.convert_image_base64str(image=self.image)
 
@@ -81,22 +118,36 @@ class ImageProcessor:
 
     @_conditional_func
     def download_image(
-        self, url: str, timeout: int, min_image_size: int = 0
+        self,
+        url: str,
+        timeout: int,
+        min_image_size: int = 0,
+        required_scale: Optional[Callable[[Tuple[int, int]], float]] = None,
     ) -> "ImageProcessor":
+        """
+        Download and decode the image. If required_scale is given, JPEG images
+        are decoded at reduced size when the later steps need less resolution,
+        see utils.image.bytes_to_reduced_image. The reduced image is aligned
+        at its resolution by rotate_and_align_image, other steps compute the
+        image at full size.
+        """
         logger.debug(f"Download image from {url}")
         data = utils.download.load_file_from_url(
             url=url,
             timeout=timeout,
             min_file_size=min_image_size,
         )
-        self.image = utils.image.bytes_to_image(data)
+        if required_scale is None:
+            self.image = utils.image.bytes_to_image(data)
+        else:
+            self.image = utils.image.bytes_to_reduced_image(data, required_scale)
         self.pictures.clear()
         return self
 
     @_conditional_func
     def rotate_image(self, angle: float) -> "ImageProcessor":
         logger.debug(f"Rotate image by {angle} degrees")
-        self.image = utils.image.rotate(self.image, angle, keep_org_size=False)
+        self.image = utils.image.rotate(self._np_image(), angle, keep_org_size=False)
         return self
 
     @_conditional_func
@@ -124,7 +175,7 @@ class ImageProcessor:
             f"sharpness:{sharpness}, color:{color}"
         )
         self.image = utils.image.adjust_image(
-            self.image,
+            self._np_image(),
             contrast=contrast,
             brightness=brightness,
             sharpness=sharpness,
@@ -144,23 +195,132 @@ class ImageProcessor:
             f"ignore:{ignore}"
         )
         self.image = utils.image.autocontrast_image(
-            self.image,
+            self._np_image(),
             cutoff_low=cutoff_low,
             cutoff_high=cutoff_high,
             ignore=ignore,
         )
         return self
 
+    @_conditional_func
+    def enhance_image(
+        self,
+        contrast: float = 1.0,
+        brightness: float = 1.0,
+        sharpness: float = 1.0,
+        color: float = 1.0,
+        autocontrast: bool = False,
+        cutoff_low: float = 0,
+        cutoff_high: float = 0,
+        ignore: Union[int, None] = None,
+        area: Optional[ImagePosition] = None,
+    ) -> "ImageProcessor":
+        """
+        Adjust and autocontrast the image in a single stage, see
+        utils.image.enhance_image.
+        """
+        logger.debug(
+            f"Enhance image contrast:{contrast}, brightness:{brightness}, "
+            f"sharpness:{sharpness}, color:{color}, autocontrast:{autocontrast}, "
+            f"area:{area}"
+        )
+        self.image = utils.image.enhance_image(
+            self._np_image(),
+            contrast=contrast,
+            brightness=brightness,
+            sharpness=sharpness,
+            color=color,
+            autocontrast=autocontrast,
+            cutoff_low=cutoff_low,
+            cutoff_high=cutoff_high,
+            ignore=ignore,
+            area=area,
+        )
+        return self
+
     @_conditional_func
     def to_gray_scale(self) -> "ImageProcessor":
         logger.debug("Convert image to gray scale")
-        self.image = utils.image.convert_to_gray_scale(self.image)
+        self.image = utils.image.convert_to_gray_scale(self._np_image())
         return self
 
     @_conditional_func
-    def align_image(self, align_images: List[RefImage]) -> "ImageProcessor":
+    def align_image(
+        self,
+        align_images: List[RefImage],
+        search_window: int = 0,
+        min_confidence: float = 0.8,
+        mode: str = utils.image.ALIGNMENT_MODE_FULL,
+        pyramid_levels: int = 2,
+        reuse_transform: bool = False,
+        max_transform_age: int = 10,
+        phase_min_response: float = 0.3,
+        phase_rotation: bool = False,
+    ) -> "ImageProcessor":
         logger.debug(f"Align image to {align_images}")
-        self.image = utils.image.align(self.image, align_images)
+        self.image = utils.image.align(
+            self._np_image(),
+            align_images,
+            search_window,
+            min_confidence,
+            mode,
+            pyramid_levels,
+            reuse_transform,
+            max_transform_age,
+            phase_min_response,
+            phase_rotation,
+        )
+        return self
+
+    @_conditional_func
+    def rotate_and_align_image(
+        self,
+        rotate_angle: float,
+        align_images: List[RefImage],
+        post_rotate_angle: float = 0,
+        search_window: int = 0,
+        min_confidence: float = 0.8,
+        mode: str = utils.image.ALIGNMENT_MODE_FULL,
+        pyramid_levels: int = 2,
+        reuse_transform: bool = False,
+        max_transform_age: int = 10,
+        phase_min_response: float = 0.3,
+        phase_rotation: bool = False,
+        lazy: bool = False,
+    ) -> "ImageProcessor":
+        """
+        Rotate, align and rotate the image again with a single resampling, see
+        utils.image.rotate_and_align. If lazy is set, the pixels of the image
+        are computed only when they are accessed, so a crop is composed into
+        the transform and cut images are sampled directly from the downloaded
+        image. Resize and other processing steps need the whole image.
+        """
+        logger.debug(
+            f"Rotate image by {rotate_angle} degrees, align image to "
+            f"{align_images} and rotate image by {post_rotate_angle} degrees"
+        )
+        intermediates: Optional[Dict[str, np.ndarray]] = (
+            {} if self.enable_img_saving else None
+        )
+        warped = utils.image.rotate_and_align(
+            self.image,
+            rotate_angle,
+            align_images,
+            post_rotate_angle,
+            search_window,
+            min_confidence,
+            mode,
+            pyramid_levels,
+            reuse_transform,
+            max_transform_age,
+            phase_min_response,
+            phase_rotation,
+            intermediates,
+        )
+        for name, img in (intermediates or {}).items():
+            logger.debug(f"Store image by name {name}")
+            self.pictures[name] = img
+        self.image = warped if lazy else warped.data
         return self
 
     @_conditional_func
@@ -172,7 +332,7 @@ class ImageProcessor:
         cutoff_high: float = 45,
         ignore: int = 2,
     ) -> "ImageProcessor":
-        image = utils.image.cut_image(self.image, position)
+        image = utils.image.cut_image(self._np_image(), position)
         if autocontrast:
             image = utils.image.autocontrast_image(
                 image, cutoff_low, cutoff_high, ignore
@@ -189,8 +349,9 @@ class ImageProcessor:
         cutoff_high: float = 45,
         ignore: int = 2,
     ) -> "ImageProcessor":
+        source = self.get_image_for_cutting()
         for img in positions:
-            image = utils.image.cut_image(self.image, img)
+            image = utils.image.cut_image(source, img)
             if autocontrast:
                 image = utils.image.autocontrast_image(
                     image, cutoff_low, cutoff_high, ignore
@@ -221,9 +382,11 @@ class ImageProcessor:
         self, images: Sequence[ImagePosition], rgb_colour: tuple = (255, 0, 0)
     ) -> "ImageProcessor":
         thickness = 1
+        # PIL draws on a copy of the image
+        image = utils.image.convert_to_image(self.image)
         for img in images:
-            self.image = utils.image.draw_rectangle(
-                self.image,
+            utils.image.draw_rectangle(
+                image,
                 img.x,
                 img.y,
                 img.w,
@@ -231,11 +394,12 @@ class ImageProcessor:
                 rgb_colour=rgb_colour,
                 thickness=thickness,
             )
-            self.image = utils.image.draw_text(
-                self.image,
+            utils.image.draw_text(
+                image,
                 img.name,
                 img.x,
                 img.y - 15,
                 rgb_colour=rgb_colour,
             )
+        self.image = utils.image.convert_image_to_np_array(image)
         return self
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import io
+import logging
+import secrets
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import PIL.Image
+
+import utils.image
+
+logger = logging.getLogger(__name__)
+
+# encoded variants (format, quality, width) kept per reading
+MAX_ENCODED_IMAGES = 32
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    format: str
+    etag: str
+
+
+@dataclass
+class _Reading:
+    images: Dict[str, Any]
+    encoded: OrderedDict = field(default_factory=OrderedDict)
+
+
+class ImageStore:
+    """
+    Images of the latest readings. Every reading gets a new id, so an image
+    identified by the reading id and the image name never changes and can be
+    cached by browsers. Images are encoded when they are requested the first
+    time and the encoded images are kept per format, quality and width.
+    Images stored as encoded data, e.g. the downloaded original image, are
+    returned as they are if no other format, quality or width is requested.
+    """
+
+    def __init__(self, max_readings: int = 3) -> None:
+        self.max_readings = max_readings
+        self._lock = threading.Lock()
+        self._readings: OrderedDict = OrderedDict()
+
+    @property
+    def latest_id(self) -> str:
+        with self._lock:
+            return next(reversed(self._readings), "")
+
+    def put(self, images: Dict[str, Any]) -> str:
+        """
+        Store the images of a new reading.
+
+        Args:
+            images (Dict[str, Any]): Images by name, NumPy arrays, lazily
+            transformed images or encoded JPEG or PNG data.
+
+        Returns:
+            str: Id of the reading.
+        """
+        reading_id = secrets.token_hex(8)
+        with self._lock:
+            self._readings[reading_id] = _Reading(dict(images))
+            while len(self._readings) > self.max_readings:
+                self._readings.popitem(last=False)
+        return reading_id
+
+    def get(self, name: str, reading_id: str = "") -> Optional[Any]:
+        """
+        Get an image, of the latest reading if no reading id is given. None if
+        the image or the reading is not available.
+        """
+        with self._lock:
+            reading_id, reading = self._reading(reading_id)
+            return None if reading is None else reading.images.get(name)
+
+    def names(self, reading_id: str = "") -> List[str]:
+        """
+        Names of the images of a reading, of the latest reading if no reading
+        id is given.
+        """
+        with self._lock:
+            reading_id, reading = self._reading(reading_id)
+            return [] if reading is None else list(reading.images)
+
+    def get_encoded(
+        self,
+        name: str,
+        reading_id: str = "",
+        format: Optional[str] = None,
+        quality: Optional[int] = None,
+        width: int = 0,
+    ) -> Optional[EncodedImage]:
+        """
+        Get an encoded image, see get and utils.image.encode_image.
+
+        Args:
+            name (str): Name of the image.
+            reading_id (str, optional): Id of the reading. Defaults to "", the
+            latest reading.
+            format (str, optional): Format, one of utils.image.IMAGE_FORMATS.
+            Defaults to None, the format of encoded data or JPEG.
+            quality (int, optional): Quality of JPEG and WebP images. Defaults
+            to None, the default quality.
+            width (int, optional): Width of a downscaled image. Defaults to 0,
+            the size of the image.
+
+        Returns:
+            Optional[EncodedImage]: Encoded image with its strong entity tag,
+            None if the image or the reading is not available.
+        """
+        with self._lock:
+            reading_id, reading = self._reading(reading_id)
+            if reading is None or name not in reading.images:
+                return None
+            image = reading.images[name]
+        if isinstance(image, bytes):
+            data_format = _data_format(image)
+            size = PIL.Image.open(io.BytesIO(image)).size
+        else:
+            data_format = None
+            size = utils.image.image_size(image)
+        format = format or data_format or "jpeg"
+        if width >= size[0]:
+            width = 0
+        key = (name, format, quality, width)
+        etag = f'"{reading_id}-{name}-{format}-{quality or 0}-{width}"'
+
+        with self._lock:
+            data = reading.encoded.get(key)
+            if data is not None:
+                reading.encoded.move_to_end(key)
+                return EncodedImage(data, format, etag)
+        if format == data_format and quality is None and width == 0:
+            data = image
+        else:
+            logger.debug(f"Encode image {name} as {format}")
+            if isinstance(image, bytes):
+                image = utils.image.bytes_to_image(image)
+            data = utils.image.encode_image(image, format, quality, width)
+        with self._lock:
+            reading.encoded[key] = data
+            while len(reading.encoded) > MAX_ENCODED_IMAGES:
+                reading.encoded.popitem(last=False)
+        return EncodedImage(data, format, etag)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._readings.clear()
+
+    def _reading(self, reading_id: str) -> Tuple[str, Optional[_Reading]]:
+        if not reading_id:
+            reading_id = next(reversed(self._readings), "")
+        return reading_id, self._readings.get(reading_id)
+
+
+def _data_format(data: bytes) -> Optional[str]:
+    if data.startswith(b"\xff\xd8"):
+        return "jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    return None
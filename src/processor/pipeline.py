@@ -0,0 +1,594 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import dataclasses
+import functools
+import hashlib
+import logging
+import threading
+import time
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+
+from cnn.cache import CacheStats
+from configuration import Config
+from data_classes import ImagePosition, RefImage
+from processor.digitizer import ANALOG_IMAGE_SIZE, DIGITAL_IMAGE_SIZE
+import utils.download
+import utils.image
+
+logger = logging.getLogger(__name__)
+
+# minimum size of the reference images in the image decoded at reduced size
+MIN_REFERENCE_IMAGE_SIZE = 16
+
+# memory for the stage outputs of the setup wizard
+STAGE_CACHE_SIZE = 64 * 1024 * 1024
+
+PipelineImage = Union[np.ndarray, utils.image.WarpedImage]
+
+
+@dataclass(frozen=True)
+class PipelineStage:
+    """
+    Stage of a compiled pipeline. The function is called with the result of
+    the previous stage and the dictionary of saved images, its parameters are
+    already bound.
+    """
+
+    name: str
+    func: Callable[[Any, Dict[str, Any]], Any]
+    params: Mapping[str, Any]
+
+
+@dataclass
+class StageTiming:
+    name: str
+    calls: int
+    last_ms: float
+    mean_ms: float
+    max_ms: float
+
+
+class PipelinePlan:
+    """
+    Ordered stages of the image processing of one reading, from the download
+    of the image to the image the cut images are taken from. The stages are
+    fixed when the plan is compiled, so running the plan does not check the
+    configuration. The time of every stage is recorded.
+    """
+
+    def __init__(self, stages: Sequence[PipelineStage], saveimages: bool) -> None:
+        self.stages: Tuple[PipelineStage, ...] = tuple(stages)
+        self.saveimages = saveimages
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._last = np.zeros(len(self.stages))
+        self._total = np.zeros(len(self.stages))
+        self._max = np.zeros(len(self.stages))
+
+    def run(self, url: str) -> Tuple[PipelineImage, Dict[str, Any]]:
+        """
+        Run all stages.
+
+        Args:
+            url (str): URL of the image.
+
+        Returns:
+            Tuple[PipelineImage, Dict[str, Any]]: Processed image and the
+            saved images, the processed image is saved as "final" and the
+            original image as downloaded data.
+        """
+        pictures: Dict[str, Any] = {}
+        value: Any = url
+        times = np.zeros(len(self.stages))
+        for i, stage in enumerate(self.stages):
+            start_time = time.perf_counter()
+            value = stage.func(value, pictures)
+            times[i] = time.perf_counter() - start_time
+        pictures["final"] = value
+        with self._lock:
+            self._calls += 1
+            self._last = times
+            self._total += times
+            np.maximum(self._max, times, out=self._max)
+        return value, pictures
+
+    def timings(self) -> List[StageTiming]:
+        with self._lock:
+            calls = self._calls
+            last, total, maximum = self._last, self._total.copy(), self._max.copy()
+        return [
+            StageTiming(
+                name=stage.name,
+                calls=calls,
+                last_ms=float(last[i]) * 1000,
+                mean_ms=float(total[i]) / max(calls, 1) * 1000,
+                max_ms=float(maximum[i]) * 1000,
+            )
+            for i, stage in enumerate(self.stages)
+        ]
+
+    def describe(self) -> Dict[str, Any]:
+        """
+        Stages with their parameters and timings as JSON serializable
+        dictionary.
+        """
+        return {
+            "saveimages": self.saveimages,
+            "stages": [
+                {
+                    "name": stage.name,
+                    "params": {k: _describe(v) for k, v in stage.params.items()},
+                    **dataclasses.asdict(timing),
+                }
+                for stage, timing in zip(self.stages, self.timings())
+            ],
+        }
+
+
+class StageCache:
+    """
+    Run stages and keep the output of every stage, so a stage is computed
+    again only when its parameters or the output of a previous stage have
+    changed. The setup wizard runs the same stages for every parameter change,
+    e.g. changing the autocontrast cutoff computes only the autocontrast and
+    the stages after it. Outputs are identified by the input of the first
+    stage and the names and parameters of the stages up to the stage, least
+    recently used outputs are dropped when the outputs exceed the memory
+    size. Cached arrays are read only. Images saved by the stages are not
+    cached, so stages which save images should not be used.
+    """
+
+    def __init__(self, max_bytes: int = STAGE_CACHE_SIZE) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self.stats = CacheStats(max_size=max(0, max_bytes))
+
+    def run(self, stages: Sequence[PipelineStage], value: Any) -> Any:
+        """
+        Run the stages.
+
+        Args:
+            stages (Sequence[PipelineStage]): Stages to run.
+            value (Any): Input of the first stage, str, bytes or NumPy array.
+
+        Returns:
+            Any: Output of the last stage.
+        """
+        keys: List[Hashable] = []
+        key: Hashable = _input_key(value)
+        for stage in stages:
+            key = (
+                key,
+                stage.name,
+                tuple((k, repr(v)) for k, v in stage.params.items()),
+            )
+            keys.append(key)
+
+        start = 0
+        with self._lock:
+            for i in range(len(keys) - 1, -1, -1):
+                if keys[i] in self._entries:
+                    self._entries.move_to_end(keys[i])
+                    value = self._entries[keys[i]][0]
+                    start = i + 1
+                    self.stats.hits += 1
+                    break
+            self.stats.misses += len(keys) - start
+
+        for stage, key in zip(stages[start:], keys[start:]):
+            value = stage.func(value, {})
+            self._put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.stats.size = 0
+
+    def _put(self, key: Hashable, value: Any) -> None:
+        size = _nbytes(value)
+        if size > self.stats.max_size:
+            return
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self.stats.size -= self._entries[key][1]
+            self._entries[key] = (value, size)
+            self._entries.move_to_end(key)
+            self.stats.size += size
+            while self.stats.size > self.stats.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.stats.size -= evicted
+                self.stats.evictions += 1
+
+
+stage_cache = StageCache()
+
+
+def _input_key(value: Any) -> Hashable:
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value).data
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        return ("input", value.shape, value.dtype.str, digest)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return ("input", hashlib.blake2b(value, digest_size=16).digest())
+
+
+def _nbytes(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, utils.image.WarpedImage):
+        return value.source.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 0
+
+
+def _describe(value: Any) -> Any:
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if isinstance(value, (list, tuple)):
+        return [_describe(item) for item in value]
+    if callable(value):
+        return getattr(getattr(value, "func", value), "__name__", str(value))
+    return value
+
+
+def _stage(name: str, func: Callable[..., Any], **params: Any) -> PipelineStage:
+    return PipelineStage(
+        name=name,
+        func=functools.partial(func, **params),
+        params=MappingProxyType(params),
+    )
+
+
+def _download(url: str, pictures: Dict[str, Any], timeout: int, min_size: int) -> bytes:
+    return utils.download.load_file_from_url(
+        url=url, timeout=timeout, min_file_size=min_size
+    )
+
+
+def _decode(
+    data: bytes,
+    pictures: Dict[str, Any],
+    required_scale: Optional[Callable[[Tuple[int, int]], float]],
+) -> PipelineImage:
+    if required_scale is None:
+        return utils.image.bytes_to_image(data)
+    return utils.image.bytes_to_reduced_image(data, required_scale)
+
+
+def _save(
+    image: PipelineImage, pictures: Dict[str, Any], picture_name: str
+) -> PipelineImage:
+    pictures[picture_name] = image
+    return image
+
+
+def _rotate_and_align(
+    image: PipelineImage,
+    pictures: Dict[str, Any],
+    rotate_angle: float,
+    ref_images: List[RefImage],
+    post_rotate_angle: float,
+    search_window: int,
+    min_confidence: float,
+    mode: str,
+    pyramid_levels: int,
+    reuse_transform: bool,
+    max_transform_age: int,
+    phase_min_response: float,
+    phase_rotation: bool,
+    save_intermediates: bool,
+    lazy: bool,
+) -> PipelineImage:
+    warped = utils.image.rotate_and_align(
+        image,
+        rotate_angle,
+        ref_images,
+        post_rotate_angle,
+        search_window,
+        min_confidence,
+        mode,
+        pyramid_levels,
+        reuse_transform,
+        max_transform_age,
+        phase_min_response,
+        phase_rotation,
+        pictures if save_intermediates else None,
+    )
+    return warped if lazy else warped.data
+
+
+def _crop(
+    image: PipelineImage, pictures: Dict[str, Any], x: int, y: int, w: int, h: int
+) -> PipelineImage:
+    return utils.image.crop_image(image, x, y, w, h)
+
+
+def _resize(
+    image: PipelineImage, pictures: Dict[str, Any], width: int, height: int
+) -> PipelineImage:
+    return utils.image.resize_image(image, width, height)
+
+
+def _gray(image: PipelineImage, pictures: Dict[str, Any]) -> np.ndarray:
+    return utils.image.convert_to_gray_scale(
+        utils.image.convert_image_to_np_array(image)
+    )
+
+
+def _decode_base64(data: str, pictures: Dict[str, Any], reduction: int) -> np.ndarray:
+    return utils.image.convert_base64_str_to_image(data, reduction)
+
+
+def _encode_base64(image: PipelineImage, pictures: Dict[str, Any]) -> str:
+    return utils.image.convert_image_base64str(image)
+
+
+def _rotate(image: PipelineImage, pictures: Dict[str, Any], angle: float) -> np.ndarray:
+    return utils.image.rotate(
+        utils.image.convert_image_to_np_array(image), angle, keep_org_size=False
+    )
+
+
+def _adjust(image: PipelineImage, pictures: Dict[str, Any], **params) -> np.ndarray:
+    return utils.image.adjust_image(
+        utils.image.convert_image_to_np_array(image), **params
+    )
+
+
+def _autocontrast(
+    image: PipelineImage, pictures: Dict[str, Any], **params
+) -> np.ndarray:
+    return utils.image.autocontrast_image(
+        utils.image.convert_image_to_np_array(image), **params
+    )
+
+
+def _enhance(image: PipelineImage, pictures: Dict[str, Any], **params) -> np.ndarray:
+    return utils.image.enhance_image(
+        utils.image.convert_image_to_np_array(image), **params
+    )
+
+
+def decode_base64_stage(reduction: int = 1) -> PipelineStage:
+    return _stage("decode", _decode_base64, reduction=reduction)
+
+
+def encode_base64_stage() -> PipelineStage:
+    return _stage("encode", _encode_base64)
+
+
+def rotate_stage(angle: float) -> PipelineStage:
+    return _stage("rotate", _rotate, angle=angle)
+
+
+def crop_stage(x: int, y: int, w: int, h: int) -> PipelineStage:
+    return _stage("crop", _crop, x=x, y=y, w=w, h=h)
+
+
+def resize_stage(width: int, height: int) -> PipelineStage:
+    return _stage("resize", _resize, width=width, height=height)
+
+
+def adjust_stage(
+    contrast: float = 1.0,
+    brightness: float = 1.0,
+    sharpness: float = 1.0,
+    color: float = 1.0,
+) -> PipelineStage:
+    return _stage(
+        "adjust",
+        _adjust,
+        contrast=contrast,
+        brightness=brightness,
+        sharpness=sharpness,
+        color=color,
+    )
+
+
+def gray_stage() -> PipelineStage:
+    return _stage("gray", _gray)
+
+
+def autocontrast_stage(
+    cutoff_low: float = 0, cutoff_high: float = 0, ignore: Optional[int] = None
+) -> PipelineStage:
+    return _stage(
+        "autocontrast",
+        _autocontrast,
+        cutoff_low=cutoff_low,
+        cutoff_high=cutoff_high,
+        ignore=ignore,
+    )
+
+
+def preview_stages(
+    size: Tuple[int, int], max_size: Tuple[int, int]
+) -> Tuple[List[PipelineStage], float]:
+    """
+    Stages which decode a base64 image as downscaled proxy for previews, JPEG
+    images are decoded at reduced size.
+
+    Args:
+        size (Tuple[int, int]): Size (width, height) of the image.
+        max_size (Tuple[int, int]): Maximum size (width, height) of the proxy.
+
+    Returns:
+        Tuple[List[PipelineStage], float]: Stages and the scale (0-1) of the
+        proxy.
+    """
+    scale = min(1.0, max_size[0] / size[0], max_size[1] / size[1])
+    reduction = next(
+        (reduction for reduction in (8, 4, 2) if scale * reduction <= 1), 1
+    )
+    stages = [decode_base64_stage(reduction)]
+    if scale < 1.0:
+        width = max(1, round(size[0] * scale))
+        height = max(1, round(size[1] * scale))
+        stages.append(resize_stage(width, height))
+    return stages, scale
+
+
+def required_image_scale(config: Config, size: Tuple[int, int]) -> float:
+    """
+    Lowest scale of the downloaded image which keeps the resolution of the
+    resized image, of the cut images the models read out and of the reference
+    images.
+
+    Args:
+        config (Config): Configuration.
+        size (Tuple[int, int]): Size (width, height) of the downloaded image.
+
+    Returns:
+        float: Scale (0-1) of the downloaded image.
+    """
+    _, size = utils.image.rotation_matrix(*size, config.alignment.rotate_angle)
+    _, size = utils.image.rotation_matrix(*size, config.alignment.post_rotate_angle)
+    if config.crop.enabled:
+        size = (config.crop.w, config.crop.h)
+    scale = 1.0
+    if config.resize.enabled:
+        scale = max(config.resize.w / size[0], config.resize.h / size[1])
+
+    # cut images are resized to the model input size
+    cut_image_scales = [
+        max(model_w / pos.w, model_h / pos.h)
+        for params, (model_w, model_h) in [
+            (config.digital_readout, DIGITAL_IMAGE_SIZE),
+            (config.analog_readout, ANALOG_IMAGE_SIZE),
+        ]
+        if params.enabled
+        for pos in params.cut_images
+    ]
+    scale *= min(1.0, max(cut_image_scales, default=1.0))
+
+    for ref in config.alignment.ref_images:
+        h, w = utils.image.template_cache.get(ref.file_name).shape[:2]
+        scale = max(scale, MIN_REFERENCE_IMAGE_SIZE / min(w, h))
+    return min(1.0, scale)
+
+
+def cut_images_area(config: Config) -> Optional[ImagePosition]:
+    """
+    Bounding box of all cut images, None if there are no cut images.
+    """
+    positions = config.digital_readout.cut_images + config.analog_readout.cut_images
+    if not positions:
+        return None
+    x = min(pos.x for pos in positions)
+    y = min(pos.y for pos in positions)
+    w = max(pos.x + pos.w for pos in positions) - x
+    h = max(pos.y + pos.h for pos in positions) - y
+    return ImagePosition("cut_images", x, y, w, h)
+
+
+def compile_pipeline(config: Config, saveimages: bool = False) -> PipelinePlan:
+    """
+    Compile the image processing of the configuration into a plan of the
+    enabled stages.
+
+    Args:
+        config (Config): Configuration.
+        saveimages (bool, optional): Save the intermediate images, the
+        original image is saved as the downloaded data. Defaults to False.
+
+    Returns:
+        PipelinePlan: Compiled plan.
+    """
+    source = config.image_source
+    alignment = config.alignment
+    processing = config.image_processing
+    stages = [
+        _stage("download", _download, timeout=source.timeout, min_size=source.min_size)
+    ]
+
+    def save(name: str) -> None:
+        if saveimages:
+            stages.append(_stage(f"save {name}", _save, picture_name=name))
+
+    # the original image is saved as downloaded, so it is not encoded again
+    save("original")
+    stages.append(
+        _stage(
+            "decode",
+            _decode,
+            required_scale=(
+                functools.partial(required_image_scale, config)
+                if source.reduced_decode
+                else None
+            ),
+        )
+    )
+    stages.append(
+        _stage(
+            "rotate_and_align",
+            _rotate_and_align,
+            rotate_angle=alignment.rotate_angle,
+            ref_images=alignment.ref_images,
+            post_rotate_angle=alignment.post_rotate_angle,
+            search_window=alignment.search_window,
+            min_confidence=alignment.min_confidence,
+            mode=alignment.mode,
+            pyramid_levels=alignment.pyramid_levels,
+            reuse_transform=alignment.reuse_transform,
+            max_transform_age=alignment.max_transform_age,
+            phase_min_response=alignment.phase_min_response,
+            phase_rotation=alignment.phase_rotation,
+            save_intermediates=saveimages,
+            # without image processing the cut images can be sampled directly
+            # from the downloaded image. Saving images does not change the
+            # path, saved images are computed when they are requested, so the
+            # readouts do not depend on saveimages.
+            lazy=not processing.enabled or source.reduced_decode,
+        )
+    )
+    if config.crop.enabled:
+        crop = config.crop
+        stages.append(crop_stage(crop.x, crop.y, crop.w, crop.h))
+        save("cropped")
+    if config.resize.enabled:
+        stages.append(resize_stage(config.resize.w, config.resize.h))
+        save("resized")
+    if processing.enabled and processing.grayscale:
+        stages.append(gray_stage())
+        save("gray")
+    if processing.enabled:
+        stages.append(
+            _stage(
+                "enhance",
+                _enhance,
+                brightness=processing.brightness,
+                contrast=processing.contrast,
+                sharpness=processing.sharpness,
+                color=processing.color,
+                autocontrast=processing.autocontrast.enabled,
+                cutoff_low=processing.autocontrast.cutoff_low,
+                cutoff_high=processing.autocontrast.cutoff_high,
+                ignore=processing.autocontrast.ignore,
+                area=(
+                    cut_images_area(config) if processing.cut_images_area_only else None
+                ),
+            )
+        )
+        save("processed")
+    plan = PipelinePlan(stages, saveimages)
+    logger.debug(f"Compiled pipeline: {[stage.name for stage in plan.stages]}")
+    return plan
@@ -0,0 +1,363 @@
+from dataclasses import asdict, dataclass
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Sequence
+
+import cv2
+import numpy as np
+import PIL.Image
+
+from cnn.benchmark import (
+    AllocationResult,
+    ModelBenchmarkResult,
+    benchmark_latency,
+    benchmark_model_dirs,
+    measure_allocations,
+    measure_readout_allocations,
+)
+from cnn.registry import get_interpreter_options
+from configuration import Config
+from data_classes import RefImage
+from processor.digitizer import DigitizerProcessor
+from processor.image import ImageProcessor
+import utils.image
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AlignmentBenchmarkResult:
+    mode: str
+    pyramid_levels: int
+    search_window: int
+    images: int
+    mean_ms: float
+    p50_ms: float
+    max_ms: float
+    mean_error_px: float
+    max_error_px: float
+    fallbacks: int = 0
+
+
+@dataclass
+class PipelineBenchmarkResult:
+    name: str
+    iterations: int
+    mean_ms: float
+    p50_ms: float
+    pil_images: float
+    peak_frames: float
+
+
+def benchmark_pipeline(
+    name: str,
+    func: Callable[[], Any],
+    frame_bytes: int,
+    iterations: int = 20,
+    warmup: int = 2,
+) -> PipelineBenchmarkResult:
+    """
+    Measure the time and the image copies of an image processing function.
+    Copies are measured as the number of PIL images allocated per call and
+    the peak memory allocated by NumPy and Python per call in frames. The
+    pixel memory of PIL images is not traced, so the peak memory of functions
+    which create PIL images is too low.
+
+    Args:
+        name (str): Name of the result.
+        func (Callable[[], Any]): Function to measure, e.g. the image
+        processing of one reading.
+        frame_bytes (int): Size of one RGB frame in bytes.
+        iterations (int, optional): Number of measured calls. Defaults to 20.
+        warmup (int, optional): Number of calls before measuring. Defaults to
+        2.
+
+    Returns:
+        PipelineBenchmarkResult: Time and copies per call.
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    pil_images = PIL.Image.core.get_stats()["new_count"]
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    pil_images = PIL.Image.core.get_stats()["new_count"] - pil_images
+    allocations = measure_allocations(name, func, iterations, warmup=0)
+    result = PipelineBenchmarkResult(
+        name=name,
+        iterations=iterations,
+        mean_ms=float(np.mean(times)) * 1000,
+        p50_ms=float(np.percentile(times, 50)) * 1000,
+        pil_images=pil_images / iterations,
+        peak_frames=allocations.mean_peak_bytes / frame_bytes,
+    )
+    logger.debug(f"Pipeline benchmark result: {result}")
+    return result
+
+
+def benchmark_alignment(
+    frames: Sequence[np.ndarray],
+    reference_images: List[RefImage],
+    search_windows: Sequence[int] = (0,),
+    pyramid_levels: Sequence[int] = (1, 2, 3),
+    min_confidence: float = 0.8,
+    iterations: int = 5,
+    phase_min_response: float = 0.3,
+    phase_rotation: bool = False,
+) -> List[AlignmentBenchmarkResult]:
+    """
+    Compare the alignment modes. The error is the distance of the found
+    reference positions to the positions found by the full resolution search
+    of the whole image. The phase mode uses the first frame as reference
+    frame, frames whose phase correlation response is too low are counted as
+    fallbacks and searched at full resolution.
+
+    Args:
+        frames (Sequence[np.ndarray]): RGB images to align, already rotated.
+        reference_images (List[RefImage]): Reference images.
+        search_windows (Sequence[int], optional): Search windows to measure,
+        0 searches the whole image. Defaults to (0,).
+        pyramid_levels (Sequence[int], optional): Pyramid levels to measure.
+        Defaults to (1, 2, 3).
+        min_confidence (float, optional): Minimum match score. Defaults to 0.8.
+        iterations (int, optional): Number of measured runs per image. Defaults
+        to 5.
+        phase_min_response (float, optional): Minimum phase correlation
+        response. Defaults to 0.3.
+        phase_rotation (bool, optional): Estimate rotation and scale in phase
+        mode. Defaults to False.
+
+    Returns:
+        List[AlignmentBenchmarkResult]: Result for every setting.
+    """
+    expected = [
+        np.array(utils.image.find_reference_coordinates(frame, reference_images))
+        for frame in frames
+    ]
+    settings = [(utils.image.ALIGNMENT_MODE_FULL, 0)] + [
+        (utils.image.ALIGNMENT_MODE_PYRAMID, levels) for levels in pyramid_levels
+    ]
+    results = []
+    for search_window in search_windows:
+        for mode, levels in settings:
+            times = []
+            errors = []
+            for frame, positions in zip(frames, expected):
+                for _ in range(iterations):
+                    start_time = time.perf_counter()
+                    found = utils.image.find_reference_coordinates(
+                        frame,
+                        reference_images,
+                        search_window,
+                        min_confidence,
+                        mode,
+                        levels,
+                    )
+                    times.append(time.perf_counter() - start_time)
+                errors += list(np.hypot(*(np.array(found) - positions).T))
+            result = AlignmentBenchmarkResult(
+                mode=mode,
+                pyramid_levels=levels,
+                search_window=search_window,
+                images=len(frames),
+                mean_ms=float(np.mean(times)) * 1000,
+                p50_ms=float(np.percentile(times, 50)) * 1000,
+                max_ms=float(np.max(times)) * 1000,
+                mean_error_px=float(np.mean(errors)),
+                max_error_px=float(np.max(errors)),
+            )
+            logger.debug(f"Alignment benchmark result: {result}")
+            results.append(result)
+    results.append(
+        _benchmark_phase(
+            frames,
+            reference_images,
+            expected,
+            min_confidence,
+            iterations,
+            phase_min_response,
+            phase_rotation,
+        )
+    )
+    return results
+
+
+def get_benchmark_urls(url: str, frames_dir: str = "") -> List[str]:
+    """
+    URLs of the images in the frames directory, the given URL if no directory
+    is given.
+    """
+    if not frames_dir:
+        return [url]
+    return [
+        f"file://{os.path.abspath(os.path.join(frames_dir, name))}"
+        for name in sorted(os.listdir(frames_dir))
+        if os.path.splitext(name)[1].lower() in [".jpg", ".jpeg", ".png"]
+    ]
+
+
+def run_benchmark(
+    config: Config, process_image: Callable[[], ImageProcessor]
+) -> Dict[str, Any]:
+    """
+    Latency of the configured models for each interpreter setting, allocations
+    of their readouts with and without zero copy and time and copies of the
+    image processing of one reading.
+
+    Args:
+        config (Config): Configuration.
+        process_image (Callable[[], ImageProcessor]): Image processing of one
+        reading of the configured image source.
+
+    Returns:
+        Dict[str, Any]: Results by measurement, as dictionaries.
+    """
+    latency = []
+    for params in [config.digital_readout, config.analog_readout]:
+        if params.enabled:
+            latency += benchmark_latency(
+                params.model_file, batch_size=max(1, len(params.cut_images))
+            )
+
+    allocations: List[AllocationResult] = []
+    for zero_copy in [False, True]:
+        digitizer = (
+            DigitizerProcessor()
+            .init_analog_model(
+                config.analog_readout.model_file,
+                config.analog_readout.model,
+                options=get_interpreter_options(config.analog_readout),
+                zero_copy=zero_copy,
+            )
+            .init_digital_model(
+                config.digital_readout.model_file,
+                config.digital_readout.model,
+                options=get_interpreter_options(config.digital_readout),
+                zero_copy=zero_copy,
+            )
+        )
+        for params, reader in [
+            (config.digital_readout, digitizer.digital_counter_reader),
+            (config.analog_readout, digitizer.analog_counter_reader),
+        ]:
+            if params.enabled and reader is not None:
+                allocations.append(measure_readout_allocations(params, reader))
+
+    pipeline = measure_image_pipeline(config, process_image)
+    return {
+        "latency": [asdict(result) for result in latency],
+        "allocations": [asdict(result) for result in allocations],
+        "pipeline": asdict(pipeline),
+    }
+
+
+def measure_image_pipeline(
+    config: Config, process_image: Callable[[], ImageProcessor]
+) -> PipelineBenchmarkResult:
+    """
+    Time and image copies of the image processing of one reading, from the
+    download to the cut images of all positions.
+    """
+    positions = config.digital_readout.cut_images + config.analog_readout.cut_images
+
+    def process() -> np.ndarray:
+        image = process_image().get_image_for_cutting()
+        return utils.image.cut_images_to_array(image, positions, 32, 32)
+
+    frame = process_image().get_image_as_np_array()
+    return benchmark_pipeline("image pipeline", process, frame.nbytes)
+
+
+def run_model_benchmark(
+    config: Config,
+    process_image: Callable[[str], ImageProcessor],
+    frames_dir: str = "",
+) -> List[ModelBenchmarkResult]:
+    """
+    Compare all models in the model directories on the processed images of
+    the frames directory or the configured image source, see
+    cnn.benchmark.benchmark_model_dirs.
+    """
+    urls = get_benchmark_urls(config.image_source.url, frames_dir)
+    frames = [process_image(url).get_image_as_np_array() for url in urls]
+    return benchmark_model_dirs(config, frames)
+
+
+def run_alignment_benchmark(
+    config: Config, frames_dir: str = ""
+) -> List[AlignmentBenchmarkResult]:
+    """
+    Compare the alignment modes on the rotated images of the frames directory
+    or the configured image source, see benchmark_alignment.
+    """
+    source = config.image_source
+    frames = [
+        ImageProcessor()
+        .download_image(url, source.timeout, source.min_size)
+        .rotate_image(config.alignment.rotate_angle)
+        .get_image_as_np_array()
+        for url in get_benchmark_urls(source.url, frames_dir)
+    ]
+    return benchmark_alignment(
+        frames,
+        config.alignment.ref_images,
+        search_windows=sorted({0, config.alignment.search_window}),
+        min_confidence=config.alignment.min_confidence,
+        phase_min_response=config.alignment.phase_min_response,
+        phase_rotation=config.alignment.phase_rotation,
+    )
+
+
+def _benchmark_phase(
+    frames: Sequence[np.ndarray],
+    reference_images: List[RefImage],
+    expected: List[np.ndarray],
+    min_confidence: float,
+    iterations: int,
+    min_response: float,
+    rotation: bool,
+) -> AlignmentBenchmarkResult:
+    targets = np.float32([(ref.x, ref.y) for ref in reference_images])  # type: ignore
+    reference = utils.image.PhaseReference()
+    reference.put(
+        frames[0],
+        reference_images,
+        cv2.getAffineTransform(np.float32(expected[0]), targets),  # type: ignore
+    )
+    times = []
+    errors = []
+    fallbacks = 0
+    for frame, positions in zip(frames, expected):
+        for _ in range(iterations):
+            start_time = time.perf_counter()
+            M = reference.get(frame, reference_images, min_response, rotation)
+            if M is None:
+                utils.image.find_reference_coordinates(
+                    frame, reference_images, min_confidence=min_confidence
+                )
+            times.append(time.perf_counter() - start_time)
+        if M is None:
+            fallbacks += 1
+            errors.append(0.0)
+            continue
+        # reference positions in the frame which are mapped to their targets
+        inverse = np.linalg.inv(np.vstack([M, [0, 0, 1]]))
+        found = (inverse[:2, :2] @ targets.T).T + inverse[:2, 2]
+        errors += list(np.hypot(*(found - positions).T))
+    result = AlignmentBenchmarkResult(
+        mode=utils.image.ALIGNMENT_MODE_PHASE,
+        pyramid_levels=0,
+        search_window=0,
+        images=len(frames),
+        mean_ms=float(np.mean(times)) * 1000,
+        p50_ms=float(np.percentile(times, 50)) * 1000,
+        max_ms=float(np.max(times)) * 1000,
+        mean_error_px=float(np.mean(errors)),
+        max_error_px=float(np.max(errors)),
+        fallbacks=fallbacks,
+    )
+    logger.debug(f"Alignment benchmark result: {result}")
+    return result
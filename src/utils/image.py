@@ -1,78 +1,649 @@
 import base64
+from dataclasses import dataclass
+import functools
 import io
-from typing import List, Union
+import logging
+import os
+import threading
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 from PIL.Image import Image
 import PIL.Image
-import PIL.ImageEnhance
-from PIL import ImageOps, ImageDraw, ImageFont
+from PIL import ImageDraw, ImageFont
 import numpy as np
 import cv2
 
 from data_classes import ImagePosition, RefImage
 
+logger = logging.getLogger(__name__)
 
-def save_image(image: Image, file_name: str) -> None:
+
+@dataclass
+class _Template:
+    mtime: float
+    size: int
+    image: np.ndarray
+
+
+class TemplateCache:
+    """
+    Cache for the reference images used by align. Every reference image is
+    decoded once and decoded again when the file modification time or size
+    changes, e.g. after the setup has saved new reference images.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._templates: Dict[Tuple[str, bool, float], _Template] = {}
+
+    def get(
+        self, file_name: str, grayscale: bool = False, scale: float = 1.0
+    ) -> np.ndarray:
+        """
+        Get reference image.
+
+        Args:
+            file_name (str): Path of the reference image.
+            grayscale (bool, optional): Return single channel image. Defaults to
+            False, which returns the image in BGR order like cv2.imread.
+            scale (float, optional): Scale of the image it is searched in, the
+            reference image is downscaled by the same factor. Defaults to 1.0.
+
+        Returns:
+            np.ndarray: Read only reference image.
+        """
+        path = os.path.realpath(file_name)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise ValueError(f"Reference image '{file_name}' not found") from e
+        key = (path, grayscale, scale)
+        with self._lock:
+            template = self._templates.get(key)
+            if (
+                template is None
+                or template.mtime != stat.st_mtime
+                or template.size != stat.st_size
+            ):
+                image = cv2.imread(path)
+                if image is None:
+                    raise ValueError(f"Failed to load reference image '{file_name}'")
+                if grayscale:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                if scale != 1.0:
+                    # scaled by the factor, not to a rounded size
+                    image = cv2.resize(
+                        image,
+                        None,
+                        fx=scale,
+                        fy=scale,
+                        interpolation=cv2.INTER_AREA,
+                    )
+                image.flags.writeable = False
+                template = _Template(stat.st_mtime, stat.st_size, image)
+                self._templates[key] = template
+                logger.debug(f"Reference image '{path}' loaded")
+            return template.image
+
+    def clear(self) -> None:
+        with self._lock:
+            self._templates.clear()
+
+
+template_cache = TemplateCache()
+
+
+@dataclass
+class _CachedTransform:
+    key: Tuple
+    coordinates: List[Tuple[int, int]]
+    matrix: np.ndarray
+    age: int = 0
+
+
+class TransformCache:
+    """
+    Last alignment transform. As long as every reference image is still found
+    at the same position the transform is reused, which is verified by
+    matching the reference images only at their previous positions.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._transform: Optional[_CachedTransform] = None
+
+    def get(
+        self,
+        data: np.ndarray,
+        reference_images: List[RefImage],
+        max_age: int,
+        min_confidence: float,
+        scale: float = 1.0,
+    ) -> Optional[np.ndarray]:
+        """
+        Get the cached transform if it is still valid for the image.
+
+        Args:
+            data (np.ndarray): Image to align.
+            reference_images (List[RefImage]): Reference images.
+            max_age (int): Number of times the transform is reused before the
+            reference images are searched again.
+            min_confidence (float): Minimum match score of every reference
+            image at its previous position.
+            scale (float, optional): Scale of the image, see
+            find_reference_coordinates. Defaults to 1.0.
+
+        Returns:
+            Optional[np.ndarray]: Affine transform, None if the reference
+            images need to be searched.
+        """
+        with self._lock:
+            cached = self._transform
+        if cached is None or cached.key != _alignment_key(data, reference_images):
+            return None
+        if cached.age >= max_age:
+            logger.debug(f"Alignment transform reached max age {max_age}")
+            return None
+        scores = [
+            _verify_ref_coordinate(
+                data, template_cache.get(ref.file_name, scale=scale), point
+            )
+            for ref, point in zip(reference_images, cached.coordinates)
+        ]
+        score = min(scores, default=0.0)
+        if score < min_confidence:
+            logger.debug(
+                f"Alignment transform verification failed, scores: "
+                f"{[round(score, 3) for score in scores]}"
+            )
+            return None
+        with self._lock:
+            cached.age += 1
+        logger.debug(
+            f"Reuse alignment transform {cached.matrix.tolist()}, "
+            f"age: {cached.age}, verification score: {score:.3f}"
+        )
+        return cached.matrix
+
+    def put(
+        self,
+        data: np.ndarray,
+        reference_images: List[RefImage],
+        coordinates: List[Tuple[int, int]],
+        matrix: np.ndarray,
+    ) -> None:
+        with self._lock:
+            self._transform = _CachedTransform(
+                _alignment_key(data, reference_images), coordinates, matrix
+            )
+        logger.debug(f"Alignment transform {matrix.tolist()} cached")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._transform = None
+
+
+def _alignment_key(data: np.ndarray, reference_images: List[RefImage]) -> Tuple:
+    return data.shape, reference_images_key(reference_images)
+
+
+def reference_images_key(reference_images: List[RefImage]) -> Tuple:
+    # new reference image files invalidate cached alignments
+    return tuple(
+        (ref.file_name, ref.x, ref.y, os.stat(ref.file_name).st_mtime)
+        for ref in reference_images
+    )
+
+
+transform_cache = TransformCache()
+
+
+@dataclass
+class _PhaseFrame:
+    key: Tuple
+    image: np.ndarray
+    spectrum: np.ndarray
+    matrix: np.ndarray
+
+
+class PhaseReference:
+    """
+    Reference frame for the phase correlation alignment. The last image which
+    was aligned with the reference images is stored in gray together with its
+    transform. The drift of later images to it is estimated with phase
+    correlation, a translation and optionally rotation and scale estimated
+    from the log-polar transformed magnitude spectra, and composed with the
+    stored transform. A low phase correlation response means the image
+    differs too much from the reference frame and the reference images have
+    to be searched.
+    """
+
+    # size of the square image and number of angles used for the log-polar
+    # transform, the rotation resolution is about 0.2 degrees
+    _spectrum_size = 256
+    _spectrum_angles = 720
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._frame: Optional[_PhaseFrame] = None
+
+    def get(
+        self,
+        data: np.ndarray,
+        reference_images: List[RefImage],
+        min_response: float,
+        rotation: bool = False,
+    ) -> Optional[np.ndarray]:
+        """
+        Estimate the alignment transform from the drift of the image to the
+        reference frame.
+
+        Args:
+            data (np.ndarray): Image to align.
+            reference_images (List[RefImage]): Reference images.
+            min_response (float): Minimum phase correlation response (0-1).
+            rotation (bool, optional): Estimate rotation and scale in addition
+            to the translation. Defaults to False.
+
+        Returns:
+            Optional[np.ndarray]: Affine transform, None if there is no
+            reference frame or the response is below min_response.
+        """
+        with self._lock:
+            frame = self._frame
+        if frame is None or frame.key != _alignment_key(data, reference_images):
+            return None
+        gray = self._gray(data)
+        h, w = gray.shape
+        M = np.eye(3)
+        if rotation:
+            (shift_x, shift_y), response = cv2.phaseCorrelate(
+                frame.spectrum, self._log_polar_spectrum(gray)
+            )
+            # the magnitude spectrum is symmetric, angles are found modulo 180
+            angle = (-shift_y * 360 / self._spectrum_angles + 90) % 180 - 90
+            radius = self._spectrum_size / 2
+            scale = np.exp(-shift_x * np.log(radius) / self._spectrum_size)
+            angle, scale = round(angle, 2), round(scale, 4)
+            logger.debug(
+                f"Phase correlation rotation: {angle:.2f}, scale: {scale:.4f}, "
+                f"response: {response:.3f}"
+            )
+            M[:2] = cv2.getRotationMatrix2D(
+                ((w - 1) / 2, (h - 1) / 2), -angle, 1 / scale
+            )
+            gray = cv2.warpAffine(gray, M[:2], (w, h))
+        # OpenCV applies the window in place to the inputs of phaseCorrelate
+        (dx, dy), response = cv2.phaseCorrelate(
+            frame.image, gray * _hanning_window(w, h)
+        )
+        if response < min_response:
+            logger.debug(
+                f"Phase correlation response {response:.3f} below {min_response}"
+            )
+            return None
+        # the estimation is not more accurate, without drift the transform of
+        # the reference frame is used as it is
+        dx, dy = round(dx, 2), round(dy, 2)
+        # maps the image to the reference frame and then to the aligned image
+        shift = np.eye(3)
+        shift[:2, 2] = [-dx, -dy]
+        M = frame.matrix @ shift @ M
+        logger.debug(
+            f"Phase correlation drift: ({dx:.2f}, {dy:.2f}), "
+            f"response: {response:.3f}"
+        )
+        return M[:2]
+
+    def put(
+        self, data: np.ndarray, reference_images: List[RefImage], matrix: np.ndarray
+    ) -> None:
+        """
+        Store the image as reference frame.
+
+        Args:
+            data (np.ndarray): Image which was aligned.
+            reference_images (List[RefImage]): Reference images.
+            matrix (np.ndarray): Affine transform which aligns the image.
+        """
+        gray = self._gray(data)
+        h, w = gray.shape
+        frame = _PhaseFrame(
+            _alignment_key(data, reference_images),
+            gray * _hanning_window(w, h),
+            self._log_polar_spectrum(gray),
+            np.vstack([matrix, [0, 0, 1]]),
+        )
+        with self._lock:
+            self._frame = frame
+        logger.debug("Phase correlation reference frame stored")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frame = None
+
+    def _gray(self, data: np.ndarray) -> np.ndarray:
+        return cv2.cvtColor(data, cv2.COLOR_RGB2GRAY).astype(np.float32)
+
+    def _log_polar_spectrum(self, gray: np.ndarray) -> np.ndarray:
+        # rotation of the image rotates the spectrum only if it is square
+        n = self._spectrum_size
+        h, w = gray.shape
+        size = min(w, h)
+        top, left = (h - size) // 2, (w - size) // 2
+        square = cv2.resize(
+            gray[top : top + size, left : left + size],
+            (n, n),
+            interpolation=cv2.INTER_AREA,
+        )
+        spectrum = np.abs(np.fft.fftshift(np.fft.fft2(square * _hanning_window(n, n))))
+        spectrum = spectrum.astype(np.float32) * _high_pass_filter(n)
+        return cv2.warpPolar(
+            spectrum,
+            (n, self._spectrum_angles),
+            (n / 2, n / 2),
+            n / 2,
+            cv2.WARP_POLAR_LOG | cv2.INTER_LINEAR,
+        )
+
+
+@functools.lru_cache(maxsize=4)
+def _hanning_window(width: int, height: int) -> np.ndarray:
+    return cv2.createHanningWindow((width, height), cv2.CV_32F)
+
+
+@functools.lru_cache(maxsize=2)
+def _high_pass_filter(size: int) -> np.ndarray:
+    # suppresses the low frequencies which dominate the magnitude spectrum
+    freq = np.linspace(-0.5, 0.5, size, endpoint=False)
+    c = np.cos(np.pi * freq)[:, np.newaxis] * np.cos(np.pi * freq)
+    return ((1 - c) * (2 - c)).astype(np.float32)
+
+
+phase_reference = PhaseReference()
+
+
+class WarpedImage:
+    """
+    Affine transform of an image whose pixels are computed on demand. Crop is
+    composed into the transform, cutting images samples only the cut areas
+    from the source image. The whole transformed image is computed once when
+    data is accessed, e.g. to resize it.
+    """
+
+    def __init__(
+        self,
+        source: np.ndarray,
+        matrix: np.ndarray,
+        size: Tuple[int, int],
+        bounds: Optional[Tuple[int, int, int, int]] = None,
+    ) -> None:
+        """
+        Args:
+            source (np.ndarray): RGB image to transform.
+            matrix (np.ndarray): 3x3 matrix which maps pixel coordinates of the
+            source image to pixel coordinates of the transformed image.
+            size (Tuple[int, int]): Size (width, height) of the transformed
+            image.
+            bounds (Tuple[int, int, int, int], optional): Area (x0, y0, x1, y1)
+            of the transformed image inside the image it was cropped from,
+            pixels outside of it are black like in PIL crop. Defaults to None,
+            the whole image.
+        """
+        self.source = source
+        self.matrix = matrix
+        self.size = size
+        self.bounds = bounds or (0, 0, size[0], size[1])
+
+    @functools.cached_property
+    def data(self) -> np.ndarray:
+        data = cv2.warpAffine(self.source, self.matrix[:2], self.size)
+        x0, y0, x1, y1 = self.bounds
+        if (x0, y0, x1, y1) != (0, 0) + tuple(self.size):
+            data[:, : max(0, x0)] = 0
+            data[:, max(0, x1) :] = 0
+            data[: max(0, y0)] = 0
+            data[max(0, y1) :] = 0
+        return data
+
+    def crop(self, x: int, y: int, w: int, h: int) -> "WarpedImage":
+        shift = np.eye(3)
+        shift[:2, 2] = [-x, -y]
+        x0, y0, x1, y1 = self.bounds
+        bounds = (max(0, x0 - x), max(0, y0 - y), min(w, x1 - x), min(h, y1 - y))
+        return WarpedImage(self.source, shift @ self.matrix, (w, h), bounds)
+
+    def resized_source_data(self, width: int, height: int) -> np.ndarray:
+        """
+        Transformed image to resize to the given size. If the source image has
+        a lower resolution than the transformed image, e.g. an image decoded at
+        reduced size, the image is computed at the resolution of the source or
+        at the given size if that is larger, instead of at its full size.
+        """
+        # transformed pixels per source pixel, 2, 4 or 8 for reduced decoding
+        density = np.sqrt(abs(np.linalg.det(self.matrix[:2, :2])))
+        if density < 2 or self.bounds != (0, 0) + tuple(self.size):
+            return self.data
+        size = (
+            min(self.size[0], max(width, round(self.size[0] / density))),
+            min(self.size[1], max(height, round(self.size[1] / density))),
+        )
+        matrix = _scale_matrix(self.size, size) @ self.matrix
+        return WarpedImage(self.source, matrix, size).data
+
+    def cut_images_to_array(
+        self,
+        positions: Sequence[ImagePosition],
+        width: int,
+        height: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Cut the given positions from the image and resize every cut image to
+        the given size. Every cut image is sampled from the source image with a
+        single remap, at the same pixels cut_images_to_array samples from the
+        whole transformed image.
+        """
+        if out is None:
+            out = np.empty((len(positions), height, width, 3), dtype=np.uint8)
+        pixels = out if out.dtype == np.uint8 else _scratch_buffer(out.shape)
+        inverse = np.linalg.inv(self.matrix)
+        for i, pos in enumerate(positions):
+            xs = pos.x + _nearest_indices(pos.w, width)
+            ys = pos.y + _nearest_indices(pos.h, height)
+            map_x = inverse[0, 0] * xs + inverse[0, 1] * ys[:, np.newaxis]
+            map_y = inverse[1, 0] * xs + inverse[1, 1] * ys[:, np.newaxis]
+            map_x += inverse[0, 2]
+            map_y += inverse[1, 2]
+            # areas outside of the transformed image are black like in PIL crop
+            x0, y0, x1, y1 = self.bounds
+            outside = (xs < x0) | (xs >= x1) | (ys[:, np.newaxis] < y0)
+            outside |= ys[:, np.newaxis] >= y1
+            map_x[outside] = -2
+            cv2.remap(
+                self.source,
+                map_x.astype(np.float32),
+                map_y.astype(np.float32),
+                cv2.INTER_LINEAR,
+                dst=pixels[i],
+            )
+        if pixels is not out:
+            np.copyto(out, pixels, casting="unsafe")
+        return out
+
+
+def _scale_matrix(size: Tuple[int, int], new_size: Tuple[int, int]) -> np.ndarray:
+    # resizing maps the pixel centers, the center of the top left pixel is (0, 0)
+    sx, sy = new_size[0] / size[0], new_size[1] / size[1]
+    return np.array([[sx, 0, (sx - 1) / 2], [0, sy, (sy - 1) / 2], [0, 0, 1]])
+
+
+def save_image(image: Union[Image, np.ndarray], file_name: str) -> None:
     if image is None:
         raise ValueError("No image to save")
-    if isinstance(image, Image):
-        Image.save(image, file_name, "JPEG")
-    elif isinstance(image, np.ndarray):
-        cv2.imwrite(file_name, image)
+    convert_to_image(image).save(file_name, "JPEG")
 
 
 def load_image_from_file(file_name: str) -> Image:
     return PIL.Image.open(file_name)
 
 
-def bytes_to_image(data: bytes) -> Image:
-    image = PIL.Image.open(io.BytesIO(data))
-    if image.format not in ["JPEG", "PNG"]:
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def bytes_to_image(data: bytes, reduction: int = 1) -> np.ndarray:
+    """
+    Decode a JPEG or PNG image.
+
+    Args:
+        data (bytes): Encoded image.
+        reduction (int, optional): Decode the image at 1/2, 1/4 or 1/8 of its
+        size. JPEG images are scaled while they are decoded, which is faster
+        than decoding the whole image. Defaults to 1.
+
+    Returns:
+        np.ndarray: RGB image of shape (height, width, 3). The pixels are equal
+        to the ones PIL decodes, the EXIF orientation is ignored like PIL does.
+    """
+    if reduction not in _DECODE_FLAGS:
+        raise ValueError(f"Invalid reduction {reduction}")
+    if not data.startswith((b"\xff\xd8", b"\x89PNG\r\n\x1a\n")):
         raise ValueError("Invalid image format")
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-    return image
+    image = cv2.imdecode(
+        np.frombuffer(data, dtype=np.uint8),
+        _DECODE_FLAGS[reduction] | cv2.IMREAD_IGNORE_ORIENTATION,
+    )
+    if image is None:
+        raise ValueError("Invalid image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 
-def convert_image_base64str(image: Image) -> str:
+def bytes_to_reduced_image(
+    data: bytes, required_scale: Callable[[Tuple[int, int]], float]
+) -> Union[np.ndarray, "WarpedImage"]:
+    """
+    Decode a JPEG image at the smallest size which still has the required
+    resolution. The largest reduction of 1/2, 1/4 and 1/8 whose scale is not
+    below the required scale is used. Other images are decoded at full size.
+
+    Args:
+        data (bytes): Encoded image.
+        required_scale (Callable[[Tuple[int, int]], float]): Function which
+        returns the lowest scale (0-1) of the image needed by the later
+        processing steps for the size (width, height) of the image.
+
+    Returns:
+        np.ndarray | WarpedImage: Image of full size, the reduced image is
+        returned as transform to full size whose pixels are computed on demand.
+        The coordinates of the image stay the same, rotate_and_align searches
+        the reference images at the resolution of the reduced image.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return bytes_to_image(data)
+    # reads only the header of the image
+    size = PIL.Image.open(io.BytesIO(data)).size
+    scale = required_scale(size)
+    reduction = next(
+        (reduction for reduction in (8, 4, 2) if scale * reduction <= 1), 1
+    )
+    if reduction == 1:
+        return bytes_to_image(data)
+    reduced = bytes_to_image(data, reduction)
+    h, w = reduced.shape[:2]
+    logger.debug(f"Image of size {size} decoded at size {(w, h)}")
+    return WarpedImage(reduced, _scale_matrix((w, h), size), size)
+
+
+def convert_image_base64str(image: Union[Image, np.ndarray, "WarpedImage"]) -> str:
     data = convert_image_to_bytes(image)
     return base64.b64encode(data).decode("utf-8")
 
 
-def convert_image_to_bytes(image: Image) -> bytes:
+def convert_image_to_bytes(image: Union[Image, np.ndarray, "WarpedImage"]) -> bytes:
     if image is None:
         raise ValueError("No image to convert")
-    if isinstance(image, Image):
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        return buffered.getvalue()
-    elif isinstance(image, np.ndarray):
-        is_success, im_buf_arr = cv2.imencode(".jpg", image)
-        return im_buf_arr.tobytes()
-    else:
-        raise ValueError("Invalid image")
+    return encode_image(image)
+
+
+# media types of the formats supported by encode_image
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+def encode_image(
+    image: Union[Image, np.ndarray, "WarpedImage"],
+    format: str = "jpeg",
+    quality: Optional[int] = None,
+    width: int = 0,
+) -> bytes:
+    """
+    Encode the image.
+
+    Args:
+        image (Image | np.ndarray | WarpedImage): Image to encode.
+        format (str, optional): Format, one of IMAGE_FORMATS. Defaults to
+        "jpeg".
+        quality (int, optional): Quality (1-100) of JPEG and WebP images.
+        Defaults to None, which uses the default quality of PIL.
+        width (int, optional): Width of a downscaled image with the same aspect
+        ratio. Defaults to 0, which keeps the size. Images are not enlarged.
+
+    Returns:
+        bytes: Encoded image.
+    """
+    if format not in IMAGE_FORMATS:
+        raise ValueError(f"Invalid image format {format}")
+    w, h = image_size(image)
+    if 0 < width < w:
+        image = resize_image(image, width, max(1, round(h * width / w)))
+    params = {} if quality is None else {"quality": quality}
+    buffered = io.BytesIO()
+    convert_to_image(image).save(buffered, format=format.upper(), **params)
+    return buffered.getvalue()
 
 
-def convert_base64_str_to_image(data: str) -> Image:
+def convert_base64_str_to_image(data: str, reduction: int = 1) -> np.ndarray:
     if data is None:
         raise ValueError("No image to convert")
 
-    return bytes_to_image(base64.b64decode(data))
+    return bytes_to_image(base64.b64decode(data), reduction)
 
 
-def convert_to_image(image: Image) -> Image:
+def convert_to_image(image: Union[Image, np.ndarray, "WarpedImage"]) -> Image:
+    """
+    Convert the image to a PIL image, e.g. to draw on it or to encode it.
+    """
     if isinstance(image, Image):
         return image
+    elif isinstance(image, WarpedImage):
+        return PIL.Image.fromarray(image.data)
     elif isinstance(image, np.ndarray):
-        return Image.fromarray(image)
+        return PIL.Image.fromarray(image)
     else:
         raise ValueError("Invalid image")
 
 
-def convert_image_to_np_array(image: Image) -> np.ndarray:
+def convert_image_to_np_array(
+    image: Union[Image, np.ndarray, "WarpedImage"],
+) -> np.ndarray:
     if isinstance(image, Image):
         return np.array(image)
     elif isinstance(image, np.ndarray):
         return image
+    elif isinstance(image, WarpedImage):
+        return image.data
     else:
         raise ValueError("Invalid image")
 
@@ -86,9 +657,11 @@ def convert_np_array_to_image(data: np.ndarray) -> Image:
         raise ValueError("Invalid image")
 
 
-def image_size(image: Image) -> tuple:
+def image_size(image: Union[Image, np.ndarray, "WarpedImage"]) -> tuple:
     if image is None:
         raise ValueError("No image for size check")
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
     return image.size
 
 
@@ -97,39 +670,513 @@ def image_size_from_file(file_name: str) -> tuple:
     return image.size
 
 
-def rotate(image: Image, angle: float, keep_org_size: bool = True) -> Image:
+def image_size_from_base64_str(data: str) -> tuple:
+    # reads only the header of the image
+    image = PIL.Image.open(io.BytesIO(base64.b64decode(data)))
+    return image.size
+
+
+def rotate(
+    image: Union[Image, np.ndarray], angle: float, keep_org_size: bool = True
+) -> np.ndarray:
     if image is None:
         raise ValueError("No image to rotate")
 
-    expand = not keep_org_size
-    return image.rotate(angle, expand=expand)
+    data = convert_image_to_np_array(image)
+    return rotate_array(data, angle, expand=not keep_org_size)[0]
+
+
+def rotation_matrix(
+    width: int, height: int, angle: float, expand: bool = True
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Affine matrix of rotate, i.e. of PIL's Image.rotate around the image
+    center.
+
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+        angle (float): Counter clockwise rotation in degrees.
+        expand (bool, optional): Enlarge the output image to hold the whole
+        rotated image. Defaults to True.
 
+    Returns:
+        Tuple[np.ndarray, Tuple[int, int]]: 3x3 matrix which maps pixel
+        coordinates of the image to pixel coordinates of the rotated image and
+        the size (width, height) of the rotated image.
+    """
+    angle = angle % 360.0
+    if angle % 90 == 0 and (expand or angle == 180 or width == height):
+        # transposed by PIL, the pixels are moved without resampling
+        cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(angle) // 90]
+        size = (width, height) if angle in (0, 180) else (height, width)
+        center = np.array([(width - 1) / 2, (height - 1) / 2])
+        new_center = np.array([(size[0] - 1) / 2, (size[1] - 1) / 2])
+        matrix = np.eye(3)
+        matrix[:2, :2] = [[cos, sin], [-sin, cos]]
+        matrix[:2, 2] = new_center - matrix[:2, :2] @ center
+        return matrix, size
 
-def align(image: Image, reference_images: List[RefImage]) -> Image:
+    # inverse matrix in the same way PIL computes it, PIL's coordinates are
+    # those of the pixel edges
+    radians = -np.deg2rad(angle)
+    a, b = round(float(np.cos(radians)), 15), round(float(np.sin(radians)), 15)
+    inverse = np.array([[a, b, 0.0], [-b, a, 0.0], [0.0, 0.0, 1.0]])
+    inverse[:2, 2] = inverse[:2, :2] @ [-width / 2, -height / 2] + [
+        width / 2,
+        height / 2,
+    ]
+    size = (width, height)
+    if expand:
+        corners = np.array(
+            [[0, 0, 1], [width, 0, 1], [width, height, 1], [0, height, 1]]
+        )
+        xx, yy = (inverse[:2] @ corners.T).tolist()
+        size = (
+            int(np.ceil(max(xx)) - np.floor(min(xx))),
+            int(np.ceil(max(yy)) - np.floor(min(yy))),
+        )
+        inverse[:2, 2] = inverse[:2] @ [
+            -(size[0] - width) / 2,
+            -(size[1] - height) / 2,
+            1,
+        ]
+    # pixel centers are at (x + 0.5, y + 0.5) in PIL's coordinates
+    shift = np.eye(3)
+    shift[:2, 2] = 0.5
+    matrix = np.linalg.inv(np.linalg.inv(shift) @ inverse @ shift)
+    return matrix, size
+
+
+def rotate_array(
+    data: np.ndarray, angle: float, expand: bool = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rotate the image like PIL's Image.rotate does. Rotations by multiples of
+    90 degrees are lossless.
+
+    Args:
+        data (np.ndarray): Image to rotate.
+        angle (float): Counter clockwise rotation in degrees.
+        expand (bool, optional): Enlarge the output image to hold the whole
+        rotated image. Defaults to True.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Rotated image and the 3x3 matrix which
+        maps pixel coordinates of data to pixel coordinates of the rotated
+        image.
+    """
+    h, w = data.shape[:2]
+    matrix, size = rotation_matrix(w, h, angle, expand)
+    if angle % 90 == 0 and (expand or angle % 180 == 0 or w == h):
+        rotated = np.rot90(data, int(angle % 360) // 90)
+        return np.ascontiguousarray(rotated), matrix
+    # nearest neighbour resampling like PIL's Image.rotate
+    rotated = cv2.warpAffine(data, matrix[:2], size, flags=cv2.INTER_NEAREST)
+    return rotated, matrix
+
+
+ALIGNMENT_MODE_FULL = "full"
+ALIGNMENT_MODE_PYRAMID = "pyramid"
+ALIGNMENT_MODE_PHASE = "phase"
+
+
+def align(
+    image: Union[Image, np.ndarray],
+    reference_images: List[RefImage],
+    search_window: int = 0,
+    min_confidence: float = 0.8,
+    mode: str = ALIGNMENT_MODE_FULL,
+    pyramid_levels: int = 2,
+    reuse_transform: bool = False,
+    max_transform_age: int = 10,
+    phase_min_response: float = 0.3,
+    phase_rotation: bool = False,
+) -> np.ndarray:
+    """
+    Align the image to the reference images.
+
+    Args:
+        image (Image | np.ndarray): Image to align.
+        reference_images (List[RefImage]): Reference images and their
+        positions in the aligned image.
+        search_window (int, optional): Search the reference images only this
+        many pixels around their positions. The whole image is searched if the
+        best match in the window is below min_confidence. Defaults to 0, which
+        searches the whole image.
+        min_confidence (float, optional): Minimum normalized correlation of a
+        match in the search window. Defaults to 0.8.
+        mode (str, optional): How the whole image is searched, "full" matches
+        the reference images on the full resolution image, "pyramid" locates
+        them on a downscaled gray image first and refines the position on the
+        full resolution image. "phase" estimates the transform to the last
+        aligned image with phase correlation, see PhaseReference, and matches
+        the reference images on the full resolution image if the phase
+        correlation response is too low. Defaults to "full".
+        pyramid_levels (int, optional): Number of times the image is halved in
+        pyramid mode. Defaults to 2.
+        reuse_transform (bool, optional): Reuse the transform of the previous
+        image as long as the reference images are found at the same positions,
+        see TransformCache. Defaults to False.
+        max_transform_age (int, optional): Search the reference images again
+        after the transform was reused this many times. Defaults to 10.
+        phase_min_response (float, optional): Minimum phase correlation
+        response in phase mode. Defaults to 0.3.
+        phase_rotation (bool, optional): Estimate rotation and scale in phase
+        mode in addition to the translation. Defaults to False.
+
+    Returns:
+        np.ndarray: Aligned RGB image of the same size as the image.
+    """
     if image is None:
         raise ValueError("No image to align")
     data = convert_image_to_np_array(image)
-    w, h = image.size
+    h, w = data.shape[:2]
+
+    M = alignment_matrix(
+        data,
+        reference_images,
+        search_window,
+        min_confidence,
+        mode,
+        pyramid_levels,
+        reuse_transform,
+        max_transform_age,
+        phase_min_response,
+        phase_rotation,
+    )
+    return cv2.warpAffine(data, M, (w, h))
+
+
+def rotate_and_align(
+    image: Union[Image, np.ndarray, "WarpedImage"],
+    rotate_angle: float,
+    reference_images: List[RefImage],
+    post_rotate_angle: float = 0,
+    search_window: int = 0,
+    min_confidence: float = 0.8,
+    mode: str = ALIGNMENT_MODE_FULL,
+    pyramid_levels: int = 2,
+    reuse_transform: bool = False,
+    max_transform_age: int = 10,
+    phase_min_response: float = 0.3,
+    phase_rotation: bool = False,
+    intermediates: Optional[Dict[str, np.ndarray]] = None,
+) -> "WarpedImage":
+    """
+    Rotate, align and rotate the image again like rotate (keep_org_size=False),
+    align and rotate do one after the other, but resample the image only once.
+    The rotation, the alignment and the post rotation are composed into a
+    single affine transform. Rotations by multiples of 90 degrees are done
+    losslessly before the reference images are searched. The pixels of the
+    transformed image are computed when they are accessed, see WarpedImage.
+
+    A WarpedImage which scales its source image, see bytes_to_reduced_image,
+    is aligned at the resolution of the source image. The reference images
+    and their positions are scaled to it, the alignment is less accurate than
+    at full size although the positions are refined to sub pixel accuracy.
 
-    ref_image_cordinates = [
-        _get_ref_coordinate(data, cv2.imread(reference_images[i].file_name))  # TODO
-        for i in range(len(reference_images))
+    Args:
+        image (Image | np.ndarray | WarpedImage): Image to transform.
+        rotate_angle (float): Counter clockwise rotation in degrees before
+        the alignment.
+        reference_images (List[RefImage]): Reference images and their
+        positions in the aligned image.
+        post_rotate_angle (float, optional): Counter clockwise rotation in
+        degrees after the alignment. Defaults to 0.
+        search_window, min_confidence, mode, pyramid_levels, reuse_transform,
+        max_transform_age, phase_min_response, phase_rotation: See align.
+        intermediates (Optional[Dict[str, np.ndarray]], optional): If given,
+        the "rotated", "aligned" and "post_rotated" images are stored in it.
+        This costs an additional resampling of the image. Defaults to None.
+
+    Returns:
+        WarpedImage: Transformed image.
+    """
+    if image is None:
+        raise ValueError("No image to align")
+    if isinstance(image, WarpedImage):
+        data, D, size = image.source, image.matrix, image.size
+        scale = data.shape[1] / size[0]
+    else:
+        data, D, scale = convert_image_to_np_array(image), None, 1.0
+    rotated, R = rotate_array(data, rotate_angle)
+    h, w = rotated.shape[:2]
+
+    A = np.eye(3)
+    A[:2] = alignment_matrix(
+        rotated,
+        reference_images,
+        search_window,
+        min_confidence,
+        mode,
+        pyramid_levels,
+        reuse_transform,
+        max_transform_age,
+        phase_min_response,
+        phase_rotation,
+        scale,
+    )
+    aligned = A
+    # maps the rotated image to the rotated image of full size
+    S = np.eye(3)
+    if D is not None:
+        R_full, (w_full, h_full) = rotation_matrix(*size, rotate_angle)
+        S = R_full @ D @ np.linalg.inv(R)
+        # the reference positions are those of the top left pixel edges, the
+        # reference positions in the aligned image are scaled from them
+        edge = np.eye(3)
+        edge[:2, 2] = 0.5
+        positions = edge @ S @ np.linalg.inv(edge)
+        A = np.diag([1 / scale, 1 / scale, 1.0]) @ A @ np.linalg.inv(positions)
+        R = R_full @ D
+    else:
+        w_full, h_full = w, h
+    P, size = rotation_matrix(w_full, h_full, post_rotate_angle)
+    if rotate_angle % 90 == 0:
+        # the lossless rotated image is the source of the transform
+        warped = WarpedImage(rotated, P @ A @ S, size)
+    else:
+        warped = WarpedImage(data, P @ A @ R, size)
+
+    if intermediates is not None:
+        intermediates["rotated"] = rotated
+        intermediates["aligned"] = cv2.warpAffine(rotated, aligned[:2], (w, h))
+        intermediates["post_rotated"] = warped.data
+    return warped
+
+
+def alignment_matrix(
+    data: np.ndarray,
+    reference_images: List[RefImage],
+    search_window: int = 0,
+    min_confidence: float = 0.8,
+    mode: str = ALIGNMENT_MODE_FULL,
+    pyramid_levels: int = 2,
+    reuse_transform: bool = False,
+    max_transform_age: int = 10,
+    phase_min_response: float = 0.3,
+    phase_rotation: bool = False,
+    scale: float = 1.0,
+) -> np.ndarray:
+    """
+    Find the affine transform which aligns the image to the reference images,
+    see align for the arguments. If the image is scaled, the reference
+    positions are scaled to it, see find_reference_coordinates.
+
+    Returns:
+        np.ndarray: 2x3 matrix which maps pixel coordinates of the image to
+        pixel coordinates of the aligned image.
+    """
+    M = (
+        transform_cache.get(
+            data, reference_images, max_transform_age, min_confidence, scale
+        )
+        if reuse_transform
+        else None
+    )
+    if M is None and mode == ALIGNMENT_MODE_PHASE:
+        M = phase_reference.get(
+            data, reference_images, phase_min_response, phase_rotation
+        )
+        if M is not None:
+            return M
+    if M is None:
+        ref_image_cordinates = find_reference_coordinates(
+            data,
+            reference_images,
+            search_window,
+            min_confidence,
+            ALIGNMENT_MODE_FULL if mode == ALIGNMENT_MODE_PHASE else mode,
+            pyramid_levels,
+            scale,
+        )
+        alignment_ref_pos = [
+            (
+                reference_images[i].x * scale,
+                reference_images[i].y * scale,
+            )
+            for i in range(len(reference_images))
+        ]
+        pts1 = np.float32(ref_image_cordinates)  # type: ignore
+        pts2 = np.float32(alignment_ref_pos)  # type: ignore
+        M = cv2.getAffineTransform(pts1, pts2)  # type: ignore
+        if reuse_transform:
+            transform_cache.put(
+                data,
+                reference_images,
+                [(round(x), round(y)) for x, y in ref_image_cordinates],
+                M,
+            )
+        if mode == ALIGNMENT_MODE_PHASE:
+            phase_reference.put(data, reference_images, M)
+    return M
+
+
+def find_reference_coordinates(
+    data: np.ndarray,
+    reference_images: List[RefImage],
+    search_window: int = 0,
+    min_confidence: float = 0.8,
+    mode: str = ALIGNMENT_MODE_FULL,
+    pyramid_levels: int = 2,
+    scale: float = 1.0,
+) -> List[Tuple[float, float]]:
+    """
+    Find the positions of the reference images in the image, see align. If
+    the image is scaled, e.g. decoded at reduced size, the reference images,
+    their positions and the search window are scaled by the same factor and
+    the positions are refined to sub pixel accuracy.
+    """
+    if mode not in [ALIGNMENT_MODE_FULL, ALIGNMENT_MODE_PYRAMID]:
+        raise ValueError(f"Unknown alignment mode '{mode}'")
+    pyramid = _Pyramid(data, pyramid_levels) if mode == ALIGNMENT_MODE_PYRAMID else None
+    if search_window > 0:
+        search_window = max(1, round(search_window * scale))
+    coordinates = [
+        _get_ref_coordinate(
+            data,
+            template_cache.get(ref.file_name, scale=scale),
+            (round(ref.x * scale), round(ref.y * scale)),
+            search_window,
+            min_confidence,
+            pyramid,
+            (
+                template_cache.get(ref.file_name, grayscale=True, scale=scale)
+                if pyramid
+                else None
+            ),
+        )
+        for ref in reference_images
     ]
-    alignment_ref_pos = [
-        (
-            reference_images[i].x,
-            reference_images[i].y,
+    if scale == 1.0:
+        return coordinates
+    return [
+        _refine_ref_coordinate(
+            data, template_cache.get(ref.file_name, scale=scale), point
         )
-        for i in range(len(reference_images))
+        for ref, point in zip(reference_images, coordinates)
     ]
-    pts1 = np.float32(ref_image_cordinates)  # type: ignore
-    pts2 = np.float32(alignment_ref_pos)  # type: ignore
-    M = cv2.getAffineTransform(pts1, pts2)  # type: ignore
-    img = cv2.warpAffine(data, M, (w, h))
-    return convert_np_array_to_image(img)
 
 
-def _get_ref_coordinate(image: np.ndarray, template: np.ndarray) -> tuple[int, int]:
+class _Pyramid:
+    """
+    Downscaled gray version of an image, created when it is used first.
+    """
+
+    def __init__(self, image: np.ndarray, levels: int) -> None:
+        self.image = image
+        self.levels = max(1, levels)
+        self._coarse: Optional[np.ndarray] = None
+
+    @property
+    def coarse(self) -> np.ndarray:
+        if self._coarse is None:
+            self._coarse = self.downscale(cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY))
+        return self._coarse
+
+    def downscale(self, image: np.ndarray) -> np.ndarray:
+        for _ in range(self.levels):
+            image = cv2.pyrDown(image)
+        return image
+
+    def match(
+        self, template: np.ndarray, template_gray: np.ndarray
+    ) -> Tuple[Tuple[int, int], float]:
+        coarse_template = self.downscale(template_gray)
+        if min(coarse_template.shape[:2]) < 4:
+            # too small to be found on the downscaled image
+            return _match_template(self.image, template)
+        point, _ = _match_template(self.coarse, coarse_template)
+        scale = 2**self.levels
+        result = _match_window(
+            self.image, template, (point[0] * scale, point[1] * scale), scale * 2
+        )
+        return result if result is not None else _match_template(self.image, template)
+
+
+def _get_ref_coordinate(
+    image: np.ndarray,
+    template: np.ndarray,
+    expected: Optional[Tuple[int, int]] = None,
+    search_window: int = 0,
+    min_confidence: float = 0.8,
+    pyramid: Optional[_Pyramid] = None,
+    template_gray: Optional[np.ndarray] = None,
+) -> Tuple[int, int]:
+    if expected is not None and search_window > 0:
+        result = _match_window(image, template, expected, search_window)
+        if result is not None and result[1] >= min_confidence:
+            return result[0]
+        logger.debug(
+            f"Reference match score {result[1] if result else 0:.3f} near "
+            f"{expected} below {min_confidence}, search whole image"
+        )
+    if pyramid is not None and template_gray is not None:
+        point, score = pyramid.match(template, template_gray)
+        if score >= min_confidence:
+            return point
+        logger.debug(
+            f"Reference match score {score:.3f} on image pyramid below "
+            f"{min_confidence}, search full resolution image"
+        )
+    point, _ = _match_template(image, template)
+    return point
+
+
+def _refine_ref_coordinate(
+    image: np.ndarray, template: np.ndarray, point: Tuple[int, int]
+) -> Tuple[float, float]:
+    # peak of parabolas through the match scores of the point and its
+    # neighbours
+    x, y = point
+    th, tw = template.shape[:2]
+    if x < 1 or y < 1 or x + tw >= image.shape[1] or y + th >= image.shape[0]:
+        return x, y
+    scores = cv2.matchTemplate(
+        image[y - 1 : y + th + 1, x - 1 : x + tw + 1], template, cv2.TM_CCOEFF_NORMED
+    )
+    return x + _parabola_peak(*scores[1]), y + _parabola_peak(*scores[:, 1])
+
+
+def _parabola_peak(left: float, center: float, right: float) -> float:
+    curvature = left - 2 * center + right
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip((left - right) / (2 * curvature), -0.5, 0.5))
+
+
+def _verify_ref_coordinate(
+    image: np.ndarray, template: np.ndarray, point: Tuple[int, int]
+) -> float:
+    # match score at the point, 0 if a neighbour pixel matches better
+    result = _match_window(image, template, point, 1)
+    if result is None or result[0] != tuple(point):
+        return 0.0
+    return result[1]
+
+
+def _match_window(
+    image: np.ndarray,
+    template: np.ndarray,
+    position: Tuple[int, int],
+    margin: int,
+) -> Optional[Tuple[Tuple[int, int], float]]:
+    # match the template only in the area margin pixels around the position
+    th, tw = template.shape[:2]
+    x0 = max(0, position[0] - margin)
+    y0 = max(0, position[1] - margin)
+    x1 = min(image.shape[1], position[0] + tw + margin)
+    y1 = min(image.shape[0], position[1] + th + margin)
+    if x1 - x0 < tw or y1 - y0 < th:
+        return None
+    point, score = _match_template(image[y0:y1, x0:x1], template)
+    return (point[0] + x0, point[1] + y0), score
+
+
+def _match_template(
+    image: np.ndarray, template: np.ndarray
+) -> Tuple[Tuple[int, int], float]:
     """
     Square difference (CV_TM_SQDIFF): This method calculates the squared difference
         between the pixel intensities of the source image and template.
@@ -152,8 +1199,9 @@ def _get_ref_coordinate(image: np.ndarray, template: np.ndarray) -> tuple[int, i
     method = cv2.TM_CCOEFF_NORMED
     res = cv2.matchTemplate(image, template, method)
     min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-    point = min_loc if method in [cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED] else max_loc
-    return (point[0], point[1])
+    if method in [cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED]:
+        return (min_loc[0], min_loc[1]), 1 - min_val
+    return (max_loc[0], max_loc[1]), max_val
 
 
 def draw_rectangle(
@@ -199,61 +1247,435 @@ def draw_text(
 
 
 def cut_image(
-    image: Image,
+    image: Union[Image, np.ndarray, WarpedImage],
     img_position: ImagePosition,
-) -> Image:
+) -> np.ndarray:
 
     if image is None:
         raise ValueError("No image to cut")
     x, y, w, h = img_position.x, img_position.y, img_position.w, img_position.h
-    return image.crop((x, y, x + w, y + h))
+    if isinstance(image, WarpedImage):
+        # sampled like the cut images which are read out
+        return image.cut_images_to_array([img_position], w, h)[0]
+    return _crop_array(convert_image_to_np_array(image), x, y, w, h)
 
 
-def crop_image(image: Image, x: int, y: int, w: int, h: int) -> Image:
+def crop_image(
+    image: Union[Image, np.ndarray, WarpedImage], x: int, y: int, w: int, h: int
+) -> Union[np.ndarray, WarpedImage]:
     if image is None:
         raise ValueError("No image to crop")
-    return image.crop((x, y, x + w, y + h))
+    if isinstance(image, WarpedImage):
+        return image.crop(x, y, w, h)
+    return _crop_array(convert_image_to_np_array(image), x, y, w, h)
 
 
-def resize_image(image: Image, width: int, height: int) -> Image:
+def _crop_array(data: np.ndarray, x: int, y: int, w: int, h: int) -> np.ndarray:
+    # a view of the image, areas outside of the image are black like in PIL crop
+    height, width = data.shape[:2]
+    if x >= 0 and y >= 0 and x + w <= width and y + h <= height:
+        return data[y : y + h, x : x + w]
+    cropped = np.zeros((max(0, h), max(0, w)) + data.shape[2:], dtype=data.dtype)
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + w), min(height, y + h)
+    if x0 < x1 and y0 < y1:
+        cropped[y0 - y : y1 - y, x0 - x : x1 - x] = data[y0:y1, x0:x1]
+    return cropped
+
+
+def resize_image(
+    image: Union[Image, np.ndarray, WarpedImage], width: int, height: int
+) -> Union[np.ndarray, WarpedImage]:
+    """
+    Resize the image. Images are reduced with area averaging and enlarged with
+    bicubic interpolation, the result differs slightly from PIL's resize.
+    """
     if image is None:
         raise ValueError("No image to resize")
-    return image.resize((width, height))
+    if isinstance(image, WarpedImage):
+        if (width, height) == image.size:
+            return image
+        # a resize is not composed into a WarpedImage, its bilinear sampling
+        # differs from area averaging and would change the readouts
+        image = image.resized_source_data(width, height)
+    data = convert_image_to_np_array(image)
+    if (width, height) == image_size(data):
+        return data
+    reduce = width < data.shape[1] and height < data.shape[0]
+    interpolation = cv2.INTER_AREA if reduce else cv2.INTER_CUBIC
+    return cv2.resize(data, (width, height), interpolation=interpolation)
 
 
 def adjust_image(
-    image: Image,
+    image: Union[Image, np.ndarray],
     contrast: float = 1.0,
     brightness: float = 1.0,
     sharpness: float = 1.0,
     color: float = 1.0,
-) -> Image:
+) -> np.ndarray:
+    """
+    Adjust the image like PIL's ImageEnhance Contrast, Brightness, Sharpness
+    and Color do one after the other, the result is equal to PIL's.
+    """
     if image is None:
         raise ValueError("No image to adjust")
-    image = PIL.ImageEnhance.Contrast(image).enhance(contrast)
-    image = PIL.ImageEnhance.Brightness(image).enhance(brightness)
-    image = PIL.ImageEnhance.Sharpness(image).enhance(sharpness)
-    image = PIL.ImageEnhance.Color(image).enhance(color)
-    return image
+    return enhance_image(image, contrast, brightness, sharpness, color)
+
+
+def enhance_image(
+    image: Union[Image, np.ndarray],
+    contrast: float = 1.0,
+    brightness: float = 1.0,
+    sharpness: float = 1.0,
+    color: float = 1.0,
+    autocontrast: bool = False,
+    cutoff_low: float = 0,
+    cutoff_high: float = 0,
+    ignore: Union[int, None] = None,
+    area: Optional[ImagePosition] = None,
+) -> np.ndarray:
+    """
+    Adjust the image like adjust_image and autocontrast it like
+    autocontrast_image in a single stage, the result is equal to calling them
+    one after the other. Contrast and brightness are merged into one lookup
+    table. If sharpness and color are not changed, the autocontrast lookup
+    table is computed from the histogram of the image mapped by it and merged
+    too, so the image is mapped only once. Otherwise the image is sharpened
+    with a single convolution after the lookup table.
 
+    Args:
+        image (Image | np.ndarray): Image to enhance.
+        contrast, brightness, sharpness, color (float, optional): Enhancement
+        factors like those of PIL's ImageEnhance, 1.0 keeps the image.
+        Defaults to 1.0.
+        autocontrast (bool, optional): Autocontrast the adjusted image.
+        Defaults to False.
+        cutoff_low, cutoff_high, ignore: See autocontrast_image.
+        area (Optional[ImagePosition], optional): Enhance only the pixels in
+        this area, e.g. the bounding box of the cut images. The contrast and
+        the autocontrast are computed from the whole image, so the pixels in
+        the area are equal to those of the whole enhanced image, the other
+        pixels are not changed. The whole image is enhanced if the
+        autocontrast needs the histogram of the sharpened image. Defaults to
+        None.
 
-def convert_to_gray_scale(image: Image) -> Image:
+    Returns:
+        np.ndarray: Enhanced image.
+    """
+    if image is None:
+        raise ValueError("No image to enhance")
+    data = convert_image_to_np_array(image)
+    lut = np.arange(256, dtype=np.uint8)
+    if contrast != 1.0:
+        mean = int(_grayscale(data).mean() + 0.5)
+        lut = _blend_table(float(contrast))[mean][lut]
+    if brightness != 1.0:
+        lut = _blend_table(float(brightness))[0][lut]
+    luts = np.tile(lut, (3, 1))
+    if autocontrast and sharpness == 1.0 and color == 1.0:
+        # histogram of the image mapped by the lookup table
+        hist = np.stack(
+            [np.bincount(lut, weights=h, minlength=256) for h in _histograms(data)]
+        )
+        autocontrast_luts = _autocontrast_luts(
+            hist[np.newaxis].astype(np.int64), cutoff_low, cutoff_high, ignore
+        )[0]
+        luts = np.take_along_axis(autocontrast_luts, luts.astype(np.intp), axis=1)
+        autocontrast = False
+    if autocontrast:
+        area = None
+
+    h, w = data.shape[:2]
+    x0, y0, x1, y1 = 0, 0, w, h
+    if area is not None:
+        x0, y0 = max(0, area.x), max(0, area.y)
+        x1, y1 = min(w, area.x + area.w), min(h, area.y + area.h)
+        if x0 >= x1 or y0 >= y1:
+            return data
+    # sharpening needs the neighbour pixels of the area
+    margin = 1 if sharpness != 1.0 else 0
+    top, left = max(0, y0 - margin), max(0, x0 - margin)
+    region = data[top : min(h, y1 + margin), left : min(w, x1 + margin)]
+    if not np.array_equal(luts, np.tile(np.arange(256), (3, 1))):
+        region = cv2.LUT(region, np.ascontiguousarray(luts.T).reshape(256, 1, 3))
+    if sharpness != 1.0:
+        region = _blend(_smooth(region), region, sharpness)
+    if color != 1.0:
+        region = _blend(convert_to_gray_scale(region), region, color)
+    if autocontrast:
+        region = autocontrast_image(region, cutoff_low, cutoff_high, ignore)
+    if area is None:
+        return region
+    enhanced = data.copy()
+    enhanced[y0:y1, x0:x1] = region[y0 - top : y1 - top, x0 - left : x1 - left]
+    return enhanced
+
+
+def _blend(
+    degenerate: Union[int, np.ndarray], data: np.ndarray, factor: float
+) -> np.ndarray:
+    # PIL's Image.blend interpolates in single precision, the results of all
+    # pairs of degenerate and image pixel values are looked up in a table
+    table = _blend_table(float(factor))
+    if np.isscalar(degenerate):
+        return cv2.LUT(data, table[int(degenerate)])
+    blended = np.empty_like(data)
+    for rows in _row_bands(data.shape[0]):
+        index = degenerate[rows].astype(np.uint16)
+        index <<= 8
+        index |= data[rows]
+        np.take(table.reshape(-1), index, out=blended[rows])
+    return blended
+
+
+@functools.lru_cache(maxsize=16)
+def _blend_table(factor: float) -> np.ndarray:
+    degenerate = np.arange(256, dtype=np.float32)[:, np.newaxis]
+    values = np.arange(256, dtype=np.float32)
+    blended = degenerate + np.float32(factor) * (values - degenerate)
+    table = np.clip(blended, 0, 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+def _smooth(data: np.ndarray) -> np.ndarray:
+    # PIL's ImageFilter.SMOOTH, the border pixels are copied. PIL rounds the
+    # weighted sum divided by 13, which is never exactly between two integers,
+    # so the float rounding of OpenCV gives the same result.
+    kernel = np.float32([[1, 1, 1], [1, 5, 1], [1, 1, 1]]) / 13
+    smoothed = cv2.filter2D(data, -1, kernel)
+    smoothed[[0, -1]] = data[[0, -1]]
+    smoothed[:, [0, -1]] = data[:, [0, -1]]
+    return smoothed
+
+
+def _grayscale(data: np.ndarray) -> np.ndarray:
+    # same luminance as PIL's conversion to mode L, the weighted sums are
+    # integers below 2**24 and exact in single precision
+    weights = np.float32([[19595, 38470, 7471]])
+    gray = np.empty(data.shape[:2], dtype=np.uint8)
+    for rows in _row_bands(data.shape[0]):
+        values = cv2.transform(data[rows].astype(np.float32), weights)
+        values += 0x8000
+        values *= np.float32(1 / 0x10000)
+        gray[rows] = values
+    return gray
+
+
+def _row_bands(height: int, rows: int = 64) -> Iterator[slice]:
+    # process large images in bands to keep temporary arrays small
+    for y in range(0, height, rows):
+        yield slice(y, y + rows)
+
+
+def convert_to_gray_scale(image: Union[Image, np.ndarray]) -> np.ndarray:
     if image is None:
         raise ValueError("No image to convert to gray scale")
-    return ImageOps.grayscale(image).convert("RGB")
+    gray = _grayscale(convert_image_to_np_array(image))
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
 
 
 def autocontrast_image(
-    image: Image,
+    image: Union[Image, np.ndarray],
     cutoff_low: float = 0,
     cutoff_high: float = 0,
     ignore: Union[int, None] = None,
-) -> Image:
+) -> np.ndarray:
     if image is None:
         raise ValueError("No image to autocontrast")
-    if isinstance(image, Image):
-        return ImageOps.autocontrast(
-            image, cutoff=(cutoff_low, cutoff_high), ignore=ignore
-        )
-    if isinstance(image, np.ndarray):
-        return image
+    data = convert_image_to_np_array(image)
+    hist = _histograms(data)
+    lut = _autocontrast_luts(
+        hist[np.newaxis].astype(np.int64), cutoff_low, cutoff_high, ignore
+    )[0]
+    return cv2.LUT(data, np.ascontiguousarray(lut.T).reshape(256, 1, 3))
+
+
+def _histograms(data: np.ndarray) -> np.ndarray:
+    # histogram of every channel, shape (3, 256)
+    return np.stack(
+        [cv2.calcHist([data], [c], None, [256], [0, 256])[:, 0] for c in range(3)]
+    )
+
+
+def cut_images_to_array(
+    image: Union[Image, np.ndarray, WarpedImage],
+    positions: Sequence[ImagePosition],
+    width: int,
+    height: int,
+    out: Optional[np.ndarray] = None,
+    autocontrast: bool = False,
+    cutoff_low: float = 0,
+    cutoff_high: float = 0,
+    ignore: Union[int, None] = None,
+) -> np.ndarray:
+    """
+    Cut the given positions from the image and resize every cut image to the
+    given size in one step. Resizing uses nearest neighbour sampling and gives
+    the same result as PIL resize with NEAREST filter.
+
+    Args:
+        image (Image | np.ndarray | WarpedImage): RGB image. The cut images of
+        a WarpedImage are sampled from its source image with bilinear
+        interpolation instead, unless autocontrast is used.
+        positions (Sequence[ImagePosition]): Positions to cut.
+        width (int): Width of the resized images.
+        height (int): Height of the resized images.
+        out (np.ndarray, optional): Array of shape (N, height, width, 3) where
+        the images are written. Defaults to None, which allocates a new uint8
+        array.
+        autocontrast (bool, optional): Apply autocontrast to every cut image.
+        Histograms are calculated from the full size cut images like
+        autocontrast_image does. Defaults to False.
+        cutoff_low (float, optional): Autocontrast low cutoff in percent.
+        cutoff_high (float, optional): Autocontrast high cutoff in percent.
+        ignore (int, optional): Autocontrast background pixel value.
+
+    Returns:
+        np.ndarray: Array of shape (N, height, width, 3).
+    """
+    if image is None:
+        raise ValueError("No image to cut")
+    if out is None:
+        out = np.empty((len(positions), height, width, 3), dtype=np.uint8)
+    if len(positions) == 0:
+        return out
+    if isinstance(image, WarpedImage) and not autocontrast:
+        return image.cut_images_to_array(positions, width, height, out)
+
+    data, pad_y, pad_x = _pad_to_positions(convert_image_to_np_array(image), positions)
+    data = np.ascontiguousarray(data)
+    indices = _gather_indices(
+        data.shape[1],
+        tuple((pad_x + p.x, pad_y + p.y, p.w, p.h) for p in positions),
+        width,
+        height,
+    )
+    pixels = out if out.dtype == np.uint8 and not autocontrast else None
+    if pixels is None:
+        pixels = _scratch_buffer(out.shape)
+    np.take(data.reshape(-1, 3), indices, axis=0, out=pixels, mode="clip")
+    if autocontrast:
+        crops = [
+            data[pad_y + p.y : pad_y + p.y + p.h, pad_x + p.x : pad_x + p.x + p.w]
+            for p in positions
+        ]
+        luts = autocontrast_luts(crops, cutoff_low, cutoff_high, ignore)
+        offsets = np.arange(len(positions) * 3).reshape(-1, 1, 1, 3) * 256
+        pixels = luts.reshape(-1)[offsets + pixels]
+    if pixels is not out:
+        np.copyto(out, pixels, casting="unsafe")
+    return out
+
+
+def autocontrast_luts(
+    images: Sequence[np.ndarray],
+    cutoff_low: float = 0,
+    cutoff_high: float = 0,
+    ignore: Union[int, None] = None,
+) -> np.ndarray:
+    """
+    Calculate autocontrast lookup tables for RGB images. The lookup tables are
+    equal to the ones PIL ImageOps.autocontrast uses.
+
+    Args:
+        images (Sequence[np.ndarray]): RGB images, can be different sizes.
+        cutoff_low (float, optional): Percent of the darkest pixels to ignore.
+        cutoff_high (float, optional): Percent of the lightest pixels to ignore.
+        ignore (int, optional): Background pixel value.
+
+    Returns:
+        np.ndarray: uint8 array of shape (N, 3, 256), a lookup table for every
+        channel of every image.
+    """
+    count = len(images)
+    offsets = np.arange(3) * 256
+    values = np.concatenate(
+        [img.reshape(-1, 3) + offsets + i * 768 for i, img in enumerate(images)]
+    )
+    hist = np.bincount(values.reshape(-1), minlength=count * 768)
+    return _autocontrast_luts(
+        hist.reshape(count, 3, 256), cutoff_low, cutoff_high, ignore
+    )
+
+
+def _autocontrast_luts(
+    hist: np.ndarray,
+    cutoff_low: float = 0,
+    cutoff_high: float = 0,
+    ignore: Union[int, None] = None,
+) -> np.ndarray:
+    # lookup tables for histograms of shape (N, 3, 256)
+    if ignore is not None:
+        hist[:, :, ignore] = 0
+
+    # remove cutoff percent of the pixels from both ends of the histograms
+    total = hist.sum(axis=2, keepdims=True)
+    cut = np.floor_divide(total * cutoff_low, 100).astype(np.int64)
+    hist = np.diff(np.maximum(np.cumsum(hist, axis=2) - cut, 0), axis=2, prepend=0)
+    cut = np.floor_divide(total * cutoff_high, 100).astype(np.int64)
+    suffix = np.cumsum(hist[:, :, ::-1], axis=2)
+    hist = np.diff(np.maximum(suffix - cut, 0), axis=2, prepend=0)[:, :, ::-1]
+
+    # stretch the remaining range to 0-255
+    used = hist > 0
+    lo = np.where(used.any(axis=2), used.argmax(axis=2), 255)[..., np.newaxis]
+    hi = np.where(used.any(axis=2), 255 - used[:, :, ::-1].argmax(axis=2), 0)
+    hi = hi[..., np.newaxis]
+    identity = np.broadcast_to(np.arange(256), hist.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 255.0 / (hi - lo)
+        stretched = np.arange(256) * scale + (-lo * scale)
+    stretched = np.clip(np.trunc(np.nan_to_num(stretched)), 0, 255)
+    return np.where(hi <= lo, identity, stretched).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=16)
+def _gather_indices(
+    image_width: int,
+    positions: Tuple[Tuple[int, int, int, int], ...],
+    width: int,
+    height: int,
+) -> np.ndarray:
+    # pixel indices of the resized cut images in the flattened image, the
+    # positions are fixed by the configuration so they are calculated once
+    rows = np.stack([y + _nearest_indices(h, height) for x, y, w, h in positions])
+    cols = np.stack([x + _nearest_indices(w, width) for x, y, w, h in positions])
+    return rows[:, :, np.newaxis] * image_width + cols[:, np.newaxis, :]
+
+
+class _ScratchBuffers(threading.local):
+    def __init__(self) -> None:
+        self.buffers: dict = {}
+
+
+_scratch_buffers = _ScratchBuffers()
+
+
+def _scratch_buffer(shape: Tuple[int, ...]) -> np.ndarray:
+    buffer = _scratch_buffers.buffers.get(shape)
+    if buffer is None:
+        buffer = np.empty(shape, dtype=np.uint8)
+        _scratch_buffers.buffers[shape] = buffer
+    return buffer
+
+
+def _nearest_indices(size: int, new_size: int) -> np.ndarray:
+    # same sampling positions as PIL nearest neighbour resize
+    step = size / new_size
+    steps = np.full(new_size, step)
+    steps[0] = step * 0.5
+    return np.cumsum(steps).astype(np.intp)
+
+
+def _pad_to_positions(
+    data: np.ndarray, positions: Sequence[ImagePosition]
+) -> Tuple[np.ndarray, int, int]:
+    # areas outside of the image are black like in PIL crop
+    top = max(0, -min(p.y for p in positions))
+    left = max(0, -min(p.x for p in positions))
+    bottom = max(0, max(p.y + p.h for p in positions) - data.shape[0])
+    right = max(0, max(p.x + p.w for p in positions) - data.shape[1])
+    if top == left == bottom == right == 0:
+        return data, 0, 0
+    return np.pad(data, ((top, bottom), (left, right), (0, 0))), top, left
@@ -29,7 +29,21 @@ def check_roi_image(response: requests.Response):
     assert verify_image(decodedImage, 800, 600), "JEPG"
 
 
+def check_meter_images(response: requests.Response):
+    sources = re.findall("<img src=([^>]*)>", response.text)
+    assert any(source.endswith("/final.jpg") for source in sources)
+    for source in sources:
+        image = requests.get(requests.compat.urljoin(response.url, source), timeout=3)
+        assert image.status_code == 200, source
+        check_image(image)
+
+
 def check_image(response: requests.Response):
     image = PIL.Image.open(io.BytesIO(response.content))
     image.verify()
     assert image.format == "JPEG"
+
+
+def check_original_image(response: requests.Response):
+    with open("/config/original.jpg", "rb") as f:
+        assert response.content == f.read()
@@ -0,0 +1,69 @@
+import numpy as np
+import PIL.Image
+
+from cnn.benchmark import benchmark_models
+from data_classes import ImagePosition, RefImage
+from utils.benchmark import benchmark_alignment, benchmark_pipeline
+
+MODEL_FILES = [
+    "config/neuralnets/digital/dig-class11_1600_s2.tflite",
+    "config/neuralnets/digital/dig-class100_0168_s2_q.tflite",
+    "config/neuralnets/analog/ana-cont_1209_s2.tflite",
+]
+
+
+def test_benchmark_models():
+    frame = np.asarray(PIL.Image.open("config/original.jpg").convert("RGB"))
+    positions = [ImagePosition(f"roi{i}", i * 50, 100, 40, 70) for i in range(3)]
+    results = benchmark_models(MODEL_FILES, [frame, frame], positions[:2], positions)
+
+    assert [result.model_type for result in results] == [
+        "digital11",
+        "digital100",
+        "analog",
+    ]
+    assert [result.images for result in results] == [6, 6, 4]
+    assert results[0].batch_size == 3
+    assert results[0].p95_ms >= results[0].p50_ms > 0
+    assert results[0].batch_images_per_sec > 0
+    assert results[0].peak_rss_mb > 0
+    assert list(results[0].agreement) == [MODEL_FILES[1]]
+    assert results[0].agreement[MODEL_FILES[1]] == results[1].agreement[MODEL_FILES[0]]
+    assert results[2].agreement == {}
+
+
+def test_benchmark_alignment():
+    frame = np.asarray(PIL.Image.open("config/original.jpg").convert("RGB").rotate(180))
+    refs = [
+        RefImage("ref0", 99, 219, 0, 0, "config/Ref_ZR_x99_y219.jpg"),
+        RefImage("ref1", 512, 117, 0, 0, "config/Ref_m3_x512_y117.jpg"),
+        RefImage("ref2", 301, 386, 0, 0, "config/Ref_x0_x301_y386.jpg"),
+    ]
+    results = benchmark_alignment(
+        [frame], refs, search_windows=(0, 50), pyramid_levels=(2,), iterations=1
+    )
+    assert [(r.mode, r.search_window) for r in results] == [
+        ("full", 0),
+        ("pyramid", 0),
+        ("full", 50),
+        ("pyramid", 50),
+        ("phase", 0),
+    ]
+    assert all(result.max_error_px == 0 for result in results[:-1])
+    assert results[-1].max_error_px < 0.01
+    assert results[-1].fallbacks == 0
+    assert all(result.mean_ms > 0 for result in results)
+
+
+def test_benchmark_pipeline():
+    frame = np.zeros((60, 80, 3), dtype=np.uint8)
+    results = [
+        benchmark_pipeline(name, func, frame.nbytes, iterations=3, warmup=1)
+        for name, func in [
+            ("numpy", lambda: np.stack([frame, frame])),
+            ("pil", lambda: PIL.Image.fromarray(frame)),
+        ]
+    ]
+    assert [result.pil_images for result in results] == [0, 1]
+    assert results[0].peak_frames >= 2
+    assert all(result.mean_ms > 0 for result in results)
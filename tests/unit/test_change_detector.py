@@ -0,0 +1,69 @@
+import numpy as np
+
+from data_classes import ImagePosition
+from processor.change_detector import ChangeDetector
+
+POSITIONS = [
+    ImagePosition("digit1", 10, 10, 40, 60),
+    ImagePosition("digit2", 60, 10, 40, 60),
+]
+
+
+def create_image() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(50, 200, (100, 120, 3), dtype=np.uint8)
+
+
+def readout(detector, image, positions=POSITIONS, model=None, source=None):
+    changed, fingerprints = detector.changed_positions(image, positions, model, source)
+    values = [
+        f"{pos.name}-{detector.stats.frames}" for pos, c in zip(positions, changed) if c
+    ]
+    return detector.update(positions, changed, fingerprints, values)
+
+
+def test_unchanged_images_keep_value():
+    detector = ChangeDetector(threshold=2, full_readout_interval=100)
+    image = create_image()
+    assert readout(detector, image) == ["digit1-1", "digit2-1"]
+    assert readout(detector, image) == ["digit1-1", "digit2-1"]
+
+    noise = np.random.default_rng(1).integers(-4, 5, image.shape)
+    noisy = np.clip(image + noise, 0, 255).astype(np.uint8)
+    assert readout(detector, noisy) == ["digit1-1", "digit2-1"]
+
+    changed = image.copy()
+    changed[10:70, 60:100] = 255
+    assert readout(detector, changed) == ["digit1-1", "digit2-4"]
+    assert detector.stats.readouts == 3
+    assert detector.stats.skipped == 5
+
+
+def test_full_readout_interval():
+    detector = ChangeDetector(threshold=2, full_readout_interval=3)
+    image = create_image()
+    readout(detector, image)
+    readout(detector, image)
+    assert readout(detector, image) == ["digit1-3", "digit2-3"]
+
+
+def test_position_or_model_change():
+    detector = ChangeDetector(threshold=2, full_readout_interval=100)
+    image = create_image()
+    readout(detector, image)
+    moved = [POSITIONS[0], ImagePosition("digit2", 61, 10, 40, 60)]
+    assert readout(detector, image, moved) == ["digit1-1", "digit2-2"]
+    assert readout(detector, image, moved, model=object()) == [
+        "digit1-3",
+        "digit2-3",
+    ]
+
+
+def test_source_change():
+    detector = ChangeDetector(threshold=2, full_readout_interval=100)
+    image = create_image()
+    assert readout(detector, image, source="url1") == ["digit1-1", "digit2-1"]
+    assert readout(detector, image, source="url1") == ["digit1-1", "digit2-1"]
+    # the same image from another camera or with another alignment
+    assert readout(detector, image, source="url2") == ["digit1-3", "digit2-3"]
+    assert readout(detector, image, source="url2") == ["digit1-3", "digit2-3"]
@@ -0,0 +1,75 @@
+import numpy as np
+import PIL.Image
+
+from cnn.analog_needle_cnn import AnalogNeedleCNN
+from cnn.benchmark import measure_allocations
+from cnn.digital_counter_cnn import DigitalCounterCNN
+
+
+def _cut_images(count: int) -> list:
+    image = PIL.Image.open("config/original.jpg").convert("RGB")
+    return [
+        image.crop((i * 40, i * 30, i * 40 + 60, i * 30 + 90)) for i in range(count)
+    ]
+
+
+def test_digital_batch_readout_equals_single_readout():
+    images = _cut_images(5)
+    cnn = DigitalCounterCNN(
+        "config/neuralnets/digital/dig-class100_0168_s2_q.tflite", dx=20, dy=32
+    )
+    assert cnn.readout_batch(images) == [cnn.readout(image) for image in images]
+    assert cnn.model.batch_supported is True
+
+
+def test_analog_batch_readout_equals_single_readout():
+    images = _cut_images(4)
+    cnn = AnalogNeedleCNN(
+        "config/neuralnets/analog/ana-cont_1209_s2.tflite", dx=32, dy=32
+    )
+    assert cnn.readout_batch(images) == [cnn.readout(image) for image in images]
+    assert cnn.model.batch_supported is True
+
+
+def test_batch_readout_empty():
+    cnn = AnalogNeedleCNN(
+        "config/neuralnets/analog/ana-cont_1209_s2.tflite", dx=32, dy=32
+    )
+    assert cnn.readout_batch([]) == []
+
+
+def test_zero_copy_readout_equals_batch_readout():
+    images = _cut_images(5)
+    cnn = DigitalCounterCNN(
+        "config/neuralnets/digital/dig-class100_0168_s2_q.tflite",
+        dx=20,
+        dy=32,
+        zero_copy=True,
+    )
+
+    def fill(out: np.ndarray) -> np.ndarray:
+        for i, image in enumerate(images[: len(out)]):
+            out[i] = np.asarray(image.resize((20, 32), PIL.Image.NEAREST))
+        return out
+
+    expected = cnn.readout_batch(images)
+    assert cnn.readout_direct(5, fill) == expected
+    assert cnn.readout_direct(1, fill) == expected[:1]
+    cnn.zero_copy = False
+    assert cnn.readout_direct(5, fill) == expected
+
+
+def test_zero_copy_readout_does_not_allocate_images():
+    cnn = AnalogNeedleCNN(
+        "config/neuralnets/analog/ana-cont_1209_s2.tflite",
+        dx=32,
+        dy=32,
+        zero_copy=True,
+    )
+    result = measure_allocations("readout", lambda: cnn.readout_direct(4, _fill))
+    assert result.max_peak_bytes < 4 * 32 * 32 * 3
+
+
+def _fill(out: np.ndarray) -> np.ndarray:
+    out[...] = 128
+    return out
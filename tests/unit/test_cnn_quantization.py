@@ -0,0 +1,48 @@
+import numpy as np
+
+from cnn.base import CNNBase
+
+
+def _cnn(input_dtype, input_quantization, output_dtype, output_quantization):
+    cnn = CNNBase("model.tflite", dx=2, dy=2)
+    cnn.input_details = [{"dtype": input_dtype, "quantization": input_quantization}]
+    cnn.output_details = [{"dtype": output_dtype, "quantization": output_quantization}]
+    return cnn
+
+
+PIXELS = np.array([[0, 127], [128, 255]], dtype=np.uint8)
+
+
+def test_float_model():
+    cnn = _cnn(np.float32, (0.0, 0), np.float32, (0.0, 0))
+    data = cnn._quantize_input(PIXELS)
+    assert data.dtype == np.float32
+    assert data.tolist() == [[0.0, 127.0], [128.0, 255.0]]
+    output = np.array([[0.25, 0.75]], dtype=np.float32)
+    assert cnn._dequantize_output(output) is output
+
+
+def test_uint8_model_gets_pixels_directly():
+    cnn = _cnn(np.uint8, (1.0, 0), np.uint8, (0.0, 0))
+    data = cnn._quantize_input(PIXELS)
+    assert data is PIXELS
+
+
+def test_int8_model_quantized_input():
+    cnn = _cnn(np.int8, (1.0, -128), np.int8, (1 / 256, -128))
+    data = cnn._quantize_input(PIXELS)
+    assert data.dtype == np.int8
+    assert data.tolist() == [[-128, -1], [0, 127]]
+
+
+def test_quantized_input_is_clipped():
+    cnn = _cnn(np.uint8, (0.5, 0), np.uint8, (0.0, 0))
+    data = cnn._quantize_input(PIXELS)
+    assert data.tolist() == [[0, 254], [255, 255]]
+
+
+def test_quantized_output_is_dequantized():
+    cnn = _cnn(np.int8, (1.0, -128), np.int8, (1 / 256, -128))
+    output = cnn._dequantize_output(np.array([[-128, 0, 127]], dtype=np.int8))
+    assert output.dtype == np.float32
+    assert output.tolist() == [[0.0, 0.5, 255 / 256]]
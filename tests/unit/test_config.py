@@ -15,9 +15,18 @@ def test_config():
     assert config.image_source.url == "file:///config/original.jpg"
     assert config.image_source.timeout == 10
     assert config.image_source.min_size == 20000
+    assert config.image_source.reduced_decode is False
 
     assert config.alignment.rotate_angle == 180
     assert config.alignment.post_rotate_angle == 0
+    assert config.alignment.search_window == 50
+    assert config.alignment.min_confidence == 0.8
+    assert config.alignment.mode == "full"
+    assert config.alignment.pyramid_levels == 2
+    assert config.alignment.reuse_transform is False
+    assert config.alignment.max_transform_age == 10
+    assert config.alignment.phase_min_response == 0.3
+    assert config.alignment.phase_rotation is False
     assert config.alignment.ref_images == [
         RefImage(
             name="ref0",
@@ -69,6 +78,7 @@ def test_config():
     assert config.image_processing.autocontrast_cut_images.cutoff_low == 2.0
     assert config.image_processing.autocontrast_cut_images.cutoff_high == 45
     assert config.image_processing.autocontrast_cut_images.ignore is None
+    assert config.image_processing.cut_images_area_only is False
 
     assert config.digital_readout.enabled is True
     assert (
@@ -76,6 +86,13 @@ def test_config():
         == "/config/neuralnets/digital/dig-class100_0168_s2_q.tflite"
     )
     assert config.digital_readout.model == "auto"
+    assert config.digital_readout.interpreter_pool_size == 1
+    assert config.digital_readout.num_threads == 0
+    assert config.digital_readout.use_xnnpack is True
+    assert config.digital_readout.zero_copy is True
+    assert config.digital_readout.cache_size == 64
+    assert config.digital_readout.change_threshold == 0.0
+    assert config.digital_readout.full_readout_interval == 10
     assert config.digital_readout.cut_images == [
         ImagePosition(name="digit1", x=215, y=97, w=42, h=75),
         ImagePosition(name="digit2", x=273, y=97, w=42, h=75),
@@ -90,6 +107,13 @@ def test_config():
         == "/config/neuralnets/analog/ana-cont_1209_s2.tflite"
     )
     assert config.analog_readout.model == "auto"
+    assert config.analog_readout.interpreter_pool_size == 1
+    assert config.analog_readout.num_threads == 0
+    assert config.analog_readout.use_xnnpack is True
+    assert config.analog_readout.zero_copy is True
+    assert config.analog_readout.cache_size == 64
+    assert config.analog_readout.change_threshold == 0.0
+    assert config.analog_readout.full_readout_interval == 10
     assert config.analog_readout.cut_images == [
         ImagePosition(name="analog1", x=491, y=307, w=115, h=115),
         ImagePosition(name="analog2", x=417, y=395, w=115, h=115),
@@ -0,0 +1,51 @@
+import numpy as np
+
+from processor.image_store import ImageStore
+
+
+def test_image_store():
+    store = ImageStore(max_readings=2)
+    assert store.latest_id == ""
+    assert store.get_encoded("final") is None
+
+    image = np.zeros((20, 30, 3), dtype=np.uint8)
+    first = store.put({"final": image})
+    second = store.put({"final": image, "digit1": image[:10, :10]})
+    assert first != second
+    assert store.latest_id == second
+    assert store.get("digit1") is not None
+    assert store.get("digit1", first) is None
+    assert store.names() == ["final", "digit1"]
+    assert store.names(first) == ["final"]
+
+    encoded = store.get_encoded("final")
+    assert encoded.data.startswith(b"\xff\xd8")
+    assert encoded.format == "jpeg"
+    assert encoded.etag == f'"{second}-final-jpeg-0-0"'
+    assert store.get_encoded("final", second).data is encoded.data
+    assert store.get_encoded("final", first).etag != encoded.etag
+
+    store.put({"final": image})
+    assert store.get_encoded("final", first) is None
+    assert store.get_encoded("final", second).data is encoded.data
+    assert store.get_encoded("unknown") is None
+
+
+def test_image_store_formats():
+    with open("config/original.jpg", "rb") as f:
+        original = f.read()
+    store = ImageStore()
+    store.put({"original": original})
+
+    assert store.get_encoded("original").data is original
+    assert store.get_encoded("original", format="jpeg").data is original
+    encoded = store.get_encoded("original", quality=50)
+    assert encoded.data != original
+    assert encoded.etag.endswith('-original-jpeg-50-0"')
+
+    thumbnail = store.get_encoded("original", format="webp", width=200)
+    assert thumbnail.data[8:12] == b"WEBP"
+    assert thumbnail.etag.endswith('-original-webp-0-200"')
+    png = store.get_encoded("original", format="png", width=1000)
+    assert png.data.startswith(b"\x89PNG")
+    assert png.etag.endswith('-original-png-0-0"')
@@ -0,0 +1,424 @@
+import io
+import os
+
+import cv2
+import numpy as np
+import PIL.Image
+import pytest
+
+from PIL import ImageEnhance, ImageOps
+
+from data_classes import ImagePosition, RefImage
+import utils.image
+
+POSITIONS = [
+    ImagePosition("a", 10, 5, 37, 61),
+    ImagePosition("b", 90, 40, 20, 30),
+    ImagePosition("c", -4, 100, 33, 33),
+    ImagePosition("d", 150, 110, 25, 25),
+]
+
+
+def create_image() -> PIL.Image.Image:
+    rng = np.random.default_rng(1)
+    data = rng.integers(40, 200, (120, 160, 3), dtype=np.uint8)
+    return PIL.Image.fromarray(data)
+
+
+def cut_with_pil(image, autocontrast: bool, width: int, height: int) -> np.ndarray:
+    images = []
+    for pos in POSITIONS:
+        img = image.crop((pos.x, pos.y, pos.x + pos.w, pos.y + pos.h))
+        if autocontrast:
+            img = ImageOps.autocontrast(img, cutoff=(2, 45))
+        images.append(np.asarray(img.resize((width, height), PIL.Image.NEAREST)))
+    return np.stack(images)
+
+
+@pytest.mark.parametrize("autocontrast", [False, True])
+@pytest.mark.parametrize("size", [(20, 32), (32, 32)])
+def test_cut_images_to_array(autocontrast, size):
+    image = create_image()
+    width, height = size
+    expected = cut_with_pil(image, autocontrast, width, height)
+    out = np.empty((len(POSITIONS), height, width, 3), dtype=np.float32)
+    result = utils.image.cut_images_to_array(
+        image,
+        POSITIONS,
+        width,
+        height,
+        out=out,
+        autocontrast=autocontrast,
+        cutoff_low=2,
+        cutoff_high=45,
+    )
+    assert result is out
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_autocontrast_luts():
+    image = create_image()
+    crops = [np.asarray(utils.image.cut_image(image, pos)) for pos in POSITIONS]
+    luts = utils.image.autocontrast_luts(crops, 2, 45, 0)
+    for crop, lut in zip(crops, luts):
+        expected = ImageOps.autocontrast(PIL.Image.fromarray(crop), (2, 45), 0)
+        result = np.stack([lut[c][crop[:, :, c]] for c in range(3)], axis=2)
+        np.testing.assert_array_equal(result, np.asarray(expected))
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_bytes_to_image(image_format):
+    buffered = io.BytesIO()
+    create_image().save(buffered, format=image_format)
+    data = buffered.getvalue()
+    expected = np.asarray(PIL.Image.open(io.BytesIO(data)).convert("RGB"))
+    np.testing.assert_array_equal(utils.image.bytes_to_image(data), expected)
+
+
+@pytest.mark.parametrize("image_format", ["jpeg", "png", "webp"])
+def test_encode_image(image_format):
+    image = np.asarray(create_image())
+    h, w = image.shape[:2]
+    data = utils.image.encode_image(image, image_format, quality=90, width=w // 2)
+    decoded = PIL.Image.open(io.BytesIO(data))
+    assert decoded.format == image_format.upper()
+    assert decoded.size == (w // 2, round(h / 2))
+    assert utils.image.encode_image(image, "jpeg") == (
+        utils.image.convert_image_to_bytes(image)
+    )
+    with pytest.raises(ValueError):
+        utils.image.encode_image(image, "gif")
+
+
+def test_bytes_to_image_invalid_format():
+    buffered = io.BytesIO()
+    create_image().save(buffered, format="BMP")
+    with pytest.raises(ValueError):
+        utils.image.bytes_to_image(buffered.getvalue())
+
+
+def test_bytes_to_reduced_image():
+    with open("config/original.jpg", "rb") as f:
+        data = f.read()
+    assert utils.image.bytes_to_image(data, 4).shape == (150, 200, 3)
+    # 1/2 is the largest reduction which keeps the required scale
+    image = utils.image.bytes_to_reduced_image(data, lambda size: 0.3)
+    assert isinstance(image, utils.image.WarpedImage)
+    assert image.size == (800, 600)
+    assert image.source.shape == (300, 400, 3)
+    image = utils.image.bytes_to_reduced_image(data, lambda size: 1.0)
+    assert isinstance(image, np.ndarray)
+    assert image.shape == (600, 800, 3)
+
+
+@pytest.mark.parametrize(
+    "contrast, brightness, sharpness, color",
+    [(1.2, 1.1, 1.5, 0.8), (0.7, 1.0, 0.5, 1.0), (1.0, 0.9, 2.5, 1.3)],
+)
+def test_adjust_image(contrast, brightness, sharpness, color):
+    image = create_image()
+    expected = ImageEnhance.Contrast(image).enhance(contrast)
+    expected = ImageEnhance.Brightness(expected).enhance(brightness)
+    expected = ImageEnhance.Sharpness(expected).enhance(sharpness)
+    expected = ImageEnhance.Color(expected).enhance(color)
+    result = utils.image.adjust_image(
+        np.asarray(image), contrast, brightness, sharpness, color
+    )
+    np.testing.assert_array_equal(result, np.asarray(expected))
+
+
+@pytest.mark.parametrize(
+    "contrast, brightness, sharpness, color",
+    [(1.2, 1.1, 1.0, 1.0), (0.7, 1.3, 1.0, 1.0), (1.2, 1.1, 1.5, 0.8)],
+)
+def test_enhance_image(contrast, brightness, sharpness, color):
+    image = create_image()
+    data = np.asarray(image)
+    expected = utils.image.autocontrast_image(
+        utils.image.adjust_image(data, contrast, brightness, sharpness, color),
+        2,
+        45,
+    )
+    result = utils.image.enhance_image(
+        data, contrast, brightness, sharpness, color, True, 2, 45
+    )
+    np.testing.assert_array_equal(result, expected)
+
+    expected = utils.image.adjust_image(data, contrast, brightness, sharpness, color)
+    area = ImagePosition("area", 30, -5, 60, 50)
+    result = utils.image.enhance_image(
+        data, contrast, brightness, sharpness, color, area=area
+    )
+    np.testing.assert_array_equal(result[:45, 30:90], expected[:45, 30:90])
+    # pixels outside of the area are not changed
+    np.testing.assert_array_equal(result[45:], data[45:])
+    np.testing.assert_array_equal(result[:, 90:], data[:, 90:])
+
+
+def test_gray_scale_and_autocontrast():
+    image = create_image()
+    data = np.asarray(image)
+    expected = ImageOps.grayscale(image).convert("RGB")
+    result = utils.image.convert_to_gray_scale(data)
+    np.testing.assert_array_equal(result, np.asarray(expected))
+    expected = ImageOps.autocontrast(image, cutoff=(2, 45), ignore=2)
+    result = utils.image.autocontrast_image(data, 2, 45, 2)
+    np.testing.assert_array_equal(result, np.asarray(expected))
+
+
+def test_crop_image():
+    image = create_image()
+    for x, y, w, h in [(10, 5, 37, 61), (-4, 100, 33, 33), (-5, -5, 200, 150)]:
+        result = utils.image.crop_image(np.asarray(image), x, y, w, h)
+        expected = np.asarray(image.crop((x, y, x + w, y + h)))
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_template_cache(tmp_path):
+    file_name = str(tmp_path / "ref.jpg")
+    PIL.Image.fromarray(np.full((20, 30, 3), 100, dtype=np.uint8)).save(file_name)
+    cache = utils.image.TemplateCache()
+    template = cache.get(file_name)
+    assert template.shape == (20, 30, 3)
+    assert cache.get(file_name) is template
+    assert cache.get(file_name, grayscale=True).shape == (20, 30)
+    assert cache.get(file_name, scale=0.5).shape == (10, 15, 3)
+
+    PIL.Image.fromarray(np.full((10, 10, 3), 50, dtype=np.uint8)).save(file_name)
+    stat = os.stat(file_name)
+    os.utime(file_name, (stat.st_atime, stat.st_mtime + 10))
+    assert cache.get(file_name).shape == (10, 10, 3)
+
+
+def test_template_cache_missing_file(tmp_path):
+    with pytest.raises(ValueError):
+        utils.image.TemplateCache().get(str(tmp_path / "missing.jpg"))
+
+
+def test_ref_coordinate_search_window():
+    image = np.asarray(PIL.Image.open("config/original.jpg").convert("RGB"))
+    template = image[200:260, 300:380].copy()
+    full = utils.image._get_ref_coordinate(image, template)
+    assert full == (300, 200)
+    assert utils.image._get_ref_coordinate(image, template, (290, 210), 20) == full
+    # expected position too far away, falls back to the whole image
+    assert utils.image._get_ref_coordinate(image, template, (500, 400), 20) == full
+
+
+REF_IMAGES = [
+    RefImage("ref0", 99, 219, 0, 0, "config/Ref_ZR_x99_y219.jpg"),
+    RefImage("ref1", 512, 117, 0, 0, "config/Ref_m3_x512_y117.jpg"),
+    RefImage("ref2", 301, 386, 0, 0, "config/Ref_x0_x301_y386.jpg"),
+]
+
+
+def load_rotated_image() -> np.ndarray:
+    image = PIL.Image.open("config/original.jpg").convert("RGB")
+    return np.asarray(image.rotate(180))
+
+
+@pytest.mark.parametrize("levels", [1, 2, 3])
+def test_pyramid_alignment_equals_full_alignment(levels):
+    image = load_rotated_image()
+    expected = utils.image.find_reference_coordinates(image, REF_IMAGES)
+    result = utils.image.find_reference_coordinates(
+        image,
+        REF_IMAGES,
+        mode=utils.image.ALIGNMENT_MODE_PYRAMID,
+        pyramid_levels=levels,
+    )
+    assert result == expected
+
+
+def test_unknown_alignment_mode():
+    with pytest.raises(ValueError):
+        utils.image.find_reference_coordinates(
+            load_rotated_image(), REF_IMAGES, mode="x"
+        )
+
+
+def test_transform_cache():
+    image = load_rotated_image()
+    cache = utils.image.TransformCache()
+    assert cache.get(image, REF_IMAGES, 10, 0.8) is None
+
+    coordinates = utils.image.find_reference_coordinates(image, REF_IMAGES)
+    matrix = np.eye(2, 3)
+    cache.put(image, REF_IMAGES, coordinates, matrix)
+    assert cache.get(image, REF_IMAGES, 2, 0.8) is matrix
+    assert cache.get(image, REF_IMAGES, 2, 0.8) is matrix
+    # max age reached
+    assert cache.get(image, REF_IMAGES, 2, 0.8) is None
+
+    cache.put(image, REF_IMAGES, coordinates, matrix)
+    moved = np.roll(image, 2, axis=1)
+    assert cache.get(moved, REF_IMAGES, 10, 0.8) is None
+    assert cache.get(image, REF_IMAGES[:2], 10, 0.8) is None
+
+
+@pytest.mark.parametrize("angle", [0, 90, 180, 270, -90, 30, -7.5])
+def test_rotate_array(angle):
+    image = create_image()
+    expected = np.asarray(image.rotate(angle, expand=True))
+    rotated, matrix = utils.image.rotate_array(np.asarray(image), angle)
+    assert rotated.shape == expected.shape
+    # PIL and OpenCV may round coordinates exactly between two pixels differently
+    assert np.mean(rotated == expected) > 0.99
+    if angle % 90 == 0:
+        assert np.array_equal(rotated, expected)
+        y, x = 17, 42
+        x2, y2 = np.rint(matrix @ [x, y, 1])[:2].astype(int)
+        assert np.array_equal(rotated[y2, x2], np.asarray(image)[y, x])
+
+
+@pytest.mark.parametrize("angle", [90, 180, 30])
+def test_rotate_keep_org_size(angle):
+    image = create_image()
+    expected = np.asarray(image.rotate(angle))
+    rotated = utils.image.rotate(np.asarray(image), angle)
+    assert rotated.shape == expected.shape
+    assert np.mean(rotated == expected) > 0.99
+
+
+@pytest.mark.parametrize("post_rotate_angle", [0, 3])
+def test_rotate_and_align_equals_separate_steps(post_rotate_angle):
+    image = PIL.Image.open("config/original.jpg").convert("RGB")
+    aligned = utils.image.align(
+        utils.image.rotate(image, 180, keep_org_size=False), REF_IMAGES
+    )
+    expected = np.asarray(
+        utils.image.rotate(aligned, post_rotate_angle, keep_org_size=False)
+    )
+    intermediates = {}
+    result = utils.image.rotate_and_align(
+        image, 180, REF_IMAGES, post_rotate_angle, intermediates=intermediates
+    ).data
+    assert result.shape == expected.shape
+    assert np.array_equal(intermediates["aligned"], np.asarray(aligned))
+    assert intermediates["post_rotated"] is result
+    if post_rotate_angle == 0:
+        assert np.array_equal(result, expected)
+    else:
+        # one resampling less, the result differs only slightly
+        assert np.mean(np.abs(result.astype(int) - expected)) < 5
+
+
+@pytest.mark.parametrize("reduction", [2, 4])
+@pytest.mark.parametrize("post_rotate_angle", [0, 3])
+def test_rotate_and_align_reduced_image(reduction, post_rotate_angle):
+    with open("config/original.jpg", "rb") as f:
+        data = f.read()
+    expected = utils.image.rotate_and_align(
+        utils.image.bytes_to_image(data), 180, REF_IMAGES, post_rotate_angle
+    )
+    image = utils.image.bytes_to_reduced_image(data, lambda size: 1 / reduction)
+    result = utils.image.rotate_and_align(image, 180, REF_IMAGES, post_rotate_angle)
+    assert result.size == expected.size
+    # the aligned image is mapped from nearly the same pixels of the downloaded
+    # image, the error is below one pixel of the reduced image
+    points = np.array([[50, 50, 1], [750, 50, 1], [400, 300, 1], [50, 550, 1]]).T
+    scale = utils.image._scale_matrix((800 // reduction, 600 // reduction), (800, 600))
+    error = np.linalg.inv(expected.matrix) @ points
+    error -= scale @ np.linalg.inv(result.matrix) @ points
+    assert np.max(np.hypot(*error[:2])) < reduction
+
+
+@pytest.mark.parametrize("post_rotate_angle", [0, 3])
+def test_warped_image_cut_images(post_rotate_angle):
+    image = PIL.Image.open("config/original.jpg").convert("RGB")
+    warped = utils.image.rotate_and_align(
+        image, 180, REF_IMAGES, post_rotate_angle
+    ).crop(20, 10, 700, 560)
+    positions = POSITIONS + [ImagePosition("e", 680, 540, 40, 40)]
+    result = utils.image.cut_images_to_array(warped, positions, 20, 32)
+    assert "data" not in vars(warped)
+    expected = utils.image.cut_images_to_array(warped.data, positions, 20, 32)
+    # same pixels, only OpenCV's fixed point interpolation may differ, the
+    # compiled pipelines always cut from the same kind of image
+    assert np.mean(result == expected) > 0.99
+    assert np.max(np.abs(result.astype(int) - expected)) <= 3
+    assert not result[-1, -1].any()
+
+
+def test_warped_image_crop_past_edge():
+    image = PIL.Image.open("config/original.jpg").convert("RGB")
+    warped = utils.image.rotate_and_align(image, 180, REF_IMAGES, 90)
+    assert warped.size == (600, 800)
+    cropped = warped.crop(-50, 300, 800, 800)
+    assert cropped.bounds == (50, 0, 650, 500)
+    # areas outside of the rotated image are black like in PIL crop
+    expected = utils.image.crop_image(warped.data, -50, 300, 800, 800)
+    assert np.max(np.abs(cropped.data.astype(int) - expected)) <= 3
+    assert not cropped.data[:, :50].any() and not cropped.data[500:].any()
+    positions = [ImagePosition("a", 0, 0, 40, 40), ImagePosition("b", 610, 460, 80, 80)]
+    result = utils.image.cut_images_to_array(cropped, positions, 20, 20)
+    assert not result[0].any()
+    assert not result[1, 10:].any() and not result[1, :, 10:].any()
+    assert result[1, :10, :10].any()
+
+
+def test_warped_image_resize():
+    data = np.asarray(create_image())
+    warped = utils.image.WarpedImage(data, np.eye(3), (160, 120))
+    assert utils.image.resize_image(warped, 160, 120) is warped
+    # the whole image is resized with area averaging like an array
+    resized = utils.image.resize_image(warped, 80, 60)
+    expected = cv2.resize(data, (80, 60), interpolation=cv2.INTER_AREA)
+    np.testing.assert_array_equal(resized, expected)
+
+
+def test_warped_image_resize_reduced_source():
+    data = np.asarray(create_image())
+    scale = utils.image._scale_matrix((160, 120), (640, 480))
+    warped = utils.image.WarpedImage(data, scale, (640, 480))
+    # the image is computed at the resolution of the source, not at full size
+    assert warped.resized_source_data(80, 60).shape == (120, 160, 3)
+    assert warped.resized_source_data(320, 240).shape == (240, 320, 3)
+    resized = utils.image.resize_image(warped, 80, 60)
+    assert "data" not in vars(warped)
+    expected = cv2.resize(data, (80, 60), interpolation=cv2.INTER_AREA)
+    np.testing.assert_array_equal(resized, expected)
+
+
+def transformed_ref_positions(matrix: np.ndarray) -> np.ndarray:
+    # positions in the image which are mapped to the reference image positions
+    inverse = np.linalg.inv(np.vstack([matrix, [0, 0, 1]]))
+    targets = np.array([(ref.x, ref.y, 1) for ref in REF_IMAGES]).T
+    return (inverse @ targets)[:2].T
+
+
+@pytest.mark.parametrize(
+    "dx, dy, angle, rotation",
+    [(6.5, -3.25, 0, False), (-12, 8, 0, True), (4, 2, 1.5, True)],
+)
+def test_phase_alignment(dx, dy, angle, rotation):
+    image = load_rotated_image()
+    utils.image.phase_reference.clear()
+    expected = utils.image.alignment_matrix(
+        image, REF_IMAGES, mode=utils.image.ALIGNMENT_MODE_PHASE
+    )
+    assert np.allclose(expected, utils.image.alignment_matrix(image, REF_IMAGES))
+
+    h, w = image.shape[:2]
+    drift = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1)
+    drift[:, 2] += [dx, dy]
+    moved = cv2.warpAffine(image, drift, (w, h))
+    matrix = utils.image.phase_reference.get(moved, REF_IMAGES, 0.3, rotation)
+    assert matrix is not None
+    positions = transformed_ref_positions(matrix)
+    moved_positions = (drift[:, :2] @ transformed_ref_positions(expected).T).T
+    moved_positions += drift[:, 2]
+    assert np.max(np.hypot(*(positions - moved_positions).T)) < 1
+
+
+def test_phase_alignment_fallback():
+    image = load_rotated_image()
+    reference = utils.image.PhaseReference()
+    assert reference.get(image, REF_IMAGES, 0.3) is None
+    reference.put(image, REF_IMAGES, np.eye(2, 3))
+    for _ in range(3):
+        assert np.array_equal(reference.get(image, REF_IMAGES, 0.9), np.eye(2, 3))
+    assert reference.get(image, REF_IMAGES[:2], 0.3) is None
+    # a different image has no phase correlation peak
+    noise = np.random.default_rng(1).integers(0, 255, image.shape, dtype=np.uint8)
+    assert reference.get(noise, REF_IMAGES, 0.3) is None
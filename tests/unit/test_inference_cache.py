@@ -0,0 +1,84 @@
+import os
+import shutil
+
+import numpy as np
+
+from cnn.cache import InferenceCache
+from cnn.digital_counter_cnn import DigitalCounterCNN
+
+MODEL_FILE = "config/neuralnets/digital/dig-class100_0168_s2_q.tflite"
+
+
+def test_cache_lru():
+    cache = InferenceCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.size == 2
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+    assert cache.stats.evictions == 1
+
+
+def test_cache_disabled():
+    cache = InferenceCache()
+    cache.put("a", 1)
+    assert cache.enabled is False
+    assert cache.get("a") is None
+    assert cache.stats.size == 0
+
+
+def test_cache_resize():
+    cache = InferenceCache(max_size=3)
+    for i in range(3):
+        cache.put(i, i)
+    cache.resize(1)
+    assert cache.stats.size == 1
+    assert cache.get(2) == 2
+
+
+def _fill(values: list):
+    def fill(out: np.ndarray) -> np.ndarray:
+        for i, value in enumerate(values):
+            out[i] = value
+        return out
+
+    return fill
+
+
+def test_cached_readout(tmp_path):
+    model_file = str(tmp_path / "model.tflite")
+    shutil.copyfile(MODEL_FILE, model_file)
+    cnn = DigitalCounterCNN(model_file, dx=20, dy=32, cache_size=8)
+    keys = ["digit1", "digit2", "digit3"]
+    expected = cnn.readout_direct(3, _fill([0, 128, 255]))
+
+    assert cnn.readout_cached(keys, _fill([0, 128, 255])) == expected
+    checkout_count = cnn.model.pool.stats.checkout_count
+    assert cnn.readout_cached(keys, _fill([0, 128, 255])) == expected
+    assert cnn.model.pool.stats.checkout_count == checkout_count
+    assert cnn.model.cache.stats.hits == 3
+
+    values = cnn.readout_cached(keys, _fill([0, 128, 64]))
+    assert values[:2] == expected[:2]
+    assert values[2] == cnn.readout_direct(1, _fill([64]))[0]
+    assert cnn.model.cache.stats.hits == 5
+    assert cnn.model.cache.stats.misses == 4
+
+
+def test_cache_invalidated_when_model_changes(tmp_path):
+    model_file = str(tmp_path / "model.tflite")
+    shutil.copyfile(MODEL_FILE, model_file)
+    cnn = DigitalCounterCNN(model_file, dx=20, dy=32, cache_size=8)
+    cnn.readout_cached(["digit1"], _fill([128]))
+    assert cnn.model.cache.stats.size == 1
+
+    stat = os.stat(model_file)
+    os.utime(model_file, (stat.st_atime, stat.st_mtime + 10))
+    cnn = DigitalCounterCNN(model_file, dx=20, dy=32)
+    assert cnn.model.cache.stats.size == 0
+    assert cnn.model.cache.stats.max_size == 8
@@ -0,0 +1,110 @@
+import os
+import shutil
+import threading
+
+from cnn.registry import InterpreterOptions, ModelRegistry
+
+MODEL_FILE = "config/neuralnets/digital/dig-class11_1600_s2.tflite"
+
+
+def test_model_reused():
+    registry = ModelRegistry()
+    model1 = registry.get(MODEL_FILE)
+    model2 = registry.get(MODEL_FILE)
+    assert model1 is model2
+
+    stats = registry.get_stats()
+    assert len(stats) == 1
+    assert stats[0].loaded is True
+    assert stats[0].load_count == 1
+    assert stats[0].reuse_count == 1
+    assert stats[0].last_load_time > 0
+
+
+def test_model_reloaded_when_file_changes(tmp_path):
+    model_file = str(tmp_path / "model.tflite")
+    shutil.copyfile(MODEL_FILE, model_file)
+    registry = ModelRegistry()
+    model1 = registry.get(model_file)
+    stat = os.stat(model_file)
+    os.utime(model_file, (stat.st_atime, stat.st_mtime + 10))
+    model2 = registry.get(model_file)
+    assert model1 is not model2
+    assert registry.get_stats()[0].load_count == 2
+
+
+def test_retain():
+    registry = ModelRegistry()
+    registry.get(MODEL_FILE)
+    registry.retain([MODEL_FILE])
+    assert registry.get_stats()[0].loaded is True
+    registry.retain(["config/neuralnets/analog/ana-cont_1209_s2.tflite"])
+    assert registry.get_stats()[0].loaded is False
+    registry.get(MODEL_FILE)
+    assert registry.get_stats()[0].load_count == 2
+
+
+def test_pool_checkout():
+    registry = ModelRegistry()
+    model = registry.get(MODEL_FILE, pool_size=2)
+    with model.pool.checkout() as item1:
+        with model.pool.checkout() as item2:
+            assert item1.interpreter is not item2.interpreter
+            assert model.pool.stats.in_use == 2
+
+    stats = registry.get_stats()[0].pool
+    assert stats.size == 2
+    assert stats.interpreters == 2
+    assert stats.in_use == 0
+    assert stats.checkout_count == 2
+    assert stats.wait_count == 0
+
+
+def test_pool_wait():
+    registry = ModelRegistry()
+    model = registry.get(MODEL_FILE, pool_size=1)
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def worker() -> None:
+        with model.pool.checkout():
+            checked_out.set()
+            release.wait()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    checked_out.wait()
+    threading.Timer(0.05, release.set).start()
+    with model.pool.checkout():
+        pass
+    thread.join()
+
+    stats = registry.get_stats()[0].pool
+    assert stats.interpreters == 1
+    assert stats.checkout_count == 2
+    assert stats.wait_count == 1
+    assert stats.max_wait_time > 0
+
+
+def test_pool_resize():
+    registry = ModelRegistry()
+    model = registry.get(MODEL_FILE, pool_size=2)
+    with model.pool.checkout(), model.pool.checkout():
+        pass
+    assert model.pool.stats.interpreters == 2
+    registry.get(MODEL_FILE, pool_size=1)
+    assert model.pool.stats.size == 1
+    assert model.pool.stats.interpreters == 1
+
+
+def test_model_reloaded_when_options_change():
+    registry = ModelRegistry()
+    model1 = registry.get(MODEL_FILE, options=InterpreterOptions(num_threads=1))
+    model2 = registry.get(MODEL_FILE)
+    assert model1 is model2
+    model3 = registry.get(MODEL_FILE, options=InterpreterOptions(use_xnnpack=False))
+    assert model3 is not model1
+    stats = registry.get_stats()[0]
+    assert stats.load_count == 2
+    assert stats.num_threads == 0
+    assert stats.use_xnnpack is False
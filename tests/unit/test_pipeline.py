@@ -0,0 +1,212 @@
+import base64
+import json
+import os
+
+import numpy as np
+import pytest
+
+from configuration import Config
+from data_classes import RefImage
+from processor.digitizer import ANALOG_IMAGE_SIZE, DigitizerProcessor
+from processor.image import ImageProcessor
+import processor.pipeline as pipeline
+import utils.image
+
+
+def _config() -> Config:
+    config = Config().load_from_file("config/config.ini")
+    config.image_source.url = f"file://{os.path.abspath('config/original.jpg')}"
+    config.image_source.min_size = 0
+    config.alignment.ref_images = [
+        RefImage("ref0", 99, 219, 0, 0, "config/Ref_ZR_x99_y219.jpg"),
+        RefImage("ref1", 512, 117, 0, 0, "config/Ref_m3_x512_y117.jpg"),
+        RefImage("ref2", 301, 386, 0, 0, "config/Ref_x0_x301_y386.jpg"),
+    ]
+    return config
+
+
+def test_compile_pipeline():
+    config = _config()
+    plan = pipeline.compile_pipeline(config)
+    assert [stage.name for stage in plan.stages] == [
+        "download",
+        "decode",
+        "rotate_and_align",
+    ]
+    image, pictures = plan.run(config.image_source.url)
+    assert isinstance(image, utils.image.WarpedImage)
+    assert list(pictures) == ["final"]
+
+    config.crop.enabled = True
+    config.crop.x, config.crop.y, config.crop.w, config.crop.h = 20, 30, 500, 400
+    config.image_processing.enabled = True
+    config.image_processing.grayscale = True
+    config.image_processing.contrast = 1.5
+    config.image_processing.autocontrast.enabled = True
+    plan = pipeline.compile_pipeline(config, saveimages=True)
+    assert [stage.name for stage in plan.stages] == [
+        "download",
+        "save original",
+        "decode",
+        "rotate_and_align",
+        "crop",
+        "save cropped",
+        "gray",
+        "save gray",
+        "enhance",
+        "save processed",
+    ]
+    image, pictures = plan.run(config.image_source.url)
+    cutoffs = config.image_processing.autocontrast
+    expected = (
+        ImageProcessor()
+        .download_image(config.image_source.url, 10)
+        .rotate_and_align_image(180, config.alignment.ref_images, search_window=50)
+        .crop_image(20, 30, 500, 400)
+        .to_gray_scale()
+        .adjust_image(contrast=1.5)
+        .autocontrast_image(cutoffs.cutoff_low, cutoffs.cutoff_high, cutoffs.ignore)
+        .get_image_as_np_array()
+    )
+    np.testing.assert_array_equal(image, expected)
+    assert set(pictures) == {
+        "original",
+        "rotated",
+        "aligned",
+        "post_rotated",
+        "cropped",
+        "gray",
+        "processed",
+        "final",
+    }
+    with open("config/original.jpg", "rb") as f:
+        assert pictures["original"] == f.read()
+
+    description = json.loads(json.dumps(plan.describe()))
+    assert description["saveimages"] is True
+    assert description["stages"][3]["params"]["ref_images"][0]["name"] == "ref0"
+    assert description["stages"][8]["params"]["contrast"] == 1.5
+    assert all(stage["calls"] == 1 for stage in description["stages"])
+    assert all(stage["mean_ms"] == stage["last_ms"] for stage in description["stages"])
+
+
+def test_compile_pipeline_autocontrast_disabled():
+    config = _config()
+    config.image_processing.enabled = True
+    config.image_processing.contrast = 1.5
+    config.image_processing.autocontrast.enabled = False
+    image, _ = pipeline.compile_pipeline(config).run(config.image_source.url)
+    adjusted = (
+        ImageProcessor()
+        .download_image(config.image_source.url, 10)
+        .rotate_and_align_image(180, config.alignment.ref_images, search_window=50)
+        .adjust_image(contrast=1.5)
+    )
+    np.testing.assert_array_equal(image, adjusted.get_image_as_np_array())
+    # the chain before the enhance stage tested the AutoContrast section
+    # instead of its enabled flag and always applied autocontrast
+    cutoffs = config.image_processing.autocontrast
+    previous = adjusted.autocontrast_image(
+        cutoffs.cutoff_low, cutoffs.cutoff_high, cutoffs.ignore
+    ).get_image_as_np_array()
+    assert not np.array_equal(image, previous)
+
+
+def _resize(config: Config) -> None:
+    config.resize.enabled = True
+    config.resize.w, config.resize.h = 640, 480
+
+
+def _rotate_and_crop_past_edge(config: Config) -> None:
+    config.alignment.post_rotate_angle = 90
+    config.crop.enabled = True
+    config.crop.x, config.crop.y, config.crop.w, config.crop.h = -50, 300, 800, 800
+
+
+@pytest.mark.parametrize("setup", [None, _resize, _rotate_and_crop_past_edge])
+def test_readout_independent_of_saveimages(setup):
+    config = _config()
+    if setup is not None:
+        setup(config)
+    positions = config.analog_readout.cut_images
+    cut_images, readings = [], []
+    for saveimages in [False, True]:
+        image, pictures = pipeline.compile_pipeline(config, saveimages).run(
+            config.image_source.url
+        )
+        image = ImageProcessor().set_processed_image(image, pictures)
+        image = image.get_image_for_cutting()
+        cut_images.append(
+            utils.image.cut_images_to_array(image, positions, *ANALOG_IMAGE_SIZE)
+        )
+        digitizer = (
+            DigitizerProcessor()
+            .init_analog_model(
+                "config/neuralnets/analog/ana-cont_1209_s2.tflite",
+                config.analog_readout.model,
+            )
+            .execute_analog_ccn_on_image(image, positions)
+        )
+        readings.append(digitizer.cnn_analog_results)
+    # both plans sample the cut images the same way
+    np.testing.assert_array_equal(cut_images[0], cut_images[1])
+    assert readings[0] == readings[1]
+
+
+def test_stage_cache():
+    image = utils.image.convert_image_base64str(
+        utils.image.bytes_to_image(open("config/original.jpg", "rb").read())
+    )
+
+    def stages(cutoff_low):
+        return [
+            pipeline.decode_base64_stage(),
+            pipeline.rotate_stage(180),
+            pipeline.crop_stage(20, 30, 500, 400),
+            pipeline.adjust_stage(contrast=1.5),
+            pipeline.autocontrast_stage(cutoff_low, 45),
+        ]
+
+    cache = pipeline.StageCache()
+    result = cache.run(stages(2), image)
+    expected = (
+        ImageProcessor()
+        .set_image_from_base64_str(image)
+        .rotate_image(180)
+        .crop_image(20, 30, 500, 400)
+        .adjust_image(contrast=1.5)
+        .autocontrast_image(2, 45)
+        .get_image_as_np_array()
+    )
+    np.testing.assert_array_equal(result, expected)
+    assert not result.flags.writeable
+    assert (cache.stats.hits, cache.stats.misses) == (0, 5)
+
+    # only autocontrast is computed again
+    cache.run(stages(5), image)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 6)
+    assert cache.run(stages(2), image) is result
+    assert (cache.stats.hits, cache.stats.misses) == (2, 6)
+
+    cache = pipeline.StageCache(max_bytes=2 * result.nbytes)
+    cache.run(stages(2), image)
+    assert cache.stats.size <= 2 * result.nbytes
+    assert cache.stats.evictions > 0
+
+
+def test_preview_stages():
+    with open("config/original.jpg", "rb") as f:
+        image = base64.b64encode(f.read()).decode("utf-8")
+    size = utils.image.image_size_from_base64_str(image)
+    assert size == (800, 600)
+
+    stages, scale = pipeline.preview_stages(size, (300, 300))
+    assert scale == 300 / 800
+    assert [stage.name for stage in stages] == ["decode", "resize"]
+    assert stages[0].params["reduction"] == 2
+    assert pipeline.StageCache().run(stages, image).shape == (225, 300, 3)
+
+    stages, scale = pipeline.preview_stages(size, (800, 600))
+    assert scale == 1.0
+    assert [stage.name for stage in stages] == ["decode"]
+    assert stages[0].params["reduction"] == 1